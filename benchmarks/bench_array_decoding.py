@@ -0,0 +1,184 @@
+"""
+Compares decoding the array columns of a UCR export with
+``ast.literal_eval()`` per cell (as ``convert_to_array()`` used to)
+against ``convert_array_column()``.
+
+    $ python -m benchmarks.bench_array_decoding --rows 200000
+
+"""
+import argparse
+import ast
+import io
+import random
+import time
+
+import pandas
+
+from hq_superset.utils import convert_array_column, convert_to_array
+
+ARRAY_COLUMNS = ['tags', 'services', 'symptoms', 'visit_types', 'owner_ids']
+
+
+def convert_to_array_literal_eval(string_array):
+    try:
+        array_values = ast.literal_eval(string_array)
+    except (ValueError, SyntaxError):
+        return []
+    if isinstance(array_values, tuple):
+        array_values = list(array_values)
+    if not array_values or array_values == [None]:
+        return []
+    return array_values
+
+
+def generate_export(rows, vocabulary_size=10, max_length=4, seed=0):
+    """
+    Returns CSV text shaped like a UCR export of a datasource with
+    many array indicators, like the answers to multi-select questions.
+    """
+    rand = random.Random(seed)
+    vocabulary = [f'value_{i}' for i in range(vocabulary_size)]
+
+    def value():
+        length = rand.randrange(max_length + 1)
+        if not length:
+            return '"[None]"'
+        # Multi-select answers are in the order of the choices
+        return '"' + repr(sorted(rand.sample(vocabulary, length))) + '"'
+
+    lines = [','.join(['doc_id'] + ARRAY_COLUMNS)]
+    for i in range(rows):
+        lines.append(','.join([f'doc{i}'] + [value() for __ in ARRAY_COLUMNS]))
+    return '\n'.join(lines) + '\n'
+
+
+def read_strings(csv_text):
+    """
+    Returns the export as chunks of 10,000 rows, like
+    ``refresh_hq_datasource()`` reads it, with array columns as strings.
+    """
+    dtype = {'doc_id': 'string'}
+    dtype.update({c: 'string' for c in ARRAY_COLUMNS})
+    return list(pandas.read_csv(
+        io.StringIO(csv_text),
+        chunksize=10000,
+        dtype=dtype,
+    ))
+
+
+def decode_literal_eval(df):
+    return [df[c].map(convert_to_array_literal_eval) for c in ARRAY_COLUMNS]
+
+
+def decode_tokenizer(df):
+    return [df[c].map(convert_to_array) for c in ARRAY_COLUMNS]
+
+
+def decode_column(df, decoded=None):
+    if decoded is None:
+        decoded = {c: {} for c in ARRAY_COLUMNS}
+    return [convert_array_column(df[c], decoded[c]) for c in ARRAY_COLUMNS]
+
+
+def decode_chunks(decode, chunks):
+    # Results are dropped after each chunk, as they are during an import
+    if decode is decode_column:
+        decoded = {c: {} for c in ARRAY_COLUMNS}
+        for df in chunks:
+            decode(df, decoded)
+    else:
+        for df in chunks:
+            decode(df)
+
+
+def import_literal_eval(csv_text):
+    """
+    How exports were read before: ``convert_to_array()`` with
+    ``ast.literal_eval()`` as a ``read_csv()`` converter.
+    """
+    converters = {c: convert_to_array_literal_eval for c in ARRAY_COLUMNS}
+    return pandas.concat(pandas.read_csv(
+        io.StringIO(csv_text),
+        chunksize=10000,
+        dtype={'doc_id': 'string'},
+        converters=converters,
+    ))
+
+
+def import_column(csv_text):
+    """
+    How ``refresh_hq_datasource()`` reads exports now.
+    """
+    dtype = {'doc_id': 'string'}
+    dtype.update({c: 'string' for c in ARRAY_COLUMNS})
+    decoded = {c: {} for c in ARRAY_COLUMNS}
+    chunks = []
+    for df in pandas.read_csv(io.StringIO(csv_text), chunksize=10000, dtype=dtype):
+        for column in ARRAY_COLUMNS:
+            df[column] = convert_array_column(df[column], decoded[column])
+        chunks.append(df)
+    return pandas.concat(chunks)
+
+
+def best_of(repeat, func, *args):
+    times = []
+    for __ in range(repeat):
+        start = time.perf_counter()
+        result = func(*args)
+        times.append(time.perf_counter() - start)
+    return min(times), result
+
+
+def print_results(title, rows, results):
+    baseline_time = results[0][1]
+    print(title)
+    print(f"  {'decoder':<22}{'seconds':>10}{'rows/s':>14}{'speed-up':>10}")
+    for name, seconds in results:
+        print(
+            f"  {name:<22}{seconds:>10.2f}{rows / seconds:>14,.0f}"
+            f"{baseline_time / seconds:>9.1f}x"
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--rows', type=int, default=200_000)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument(
+        '--vocabulary-size',
+        type=int,
+        default=10,
+        help='The number of distinct array items. Larger values mean '
+             'fewer repeated arrays.',
+    )
+    parser.add_argument('--max-length', type=int, default=4)
+    args = parser.parse_args()
+
+    csv_text = generate_export(args.rows, args.vocabulary_size, args.max_length)
+    print(f"{args.rows} rows, {len(ARRAY_COLUMNS)} array columns")
+
+    chunks = read_strings(csv_text)
+    expected = [values.tolist() for values in decode_literal_eval(chunks[0])]
+    decode_results = []
+    for name, decode in (
+        ('literal_eval per cell', decode_literal_eval),
+        ('tokenizer per cell', decode_tokenizer),
+        ('convert_array_column', decode_column),
+    ):
+        assert [values.tolist() for values in decode(chunks[0])] == expected, name
+        seconds = best_of(args.repeat, decode_chunks, decode, chunks)[0]
+        decode_results.append((name, seconds))
+    print_results('Decoding array columns:', args.rows, decode_results)
+
+    import_results = [
+        (name, best_of(args.repeat, func, csv_text)[0])
+        for name, func in (
+            ('literal_eval', import_literal_eval),
+            ('convert_array_column', import_column),
+        )
+    ]
+    print_results('Reading and decoding the export:', args.rows, import_results)
+
+
+if __name__ == '__main__':
+    main()
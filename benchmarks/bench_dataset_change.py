@@ -0,0 +1,218 @@
+"""
+Applies single-document dataset changes, like the ones CommCare HQ
+forwards to the "change" API, and reports their latency with the
+resolved table cached per worker and without.
+
+    $ python -m benchmarks.bench_dataset_change --changes 1000 --mix narrow typical
+
+Without the cache, every change looks up its dataset and reflects its
+table, which is the per-change overhead that the cache saves.
+
+Compare replacing the rows of each document with writing only the rows
+that differ (``HQ_DATASET_CHANGE_APPLY_DIFF``), which also reports the
+WAL that each run writes:
+
+    $ python -m benchmarks.bench_dataset_change --apply replace diff
+
+The changes are the rows that the table was imported with, so with
+"diff" every row is unchanged, unless ``--change-rate`` of them are
+changed.
+
+Changes are applied to the HQ database of the Superset config given
+by ``SUPERSET_CONFIG_PATH``, which defaults to the test config (a
+local PostgreSQL database), and to its cache.
+"""
+import argparse
+import csv
+import io
+import itertools
+import os
+import random
+import shutil
+import statistics
+import tempfile
+import time
+from unittest.mock import patch
+from zipfile import ZipFile
+
+from benchmarks.bench_import import DOMAIN, create_app, create_user
+from benchmarks.synthetic import (
+    COLUMN_MIXES,
+    generate_datasource_defn,
+    generate_export,
+)
+
+# Array indicators are sent as lists, not as the strings of the export
+CHANGE_MIXES = sorted(
+    mix for mix, column_mix in COLUMN_MIXES.items() if 'array' not in column_mix
+)
+
+
+def read_changes(export_path, datasource_id, change_rate=0.0, seed=0):
+    """
+    Returns a change for each row of the export, which replaces the
+    row of its document. ``change_rate`` of the changes set a new
+    ``inserted_at``, which is different for each ``seed``.
+    """
+    rand = random.Random(seed)
+    with ZipFile(export_path) as zipfile:
+        name = zipfile.namelist()[0]
+        with zipfile.open(name) as raw:
+            rows = list(csv.DictReader(io.TextIOWrapper(raw, encoding='utf-8')))
+    changes = []
+    for row in rows:
+        row = {k: v if v != '' else None for k, v in row.items()}
+        if rand.random() < change_rate:
+            row['inserted_at'] = f'2030-01-01 00:00:{seed % 60:02d}'
+        changes.append({
+            'data_source_id': datasource_id,
+            'doc_id': row['doc_id'],
+            'data': [row],
+        })
+    return changes
+
+
+def apply_changes(changes, cached):
+    """
+    Applies each change, and returns the latency of each in seconds.
+    """
+    from hq_superset.models import DataSetChange
+    from hq_superset.table_cache import clear_table_cache
+
+    seconds = []
+    for change in changes:
+        if not cached:
+            clear_table_cache()
+        start = time.perf_counter()
+        DataSetChange(**change).update_dataset()
+        seconds.append(time.perf_counter() - start)
+    return seconds
+
+
+def get_wal_lsn(database):
+    from sqlalchemy.sql import text
+
+    with database.get_sqla_engine_with_context() as engine:
+        return engine.execute(text('SELECT pg_current_wal_lsn()')).scalar()
+
+
+def get_wal_bytes(database, start_lsn):
+    from sqlalchemy.sql import text
+
+    with database.get_sqla_engine_with_context() as engine:
+        return engine.execute(
+            text('SELECT pg_wal_lsn_diff(pg_current_wal_lsn(), :lsn)'),
+            {'lsn': start_lsn},
+        ).scalar()
+
+
+def print_results(label, seconds, wal_bytes):
+    seconds = sorted(seconds)
+    p95 = seconds[int(len(seconds) * 0.95)]
+    print(
+        f"  {label:<18}{statistics.mean(seconds) * 1000:>10.2f}"
+        f"{statistics.median(seconds) * 1000:>10.2f}{p95 * 1000:>10.2f}"
+        f"{len(seconds) / sum(seconds):>14,.0f}"
+        f"{wal_bytes / 1000:>10,.0f}"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--changes', type=int, default=1000)
+    parser.add_argument(
+        '--mix',
+        nargs='+',
+        choices=CHANGE_MIXES,
+        default=['narrow'],
+        help='The mix of indicator data types of the datasource',
+    )
+    parser.add_argument(
+        '--apply',
+        nargs='+',
+        choices=['replace', 'diff'],
+        default=['replace'],
+        help='How to apply the changes',
+    )
+    parser.add_argument(
+        '--change-rate',
+        type=float,
+        default=0.0,
+        help='The proportion of changes that change their row',
+    )
+    args = parser.parse_args()
+
+    app = create_app()
+    directory = tempfile.mkdtemp(prefix='bench_dataset_change_')
+    try:
+        with app.app_context():
+            from sqlalchemy.sql import text
+
+            from hq_superset.services import refresh_hq_datasource
+            from hq_superset.utils import (
+                get_hq_database,
+                get_schema_name_for_domain,
+            )
+
+            user_id = create_user(app).id
+            database = get_hq_database()
+            schema = get_schema_name_for_domain(DOMAIN)
+            with database.get_sqla_engine_with_context() as engine:
+                engine.execute(text(f'CREATE SCHEMA IF NOT EXISTS "{schema}"'))
+            try:
+                for mix in args.mix:
+                    defn = generate_datasource_defn(
+                        COLUMN_MIXES[mix], datasource_id=f'bench_{mix}'
+                    )
+                    export_path = os.path.join(directory, f'{mix}.zip')
+                    generate_export(export_path, defn, args.changes)
+                    refresh_hq_datasource(
+                        DOMAIN,
+                        defn['id'],
+                        defn['display_name'],
+                        export_path,
+                        defn,
+                        user_id,
+                    )
+                    print(
+                        f"{mix}: {args.changes:,} changes, "
+                        f"{len(defn['configured_indicators']) + 2} columns"
+                    )
+                    print(
+                        f"  {'apply, table':<18}{'mean ms':>10}{'p50 ms':>10}"
+                        f"{'p95 ms':>10}{'changes/s':>14}{'WAL kB':>10}"
+                    )
+                    runs = itertools.count()
+                    for apply in args.apply:
+                        results = {}
+                        for label, cached in [('uncached', False), ('cached', True)]:
+                            # Each run changes the rows again
+                            changes = read_changes(
+                                export_path,
+                                defn['id'],
+                                args.change_rate,
+                                seed=next(runs),
+                            )
+                            start_lsn = get_wal_lsn(database)
+                            with patch.dict(app.config, {
+                                'HQ_DATASET_CHANGE_APPLY_DIFF': apply == 'diff',
+                            }):
+                                results[label] = apply_changes(changes, cached)
+                            print_results(
+                                f'{apply}, {label}',
+                                results[label],
+                                get_wal_bytes(database, start_lsn),
+                            )
+                        print(
+                            f"  speed-up of the cached table: "
+                            f"{sum(results['uncached']) / sum(results['cached']):.1f}x"
+                        )
+            finally:
+                with database.get_sqla_engine_with_context() as engine:
+                    engine.execute(text(f'DROP SCHEMA IF EXISTS "{schema}" CASCADE'))
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,109 @@
+"""
+Compares parsing the date columns of a UCR export per cell with
+``parse_date()`` against parsing them a column at a time with
+``parse_date_columns()``.
+
+    $ python -m benchmarks.bench_date_parsing --rows 200000
+
+"""
+import argparse
+import io
+import random
+import time
+import warnings
+from datetime import datetime, timedelta
+
+import pandas
+
+from hq_superset.utils import parse_date, parse_date_columns
+
+DATE_COLUMNS = ['visit_date', 'lmp_date', 'dob']
+DATETIME_COLUMNS = ['inserted_at', 'modified_on']
+
+
+def generate_export(rows, blank_rate=0.05, bad_rate=0.001, seed=0):
+    """
+    Returns CSV text shaped like a UCR export, with date and datetime
+    columns formatted the way CommCare HQ formats them.
+    """
+    rand = random.Random(seed)
+    start = datetime(2020, 1, 1)
+
+    def value(is_datetime):
+        roll = rand.random()
+        if roll < blank_rate:
+            return ''
+        if roll < blank_rate + bad_rate:
+            return 'not a date'
+        dt = start + timedelta(seconds=rand.randrange(5 * 365 * 86400))
+        if is_datetime:
+            return dt.replace(microsecond=rand.randrange(1_000_000)).isoformat(' ')
+        return dt.date().isoformat()
+
+    columns = ['doc_id', 'name'] + DATE_COLUMNS + DATETIME_COLUMNS
+    lines = [','.join(columns)]
+    for i in range(rows):
+        lines.append(','.join(
+            [f'doc{i}', f'name {i % 100}']
+            + [value(False) for __ in DATE_COLUMNS]
+            + [value(True) for __ in DATETIME_COLUMNS]
+        ))
+    return '\n'.join(lines) + '\n'
+
+
+def read_per_cell(csv_text, date_columns):
+    with warnings.catch_warnings():
+        # ``date_parser`` is deprecated in pandas 2
+        warnings.simplefilter('ignore')
+        return pandas.concat(pandas.read_csv(
+            io.StringIO(csv_text),
+            chunksize=10000,
+            dtype={'doc_id': 'string', 'name': 'string'},
+            parse_dates=date_columns,
+            date_parser=parse_date,
+        ))
+
+
+def read_vectorized(csv_text, date_columns):
+    dtype = {'doc_id': 'string', 'name': 'string'}
+    dtype.update({column: 'string' for column in date_columns})
+    chunks = []
+    for df in pandas.read_csv(io.StringIO(csv_text), chunksize=10000, dtype=dtype):
+        parse_date_columns(df, date_columns)
+        chunks.append(df)
+    return pandas.concat(chunks)
+
+
+def best_of(repeat, func, *args):
+    times = []
+    for __ in range(repeat):
+        start = time.perf_counter()
+        result = func(*args)
+        times.append(time.perf_counter() - start)
+    return min(times), result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--rows', type=int, default=200_000)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    csv_text = generate_export(args.rows)
+    date_columns = DATE_COLUMNS + DATETIME_COLUMNS
+    per_cell_time, per_cell_df = best_of(args.repeat, read_per_cell, csv_text, date_columns)
+    vectorized_time, vectorized_df = best_of(args.repeat, read_vectorized, csv_text, date_columns)
+
+    print(f"{args.rows} rows, {len(date_columns)} date/datetime columns")
+    print(f"{'parser':<12}{'seconds':>10}{'rows/s':>14}  dtypes")
+    for name, seconds, df in (
+        ('per-cell', per_cell_time, per_cell_df),
+        ('vectorized', vectorized_time, vectorized_df),
+    ):
+        dtypes = sorted({str(df[c].dtype) for c in date_columns})
+        print(f"{name:<12}{seconds:>10.2f}{args.rows / seconds:>14,.0f}  {', '.join(dtypes)}")
+    print(f"speed-up: {per_cell_time / vectorized_time:.1f}x")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,388 @@
+"""
+Imports synthetic UCR exports with ``refresh_hq_datasource()``, and
+reports the time, throughput and peak RSS of each stage of the import.
+
+    $ python -m benchmarks.bench_import --rows 10000 100000 --mix typical arrays
+
+Compare loading with several threads (``HQ_IMPORT_LOADER_WORKERS``):
+
+    $ python -m benchmarks.bench_import --rows 1000000 --workers 1 4
+
+or parsing with pandas and with Arrow (``HQ_IMPORT_CSV_ENGINE``):
+
+    $ python -m benchmarks.bench_import --engine pandas pyarrow
+
+Stages are timed in the thread that reads the export, so with more
+than one worker, "load" is the time spent waiting for the workers.
+Loading in parallel only helps if PostgreSQL has cores to spare.
+
+Imports run against the HQ database of the Superset config given by
+``SUPERSET_CONFIG_PATH``, which defaults to the test config (a local
+PostgreSQL database). Peak RSS is sampled from /proc, so it is only
+reported on Linux.
+"""
+import argparse
+import functools
+import io
+import itertools
+import os
+import shutil
+import tempfile
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from unittest.mock import patch
+
+from benchmarks.synthetic import (
+    COLUMN_MIXES,
+    generate_datasource_defn,
+    generate_export,
+)
+
+STAGES = ['unzip', 'parse', 'cast', 'load', 'index', 'fetch_metadata', 'other']
+DOMAIN = 'bench'
+
+
+class StageProfiler:
+    """
+    Accumulates the wall time of named stages, and samples the peak
+    RSS of the process during each one.
+
+    Stages can be nested. Time spent in an inner stage is not counted
+    towards the outer stage.
+    """
+
+    def __init__(self, interval=0.01):
+        self.interval = interval
+        self.seconds = defaultdict(float)
+        self.peak_rss = defaultdict(int)
+        self._stack = []
+        self._started = None
+        self._sampling = None
+
+    @contextmanager
+    def stage(self, name):
+        now = time.perf_counter()
+        if self._stack:
+            self.seconds[self._stack[-1]] += now - self._started
+        self._stack.append(name)
+        self._started = now
+        try:
+            yield
+        finally:
+            now = time.perf_counter()
+            self.seconds[self._stack.pop()] += now - self._started
+            self._started = now
+
+    def wrap(self, name, func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with self.stage(name):
+                return func(*args, **kwargs)
+        return wrapper
+
+    @contextmanager
+    def sampling_rss(self):
+        self._sampling = threading.Event()
+        thread = threading.Thread(target=self._sample_rss, daemon=True)
+        thread.start()
+        try:
+            yield
+        finally:
+            self._sampling.set()
+            thread.join()
+
+    def _sample_rss(self):
+        while not self._sampling.wait(self.interval):
+            rss = get_rss()
+            try:
+                name = self._stack[-1]
+            except IndexError:
+                name = 'other'
+            self.peak_rss[name] = max(self.peak_rss[name], rss)
+
+
+class TimedFile(io.RawIOBase):
+    """
+    A readable file whose reads are attributed to a profiler stage.
+    """
+
+    def __init__(self, file, stage):
+        self._file = file
+        self._stage = stage
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        with self._stage():
+            data = self._file.read(len(buffer))
+        buffer[:len(data)] = data
+        return len(data)
+
+
+class TimedReader:
+    """
+    Wraps the iterator of DataFrames that ``read_export()`` returns, so
+    that reading each chunk is attributed to a profiler stage.
+    """
+
+    def __init__(self, reader, stage):
+        self._reader = reader
+        self._stage = stage
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        with self._stage():
+            return next(self._reader)
+
+
+def get_rss():
+    """
+    Returns the resident set size of this process in bytes, or 0 if
+    it is not available.
+    """
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return 0
+
+
+def create_app():
+    os.environ.setdefault(
+        'SUPERSET_CONFIG_PATH', 'hq_superset/tests/config_for_tests.py'
+    )
+    os.environ.setdefault(
+        'SUPERSET_HOME', tempfile.mkdtemp(prefix='bench_superset_')
+    )
+    from superset.app import create_app
+
+    return create_app()
+
+
+def create_user(app):
+    import superset
+
+    superset.db.create_all()
+    sm = app.appbuilder.sm
+    user = sm.find_user('bench')
+    if not user:
+        user = sm.add_user(
+            'bench', 'Bench', 'User', 'bench@example.com', sm.add_role('bench')
+        )
+    return user
+
+
+def run_import(datasource_defn, export_path, user_id):
+    """
+    Imports the export with ``refresh_hq_datasource()``, and returns
+    the profiler and the total wall time.
+    """
+    from superset.connectors.sqla.models import SqlaTable
+
+    import hq_superset.services
+    from hq_superset.loaders import DataFrameLoader, ParallelCopyLoader
+    from hq_superset.services import refresh_hq_datasource
+    from hq_superset.utils import get_datasource_file
+
+    profiler = StageProfiler()
+    services = hq_superset.services
+    read_export = services.read_export
+
+    @contextmanager
+    def timed_datasource_file(path):
+        with get_datasource_file(path) as f:
+            yield io.BufferedReader(
+                TimedFile(f, functools.partial(profiler.stage, 'unzip')),
+                buffer_size=1024 * 1024,
+            )
+
+    def timed_read_export(*args, **kwargs):
+        with profiler.stage('parse'):
+            reader = read_export(*args, **kwargs)
+        return TimedReader(reader, functools.partial(profiler.stage, 'parse'))
+
+    with (
+        patch.object(services, 'get_datasource_file', timed_datasource_file),
+        patch.object(services, 'read_export', timed_read_export),
+        patch.object(
+            services,
+            'parse_date_columns',
+            profiler.wrap('cast', services.parse_date_columns),
+        ),
+        patch.object(
+            services,
+            'convert_array_column',
+            profiler.wrap('cast', services.convert_array_column),
+        ),
+        patch.object(
+            DataFrameLoader,
+            'load',
+            profiler.wrap('load', DataFrameLoader.load),
+        ),
+        patch.object(
+            ParallelCopyLoader,
+            'load',
+            profiler.wrap('load', ParallelCopyLoader.load),
+        ),
+        patch.object(
+            ParallelCopyLoader,
+            'wait',
+            profiler.wrap('load', ParallelCopyLoader.wait),
+        ),
+        patch.object(
+            services,
+            'create_indexes',
+            profiler.wrap('index', services.create_indexes),
+        ),
+        patch.object(
+            SqlaTable,
+            'fetch_metadata',
+            profiler.wrap('fetch_metadata', SqlaTable.fetch_metadata),
+        ),
+        profiler.sampling_rss(),
+    ):
+        start = time.perf_counter()
+        refresh_hq_datasource(
+            DOMAIN,
+            datasource_defn['id'],
+            datasource_defn['display_name'],
+            export_path,
+            datasource_defn,
+            user_id,
+        )
+        wall_time = time.perf_counter() - start
+    profiler.seconds['other'] += wall_time - sum(profiler.seconds.values())
+    return profiler, wall_time
+
+
+def print_results(
+    mix,
+    rows,
+    column_count,
+    export_size,
+    engine,
+    workers,
+    profiler,
+    wall_time,
+):
+    print(
+        f"{mix}: {rows:,} rows, {column_count} columns, "
+        f"{export_size / 1_000_000:.1f} MB zipped, {engine} engine, "
+        f"{workers} loader worker(s)"
+    )
+    print(f"  {'stage':<16}{'seconds':>10}{'rows/s':>14}{'peak RSS MB':>14}")
+    for stage in STAGES:
+        seconds = profiler.seconds.get(stage, 0.0)
+        rows_per_second = f"{rows / seconds:,.0f}" if seconds else '-'
+        peak_rss = profiler.peak_rss.get(stage)
+        peak_rss = f"{peak_rss / 1_000_000:,.0f}" if peak_rss else '-'
+        print(f"  {stage:<16}{seconds:>10.2f}{rows_per_second:>14}{peak_rss:>14}")
+    peak_rss = max(profiler.peak_rss.values(), default=0)
+    print(
+        f"  {'total':<16}{wall_time:>10.2f}{rows / wall_time:>14,.0f}"
+        f"{peak_rss / 1_000_000:>14,.0f}"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--rows', type=int, nargs='+', default=[100_000])
+    parser.add_argument(
+        '--mix',
+        nargs='+',
+        choices=sorted(COLUMN_MIXES),
+        default=['typical'],
+        help='The mix of indicator data types of the datasource',
+    )
+    parser.add_argument('--array-density', type=float, default=0.7)
+    parser.add_argument('--date-density', type=float, default=0.9)
+    parser.add_argument(
+        '--workers',
+        type=int,
+        nargs='+',
+        default=[1],
+        help='Values of HQ_IMPORT_LOADER_WORKERS to compare',
+    )
+    parser.add_argument(
+        '--engine',
+        nargs='+',
+        choices=['pandas', 'pyarrow'],
+        default=['pandas'],
+        help='Values of HQ_IMPORT_CSV_ENGINE to compare',
+    )
+    args = parser.parse_args()
+
+    app = create_app()
+    directory = tempfile.mkdtemp(prefix='bench_import_')
+    try:
+        with app.app_context():
+            from sqlalchemy.sql import text
+
+            from hq_superset.utils import (
+                get_hq_database,
+                get_schema_name_for_domain,
+            )
+
+            user_id = create_user(app).id
+            database = get_hq_database()
+            schema = get_schema_name_for_domain(DOMAIN)
+            with database.get_sqla_engine_with_context() as engine:
+                engine.execute(text(f'CREATE SCHEMA IF NOT EXISTS "{schema}"'))
+            try:
+                for mix in args.mix:
+                    defn = generate_datasource_defn(
+                        COLUMN_MIXES[mix], datasource_id=f'bench_{mix}'
+                    )
+                    for rows in args.rows:
+                        export_path = os.path.join(directory, f'{mix}_{rows}.zip')
+                        generate_export(
+                            export_path,
+                            defn,
+                            rows,
+                            array_density=args.array_density,
+                            date_density=args.date_density,
+                        )
+                        wall_times = []
+                        for engine, workers in itertools.product(
+                            args.engine, args.workers
+                        ):
+                            with patch.dict(app.config, {
+                                'HQ_IMPORT_CSV_ENGINE': engine,
+                                'HQ_IMPORT_LOADER_WORKERS': workers,
+                            }):
+                                profiler, wall_time = run_import(
+                                    defn, export_path, user_id
+                                )
+                            wall_times.append(wall_time)
+                            print_results(
+                                mix,
+                                rows,
+                                len(defn['configured_indicators']) + 2,
+                                os.path.getsize(export_path),
+                                engine,
+                                workers,
+                                profiler,
+                                wall_time,
+                            )
+                        if len(wall_times) > 1:
+                            print(
+                                f"  speed-up of the last run vs the first: "
+                                f"{wall_times[0] / wall_times[-1]:.1f}x"
+                            )
+            finally:
+                with database.get_sqla_engine_with_context() as engine:
+                    engine.execute(text(f'DROP SCHEMA IF EXISTS "{schema}" CASCADE'))
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
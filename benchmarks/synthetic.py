@@ -0,0 +1,137 @@
+"""
+Generates synthetic UCR datasource definitions and zipped CSV exports
+for benchmarks.
+"""
+import csv
+import io
+import random
+from datetime import datetime, timedelta
+from zipfile import ZIP_DEFLATED, ZipFile
+
+# The number of indicators of each data type in a datasource
+COLUMN_MIXES = {
+    'narrow': {'string': 2, 'integer': 1, 'date': 1},
+    'typical': {
+        'string': 10,
+        'integer': 5,
+        'decimal': 3,
+        'date': 4,
+        'datetime': 2,
+        'array': 2,
+    },
+    'wide': {
+        'string': 60,
+        'integer': 20,
+        'decimal': 10,
+        'date': 15,
+        'datetime': 5,
+        'array': 10,
+    },
+    'arrays': {'string': 4, 'integer': 1, 'date': 1, 'array': 12},
+    'dates': {'string': 4, 'integer': 1, 'date': 12, 'datetime': 6},
+}
+
+START = datetime(2020, 1, 1)
+FIVE_YEARS = 5 * 365 * 86400  # seconds
+
+
+def generate_datasource_defn(column_mix, datasource_id='bench_ucr'):
+    """
+    Returns a datasource definition, shaped like the one the CommCare
+    HQ API returns, with the indicators given by ``column_mix``.
+    """
+    indicators = []
+    for datatype, count in column_mix.items():
+        for i in range(count):
+            column_id = f'{datatype}_{i}'
+            indicators.append({
+                'column_id': column_id,
+                'datatype': datatype,
+                'display_name': column_id,
+                'type': 'expression',
+            })
+    return {
+        'id': datasource_id,
+        'display_name': f'Benchmark {datasource_id}',
+        'configured_filter': {},
+        'configured_indicators': indicators,
+    }
+
+
+def generate_export(
+    path,
+    datasource_defn,
+    rows,
+    blank_rate=0.05,
+    array_density=0.7,
+    date_density=0.9,
+    vocabulary_size=10,
+    seed=0,
+):
+    """
+    Writes a zipped CSV export of ``rows`` rows of ``datasource_defn``
+    to ``path``, formatted the way CommCare HQ formats UCR exports.
+
+    ``array_density`` and ``date_density`` are the proportions of
+    array and date values that are not blank. Other values are blank
+    at ``blank_rate``.
+    """
+    rand = random.Random(seed)
+    vocabulary = [f'choice_{i}' for i in range(vocabulary_size)]
+
+    def string():
+        return f'text {rand.randrange(1000)}'
+
+    def integer():
+        return str(rand.randrange(-1000, 100_000))
+
+    def decimal():
+        return f'{rand.uniform(0, 1000):.3f}'
+
+    def date():
+        return (
+            START + timedelta(seconds=rand.randrange(FIVE_YEARS))
+        ).date().isoformat()
+
+    def datetime_():
+        dt = START + timedelta(
+            seconds=rand.randrange(FIVE_YEARS),
+            microseconds=rand.randrange(1_000_000),
+        )
+        return dt.isoformat(' ')
+
+    def array():
+        length = rand.randrange(1, 5)
+        # Multi-select answers are in the order of the choices
+        return repr(sorted(rand.sample(vocabulary, length)))
+
+    generators = {
+        'string': (string, 1 - blank_rate),
+        'integer': (integer, 1 - blank_rate),
+        'decimal': (decimal, 1 - blank_rate),
+        'date': (date, date_density),
+        'datetime': (datetime_, date_density),
+        'array': (array, array_density),
+    }
+    columns = [
+        (ind['column_id'], *generators[ind['datatype']])
+        for ind in datasource_defn['configured_indicators']
+    ]
+
+    with (
+        ZipFile(path, 'w', ZIP_DEFLATED) as zipfile,
+        zipfile.open(f"{datasource_defn['id']}.csv", 'w') as raw,
+        io.TextIOWrapper(raw, encoding='utf-8', newline='') as text,
+    ):
+        writer = csv.writer(text)
+        writer.writerow(
+            ['doc_id', 'inserted_at'] + [column_id for column_id, *__ in columns]
+        )
+        for i in range(rows):
+            writer.writerow(
+                [f'doc{i:08d}', datetime_()]
+                + [
+                    generate() if rand.random() < density else ''
+                    for __, generate, density in columns
+                ]
+            )
@@ -13,7 +13,7 @@ from superset.views.base import (
 
 from hq_superset.models import DataSetChange
 from hq_superset.oauth2_server import authorization, require_oauth
-from hq_superset.tasks import process_dataset_change
+from hq_superset.tasks import queue_dataset_change, queue_dataset_changes
 
 
 class OAuth(BaseApi):
@@ -42,6 +42,11 @@ class DataSetChangeAPI(BaseApi):
     """
 
     MAX_REQUEST_LENGTH = 10 * 1024 * 1024  # reject JSON requests > 10MB
+    # Bulk requests are read one line at a time. Each line is a change,
+    # which is limited to MAX_REQUEST_LENGTH.
+    MAX_BULK_REQUEST_LENGTH = 200 * 1024 * 1024  # 200MB
+    # Valid changes of a bulk request are queued this many at a time
+    BULK_QUEUE_SIZE = 1000
 
     def __init__(self):
         self.route_base = '/commcarehq_dataset'
@@ -75,8 +80,100 @@ class DataSetChangeAPI(BaseApi):
                 status=HTTPStatus.BAD_REQUEST.value,
             )
 
-        process_dataset_change.delay(request_json)
+        queue_dataset_change(request_json)
         return json_success(
             'Dataset change accepted',
             status=HTTPStatus.ACCEPTED.value,
         )
+
+    @expose('/changes/', methods=('POST',))
+    @handle_api_exception
+    @require_oauth()
+    def post_dataset_changes(self) -> FlaskResponse:
+        """
+        Accepts newline-delimited JSON, with one change on each line,
+        like the request body of ``post_dataset_change()``.
+
+        Each line is validated on its own. Valid changes are queued,
+        and the response gives the result of each non-empty line.
+        """
+        if request.content_length is None:
+            return json_error_response(
+                HTTPStatus.LENGTH_REQUIRED.description,
+                status=HTTPStatus.LENGTH_REQUIRED.value,
+            )
+        if request.content_length > self.MAX_BULK_REQUEST_LENGTH:
+            return json_error_response(
+                HTTPStatus.REQUEST_ENTITY_TOO_LARGE.description,
+                status=HTTPStatus.REQUEST_ENTITY_TOO_LARGE.value,
+            )
+
+        results = []
+        accepted = []
+        accepted_count = 0
+        for line_number, line in enumerate(
+            read_lines(request.stream, self.MAX_REQUEST_LENGTH), start=1
+        ):
+            if line is None:
+                error = HTTPStatus.REQUEST_ENTITY_TOO_LARGE.description
+            elif not line.strip():
+                continue
+            else:
+                request_json, error = parse_change(line)
+            if error:
+                results.append({'line': line_number, 'error': error})
+                continue
+            results.append({'line': line_number, 'status': 'accepted'})
+            accepted.append(request_json)
+            if len(accepted) == self.BULK_QUEUE_SIZE:
+                queue_dataset_changes(accepted)
+                accepted_count += len(accepted)
+                accepted = []
+        if accepted:
+            queue_dataset_changes(accepted)
+            accepted_count += len(accepted)
+
+        status = HTTPStatus.ACCEPTED if accepted_count else HTTPStatus.BAD_REQUEST
+        return json_success(
+            json.dumps({
+                'accepted': accepted_count,
+                'rejected': len(results) - accepted_count,
+                'results': results,
+            }),
+            status=status.value,
+        )
+
+
+def parse_change(line):
+    """
+    Parses a line of a bulk request. Returns the change, and why it is
+    not valid, or None if it is.
+    """
+    try:
+        request_json = json.loads(line)
+    except ValueError:  # Includes JSONDecodeError and UnicodeDecodeError
+        return None, 'Invalid JSON syntax'
+    try:
+        # ensure change request is parsable
+        DataSetChange(**request_json)
+    except TypeError:
+        return None, 'Could not parse change request'
+    if not isinstance(request_json['data_source_id'], str):
+        return None, 'Could not parse change request'
+    return request_json, None
+
+
+def read_lines(stream, max_line_length):
+    """
+    Yields the lines of ``stream`` as bytes, without reading more than
+    ``max_line_length`` bytes of a line into memory. Lines that are
+    longer are yielded as None.
+    """
+    while line := stream.readline(max_line_length + 1):
+        if len(line) <= max_line_length or line.endswith(b'\n'):
+            yield line
+            continue
+        # Skip the rest of the line
+        while (rest := stream.readline(max_line_length)) and not rest.endswith(b'\n'):
+            pass
+        yield None
@@ -0,0 +1,202 @@
+"""
+Casts the rows of dataset changes from CommCare HQ to the types of the
+columns of their table.
+
+Changes arrive as JSON, so dates and datetimes are strings, numbers
+may be strings, and array values may be lists or the strings that UCR
+exports use. A ``RowCaster`` chooses a conversion for each column of a
+table once, and is cached with the table (see
+``hq_superset.table_cache``), so casting a row only looks up and calls
+the conversion of each of its values.
+
+Values that cannot be cast raise ``ValueError``.
+"""
+from datetime import date
+
+from sqlalchemy import types
+
+from hq_superset.utils import convert_to_array, js_to_py_datetime
+
+
+class RowCaster:
+    """
+    Casts rows to the types of the columns of ``table``.
+
+    ``column_types`` are the types that columns were narrowed to (see
+    ``hq_superset.profiling``). Values of boolean columns must be one
+    of the two spellings that the column was narrowed from.
+    """
+
+    def __init__(self, table, column_types=None):
+        self.column_names = [column.name for column in table.columns]
+        self._casts = {
+            column.name: get_cast(
+                column.type, (column_types or {}).get(column.name)
+            )
+            for column in table.columns
+        }
+
+    def cast_row(self, row):
+        casts = self._casts
+        try:
+            return {column: casts[column](value) for column, value in row.items()}
+        except KeyError as err:
+            raise KeyError(f"{err.args[0]!r} is not a column of the table")
+
+    def cast_rows(self, data):
+        """
+        Returns ``data`` as a list of rows for an ``executemany()``.
+        """
+        return [self.cast_row(row) for row in data]
+
+    def cast_columns(self, data):
+        """
+        Returns ``data`` as a dict of the values of each column, in the
+        order of the columns of the table. Columns that are missing from
+        a row are None.
+        """
+        present = set().union(*data)
+        columns = {}
+        for column in self.column_names:
+            if column in present:
+                cast = self._casts[column]
+                columns[column] = [cast(row.get(column)) for row in data]
+        unknown = present.difference(self._casts)
+        if unknown:
+            raise KeyError(f"{sorted(unknown)} are not columns of the table")
+        return columns
+
+
+def get_cast(sql_type, column_type=None):
+    """
+    Returns a function that casts values to ``sql_type``, or that
+    returns them unchanged if the driver can send them as they are.
+    """
+    if column_type and column_type['type'] == 'boolean':
+        return _boolean_cast(column_type['true'], column_type['false'])
+    if isinstance(sql_type, types.ARRAY):
+        return cast_array
+    if isinstance(sql_type, types.Boolean):
+        return _keep
+    if isinstance(sql_type, types.Integer):
+        return cast_integer
+    if isinstance(sql_type, types.Float):
+        # Includes DOUBLE PRECISION
+        return cast_float
+    if isinstance(sql_type, types.DateTime):
+        if sql_type.timezone:
+            return cast_datetime_tz
+        return cast_datetime
+    if isinstance(sql_type, types.Date):
+        return cast_date
+    return _keep
+
+
+def _keep(value):
+    return value
+
+
+def _boolean_cast(true, false):
+    values = {true: True, false: False}
+
+    def cast_boolean(value):
+        if value is None or isinstance(value, bool):
+            return value
+        try:
+            return values[value]
+        except (KeyError, TypeError):
+            raise ValueError(f"{value!r} is not one of {true!r} or {false!r}")
+
+    return cast_boolean
+
+
+def cast_integer(value):
+    """
+    >>> cast_integer('12')
+    12
+    >>> cast_integer(3.0)
+    3
+    >>> cast_integer('') is None
+    True
+    >>> cast_integer(3.5)
+    Traceback (most recent call last):
+    ...
+    ValueError: 3.5 is not an integer
+    """
+    if value is None:
+        return None
+    if isinstance(value, int):
+        # Booleans are ints, but PostgreSQL does not cast them
+        return int(value)
+    if isinstance(value, str):
+        if not value.strip():
+            return None
+        try:
+            return int(value)
+        except ValueError:
+            value = float(value)
+    if isinstance(value, float) and value.is_integer():
+        return int(value)
+    raise ValueError(f"{value!r} is not an integer")
+
+
+def cast_float(value):
+    """
+    >>> cast_float('1.5')
+    1.5
+    >>> cast_float(2)
+    2.0
+    """
+    if value is None:
+        return None
+    if isinstance(value, str) and not value.strip():
+        return None
+    return float(value)
+
+
+def cast_date(value):
+    """
+    >>> cast_date('2024-02-24')
+    datetime.date(2024, 2, 24)
+    >>> cast_date('2024-02-24T14:01:25.397469Z')
+    datetime.date(2024, 2, 24)
+    """
+    if value is None or value == '':
+        return None
+    if isinstance(value, date):
+        # Includes datetimes
+        return value if type(value) is date else value.date()
+    if len(value) > 10:
+        return js_to_py_datetime(value, preserve_tz=False).date()
+    return date.fromisoformat(value)
+
+
+def cast_datetime(value):
+    if value is None or value == '':
+        return None
+    return js_to_py_datetime(value, preserve_tz=False)
+
+
+def cast_datetime_tz(value):
+    if value is None or value == '':
+        return None
+    return js_to_py_datetime(value)
+
+
+def cast_array(value):
+    """
+    Missing values are empty lists, as they are when the datasource
+    is imported.
+
+    >>> cast_array("['a', 'b']")
+    ['a', 'b']
+    >>> cast_array(None)
+    []
+    """
+    if value is None:
+        return []
+    if isinstance(value, list):
+        return value
+    if isinstance(value, tuple):
+        return list(value)
+    return convert_to_array(value)
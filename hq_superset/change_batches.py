@@ -0,0 +1,210 @@
+"""
+Batches changes to datasets from CommCare HQ, so that the changes to
+a datasource that arrive close together are applied in one
+transaction.
+
+Changes are pushed onto a Redis list for their datasource. The first
+change pushed onto an empty list schedules the list to be drained
+after ``HQ_DATASET_CHANGE_BATCH_SECONDS``, and a list that reaches
+``HQ_DATASET_CHANGE_BATCH_SIZE`` changes is drained straight away.
+Changes are taken and applied while holding a lock for the
+datasource, so batches are applied in the order they arrived.
+
+A batch is moved onto a processing list for the datasource, and only
+removed from it after it has been applied. If a worker dies while it
+applies a batch, the batch is applied again by the next worker that
+drains the list. Lists that are left behind, because the task that
+was scheduled to drain them was lost, are drained periodically.
+"""
+import json
+import logging
+from functools import lru_cache
+
+import redis
+from datadog import statsd
+from flask import current_app
+
+from hq_superset.exceptions import TableMissing
+from hq_superset.metrics import get_tags
+from hq_superset.models import DataSetChange
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BATCH_SIZE = 500
+QUEUE_KEY_PREFIX = 'hq_dataset_changes'
+# Applying a batch must take less time than this, or another worker
+# can take the lock and apply the next batch before it
+LOCK_TIMEOUT_SECONDS = 5 * 60
+LOCK_WAIT_SECONDS = 30
+
+
+def get_batch_seconds():
+    """
+    Returns how many seconds to wait for changes to a datasource to
+    batch them. If it is 0, changes are not batched.
+    """
+    return current_app.config.get("HQ_DATASET_CHANGE_BATCH_SECONDS") or 0
+
+
+def get_batch_size():
+    return (
+        current_app.config.get("HQ_DATASET_CHANGE_BATCH_SIZE")
+        or DEFAULT_BATCH_SIZE
+    )
+
+
+def get_redis_client():
+    return _get_redis_client(current_app.config['CACHE_CONFIG']['CACHE_REDIS_URL'])
+
+
+@lru_cache
+def _get_redis_client(url):
+    # Each client has its own connection pool
+    return redis.Redis.from_url(url)
+
+
+def get_queue_key(data_source_id):
+    return f"{QUEUE_KEY_PREFIX}:{data_source_id}"
+
+
+def get_processing_key(data_source_id):
+    return f"{get_queue_key(data_source_id)}:processing"
+
+
+def push_dataset_change(request_json):
+    """
+    Pushes a change onto the list for its datasource, and returns the
+    length of the list.
+    """
+    return push_dataset_changes(request_json['data_source_id'], [request_json])
+
+
+def push_dataset_changes(data_source_id, request_jsons):
+    """
+    Pushes changes to the same datasource onto its list in one call,
+    and returns the length of the list.
+    """
+    return get_redis_client().rpush(
+        get_queue_key(data_source_id),
+        *(json.dumps(request_json) for request_json in request_jsons),
+    )
+
+
+def take_dataset_changes(data_source_id, count):
+    """
+    Moves up to ``count`` changes from the start of the list for the
+    datasource onto its processing list, and returns them. They stay
+    there until ``ack_dataset_changes()`` is called.
+
+    If the processing list is not empty, a worker died before it
+    finished applying them, and they are returned again instead.
+    """
+    client = get_redis_client()
+    processing_key = get_processing_key(data_source_id)
+    values = client.lrange(processing_key, 0, -1)
+    if not values:
+        with client.pipeline() as pipeline:
+            for __ in range(count):
+                pipeline.lmove(
+                    get_queue_key(data_source_id),
+                    processing_key,
+                    'LEFT',
+                    'RIGHT',
+                )
+            values = [value for value in pipeline.execute() if value]
+    return [DataSetChange(**json.loads(value)) for value in values]
+
+
+def ack_dataset_changes(data_source_id):
+    """
+    Removes the changes that have been applied from the processing list
+    for the datasource.
+    """
+    get_redis_client().delete(get_processing_key(data_source_id))
+
+
+def get_queued_data_source_ids():
+    """
+    Returns the IDs of the datasources that have changes waiting to be
+    applied, or that a worker did not finish applying.
+    """
+    data_source_ids = set()
+    for key in get_redis_client().scan_iter(match=f"{QUEUE_KEY_PREFIX}:*"):
+        __, data_source_id, *suffix = key.decode('utf-8').split(':')
+        if suffix != ['lock']:
+            data_source_ids.add(data_source_id)
+    return sorted(data_source_ids)
+
+
+def apply_dataset_changes(data_source_id):
+    """
+    Applies the changes to the datasource in batches until its list is
+    empty. Returns False if another worker is applying its changes.
+    """
+    client = get_redis_client()
+    lock = client.lock(
+        f"{get_queue_key(data_source_id)}:lock",
+        timeout=LOCK_TIMEOUT_SECONDS,
+        blocking_timeout=LOCK_WAIT_SECONDS,
+    )
+    if not lock.acquire():
+        return False
+    try:
+        while changes := take_dataset_changes(data_source_id, get_batch_size()):
+            apply_batch(changes)
+            # Renews the lock for the next batch, so that it does not
+            # expire while the list is drained
+            lock.reacquire()
+            ack_dataset_changes(data_source_id)
+    except redis.exceptions.LockNotOwnedError:
+        # The batch took longer than the lock timeout, and another
+        # worker may have taken the lock, and the batch with it. The
+        # batch stays on the processing list. That worker, or the next
+        # drain, applies it again and drains the rest.
+        logger.error(
+            "The lock on the changes to %s expired while a batch was applied",
+            data_source_id,
+        )
+    finally:
+        _release_lock(lock)
+    return True
+
+
+def _release_lock(lock):
+    # Only releases the lock if it is still held by this worker
+    try:
+        lock.release()
+    except redis.exceptions.LockNotOwnedError:
+        pass
+
+
+def apply_batch(changes):
+    data_source_id = changes[0].data_source_id
+    statsd.histogram(
+        'cca.dataset_change.batch_size',
+        len(changes),
+        tags=get_tags({"datasource": data_source_id}),
+    )
+    try:
+        DataSetChange.combine(changes).update_dataset()
+    except TableMissing:
+        pass
+    except Exception:
+        # Apply the changes one at a time, so that one change that
+        # cannot be applied does not lose the others
+        logger.exception(
+            "Failed to apply a batch of %s changes to %s",
+            len(changes),
+            data_source_id,
+        )
+        for change in changes:
+            try:
+                change.update_dataset()
+            except TableMissing:
+                pass
+            except Exception:
+                logger.exception(
+                    "Failed to apply the change to %s of %s",
+                    change.doc_id,
+                    data_source_id,
+                )
@@ -0,0 +1,136 @@
+"""
+Records the changes to a datasource from CommCare HQ while it is being
+imported, and replays them onto the table that the import writes.
+
+The export is taken when its download starts, so it does not include
+changes that arrive after that. They are applied to the live table,
+which a full import replaces with its staging table, and an
+incremental import overwrites with the rows it exported. Recording
+starts before the export is downloaded. Changes are recorded when they
+are queued, before they are applied. The recorded changes are replayed
+in the transaction that swaps in the staging table, or merges it.
+Writes to the live table wait for that transaction, and are applied to
+the new table after it commits.
+"""
+import json
+import logging
+
+import sqlalchemy
+from datadog import statsd
+
+from hq_superset.casters import RowCaster
+from hq_superset.change_batches import get_redis_client
+from hq_superset.metrics import get_tags
+from hq_superset.models import DataSetChange
+
+logger = logging.getLogger(__name__)
+
+KEY_PREFIX = 'hq_dataset_changes_during_import'
+# Longer than the longest import, including the time its task waits
+# in the queue. A recording that is not stopped expires.
+RECORDING_TIMEOUT_SECONDS = 12 * 60 * 60
+
+
+def get_recording_key(data_source_id):
+    return f"{KEY_PREFIX}:{data_source_id}:recording"
+
+
+def get_log_key(data_source_id):
+    return f"{KEY_PREFIX}:{data_source_id}"
+
+
+def start_recording_changes(data_source_id, restart=True):
+    """
+    Starts recording the changes to the datasource. If ``restart`` is
+    False, a recording that has already started keeps its changes.
+    """
+    client = get_redis_client()
+    started = client.set(
+        get_recording_key(data_source_id),
+        1,
+        ex=RECORDING_TIMEOUT_SECONDS,
+        nx=not restart,
+    )
+    if started:
+        client.delete(get_log_key(data_source_id))
+
+
+def stop_recording_changes(data_source_id):
+    get_redis_client().delete(
+        get_recording_key(data_source_id),
+        get_log_key(data_source_id),
+    )
+
+
+def record_dataset_changes(data_source_id, request_jsons):
+    """
+    Records changes to the datasource, if it is being imported.
+    """
+    client = get_redis_client()
+    if not client.exists(get_recording_key(data_source_id)):
+        return
+    key = get_log_key(data_source_id)
+    with client.pipeline() as pipeline:
+        pipeline.rpush(
+            key,
+            *(json.dumps(request_json) for request_json in request_jsons),
+        )
+        pipeline.expire(key, RECORDING_TIMEOUT_SECONDS)
+        pipeline.execute()
+
+
+def take_recorded_changes(data_source_id):
+    """
+    Removes and returns the changes recorded so far. Recording
+    continues.
+    """
+    key = get_log_key(data_source_id)
+    with get_redis_client().pipeline() as pipeline:
+        pipeline.lrange(key, 0, -1)
+        pipeline.delete(key)
+        values, __ = pipeline.execute()
+    return [DataSetChange(**json.loads(value)) for value in values]
+
+
+def replay_recorded_changes(connection, data_source_id, table, column_types=None):
+    """
+    Applies the changes recorded so far to ``table`` (a
+    ``superset.sql_parse.Table``), in the transaction of
+    ``connection``. Changes that cannot be applied are logged and
+    skipped, so that they do not fail the import.
+    """
+    changes = take_recorded_changes(data_source_id)
+    if not changes:
+        return
+    sqla_table = sqlalchemy.Table(
+        table.table,
+        sqlalchemy.MetaData(),
+        schema=table.schema,
+        autoload_with=connection,
+    )
+    caster = RowCaster(sqla_table, column_types)
+    statsd.increment(
+        'cca.dataset_change.replayed',
+        len(changes),
+        tags=get_tags({"datasource": data_source_id}),
+    )
+    try:
+        with connection.begin_nested():
+            DataSetChange.combine(changes).write_rows(
+                connection, sqla_table, caster
+            )
+        return
+    except Exception:
+        logger.exception(
+            "Failed to replay %s changes to %s", len(changes), data_source_id
+        )
+    for change in changes:
+        try:
+            with connection.begin_nested():
+                change.write_rows(connection, sqla_table, caster)
+        except Exception:
+            logger.exception(
+                "Failed to replay the change to %s of %s",
+                change.doc_id,
+                data_source_id,
+            )
@@ -44,6 +44,9 @@ READ_ONLY_MENU_PERMISSIONS = {
 }
 
 DOMAIN_PREFIX = "hqdomain_"
+
+# The key in ``SqlaTable.extra`` under which import metadata is stored
+IMPORT_METADATA_KEY = 'hq_import'
 SESSION_USER_DOMAINS_KEY = "user_hq_domains"
 SESSION_OAUTH_RESPONSE_KEY = "oauth_response"
 SESSION_DOMAIN_ROLE_LAST_SYNCED_AT = "domain_role_last_synced_at"
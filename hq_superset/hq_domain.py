@@ -89,6 +89,7 @@ DOMAIN_EXCLUDED_VIEWS = [
     'CurrentUserRestApi.get_me',
     'Superset.log',
     'DataSetChangeAPI.post_dataset_change',
+    'DataSetChangeAPI.post_dataset_changes',
     'OAuth.issue_access_token',
     'SelectDomainView.list',
     'SelectDomainView.select',
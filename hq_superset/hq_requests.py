@@ -1,9 +1,24 @@
+import functools
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from urllib.parse import urljoin
 
 import superset
+from datadog import statsd
+from flask import copy_current_request_context, current_app, has_request_context
 
+from hq_superset.metrics import get_tags
 from hq_superset.oauth import get_valid_cchq_oauth_token
 
+logger = logging.getLogger(__name__)
+
+DEFAULT_HQ_REQUEST_WORKERS = 4
+
+_executor = None
+_executor_lock = threading.Lock()
+
 
 class HQRequest:
 
@@ -26,8 +41,116 @@ class HQRequest:
     def absolute_url(self):
         return urljoin(self.api_base_url, self.url)
 
-    def get(self):
-        return self.commcare_provider.get(self.url, token=self.oauth_token)
+    def get(self, **kwargs):
+        return self.commcare_provider.get(
+            self.url,
+            token=self.oauth_token,
+            **kwargs,
+        )
 
     def post(self, data):
         return self.commcare_provider.post(self.url, data=data, token=self.oauth_token)
+
+
+class HQCallGroup:
+    """
+    Makes calls to CommCare HQ concurrently, in a thread pool that is
+    shared by all requests, and reports how much latency that saves
+    compared with making the calls one after another.
+
+    Calls run in a copy of the current request context, so they use
+    the user's OAuth token.
+    """
+
+    def __init__(self, tag_values: dict[str, str]):
+        self.tag_values = tag_values
+        self.seconds = {}
+        self._started = time.monotonic()
+        if has_request_context():
+            # Refresh an expired token once, instead of in each thread
+            get_valid_cchq_oauth_token()
+
+    def submit(self, name, func, *args, **kwargs):
+        """
+        Calls ``func`` in the thread pool, and returns its ``Future``.
+        """
+        return get_hq_executor().submit(
+            self._timed(name, _with_current_context(func)), *args, **kwargs
+        )
+
+    def call(self, name, func, *args, **kwargs):
+        """
+        Calls ``func`` in the current thread, while submitted calls run.
+        """
+        return self._timed(name, func)(*args, **kwargs)
+
+    def _timed(self, name, func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            started = time.monotonic()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self.seconds[name] = time.monotonic() - started
+        return wrapper
+
+    def report(self):
+        """
+        Reports the seconds that each call took, and the seconds saved
+        by not making them one after another. Call this once the
+        results of all the calls have been used.
+        """
+        wall_seconds = time.monotonic() - self._started
+        # Calls that have not finished, after an error, are left out
+        call_seconds = dict(self.seconds)
+        saved_seconds = max(sum(call_seconds.values()) - wall_seconds, 0.0)
+        for name, seconds in call_seconds.items():
+            statsd.histogram(
+                'cca.hq_request.seconds',
+                seconds,
+                tags=get_tags({**self.tag_values, "call": name}),
+            )
+        statsd.histogram(
+            'cca.hq_request.saved_seconds',
+            saved_seconds,
+            tags=get_tags(dict(self.tag_values)),
+        )
+        logger.info(
+            "HQ calls %s took %.2fs, saving %.2fs: %s",
+            self.tag_values,
+            wall_seconds,
+            saved_seconds,
+            ", ".join(f"{name} {s:.2f}s" for name, s in call_seconds.items()),
+        )
+
+
+def get_hq_executor():
+    """
+    Returns the thread pool for calls to CommCare HQ. Its size is
+    ``HQ_REQUEST_WORKERS``, so that busy web workers do not open more
+    connections to HQ than that each.
+    """
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(
+                max_workers=(
+                    current_app.config.get("HQ_REQUEST_WORKERS")
+                    or DEFAULT_HQ_REQUEST_WORKERS
+                ),
+                thread_name_prefix='hq_request',
+            )
+    return _executor
+
+
+def _with_current_context(func):
+    if has_request_context():
+        return copy_current_request_context(func)
+
+    app = current_app._get_current_object()
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        with app.app_context():
+            return func(*args, **kwargs)
+    return wrapper
@@ -1,6 +1,7 @@
 """
 Functions that return URLs on CommCare HQ
 """
+from urllib.parse import urlencode
 
 
 def datasource_details(domain, datasource_id):
@@ -11,10 +12,14 @@ def datasource_list(domain):
     return f"a/{domain}/api/v0.5/ucr_data_source/"
 
 
-def datasource_export(domain, datasource_id):
+def datasource_export(domain, datasource_id, inserted_after=None):
+    params = {'format': 'csv'}
+    if inserted_after:
+        # Only export rows inserted (or updated) after the given time
+        params['inserted_at-start'] = inserted_after.isoformat()
     return (
         f"a/{domain}/configurable_reports/data_sources/export/{datasource_id}/"
-        "?format=csv"
+        f"?{urlencode(params)}"
     )
 
 
@@ -0,0 +1,118 @@
+"""
+Estimates how long importing an export will take, to decide whether
+to import it in the web request or in the background.
+
+The estimate is the number of cells in the export (rows times columns)
+divided by the rate at which past imports loaded cells. The number of
+rows is estimated from the uncompressed size of the CSV file, which is
+stored in the zip file's central directory, and the size of the rows
+at the start of the file. Snapshots store their number of rows.
+"""
+import logging
+from collections import namedtuple
+from zipfile import ZipFile
+
+from flask import current_app
+from pyarrow import parquet
+from superset.extensions import cache_manager
+
+from hq_superset.snapshots import is_snapshot_file
+from hq_superset.utils import get_column_dtypes
+
+logger = logging.getLogger(__name__)
+
+THROUGHPUT_CACHE_KEY = 'hq_import_cells_per_second'
+# Used until an import has been recorded
+DEFAULT_CELLS_PER_SECOND = 500_000
+DEFAULT_SYNC_IMPORT_BUDGET_SECONDS = 20
+# The weight of the latest import in the moving average of throughput
+THROUGHPUT_WEIGHT = 0.2
+# Smaller imports are dominated by fixed costs, like creating indexes
+# and updating metadata, so they would underestimate throughput
+MIN_ROWS_FOR_THROUGHPUT = 10_000
+SAMPLE_BYTES = 64 * 1024
+
+ImportCost = namedtuple('ImportCost', ['rows', 'columns', 'seconds'])
+
+
+def estimate_import_cost(path, datasource_defn):
+    """
+    Returns the ``ImportCost`` of importing the export, or the copy of
+    a snapshot, at ``path``.
+    """
+    rows = estimate_row_count(path)
+    columns = get_column_count(datasource_defn)
+    return ImportCost(rows, columns, rows * columns / get_cells_per_second())
+
+
+def get_sync_import_budget():
+    """
+    Returns the most seconds that an import may be expected to take to
+    be run in the web request.
+    """
+    budget = current_app.config.get("HQ_IMPORT_SYNC_BUDGET_SECONDS")
+    if budget is None:
+        return DEFAULT_SYNC_IMPORT_BUDGET_SECONDS
+    return budget
+
+
+def get_column_count(datasource_defn):
+    column_dtypes, date_columns, array_columns = get_column_dtypes(
+        datasource_defn
+    )
+    return len(column_dtypes) + len(date_columns) + len(array_columns)
+
+
+def estimate_row_count(path):
+    if is_snapshot_file(path):
+        return parquet.read_metadata(path).num_rows
+    with ZipFile(path) as zipfile:
+        info = zipfile.infolist()[0]
+        with zipfile.open(info) as csv_file:
+            sample = csv_file.read(SAMPLE_BYTES)
+    return estimate_rows(info.file_size, sample)
+
+
+def estimate_rows(total_bytes, sample):
+    """
+    Estimates the number of rows in a CSV file of ``total_bytes``,
+    from ``sample``, its first bytes, which start with a header.
+
+    >>> estimate_rows(23, b'id,n\\na1,10\\na2,20\\na3,30\\n')
+    3
+    >>> estimate_rows(5_005, b'id,n\\na1,10\\na2,20\\na3,')
+    833
+
+    """
+    __, __, rows = sample.partition(b'\n')
+    if len(sample) >= total_bytes:
+        # The sample is the whole file
+        return len(rows.splitlines())
+    line_count = rows.count(b'\n')
+    if not line_count:
+        # The sample does not hold a whole row
+        return 1
+    bytes_per_row = (rows.rindex(b'\n') + 1) / line_count
+    return round((total_bytes - (len(sample) - len(rows))) / bytes_per_row)
+
+
+def get_cells_per_second():
+    return cache_manager.cache.get(THROUGHPUT_CACHE_KEY) or DEFAULT_CELLS_PER_SECOND
+
+
+def record_import_throughput(rows, columns, seconds):
+    """
+    Adds an import to the moving average of the rate at which imports
+    load cells.
+    """
+    if rows < MIN_ROWS_FOR_THROUGHPUT or seconds <= 0:
+        return
+    cells_per_second = rows * columns / seconds
+    previous = cache_manager.cache.get(THROUGHPUT_CACHE_KEY)
+    if previous:
+        cells_per_second = (
+            previous + THROUGHPUT_WEIGHT * (cells_per_second - previous)
+        )
+    # A timeout of 0 keeps the average until the cache is cleared
+    cache_manager.cache.set(THROUGHPUT_CACHE_KEY, cells_per_second, timeout=0)
+    logger.info("Imports load %.0f cells per second", cells_per_second)
@@ -0,0 +1,275 @@
+"""
+Reads UCR exports in chunks that are sized to fit a memory budget.
+"""
+import logging
+import os
+import resource
+import sys
+
+import pandas
+import pyarrow
+from datadog import statsd
+from pyarrow import csv as arrow_csv
+
+from hq_superset.metrics import get_tags
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MEMORY_BUDGET_BYTES = 256 * 1024 * 1024  # 256MB
+
+# A chunk is held in memory as it is read, as it is converted, and as
+# the CSV that is copied to the database, so it may only take up a
+# fraction of the budget.
+CHUNK_MEMORY_OVERHEAD = 3
+
+MIN_CHUNK_ROWS = 1000
+MAX_CHUNK_ROWS = 500_000
+
+# How many rows of a chunk to measure
+SAMPLE_ROWS = 1000
+
+# Approximate bytes per value, by pandas dtype. String values are
+# Python objects.
+DTYPE_BYTES = {
+    'string': 60,
+    'Int64': 9,
+    'Int8': 2,
+    'Float64': 9,
+}
+DATE_BYTES = 8
+ARRAY_BYTES = 150
+
+CSV_ENGINES = ('pandas', 'pyarrow')
+
+# The values that ``pandas.read_csv()`` reads as missing by default,
+# as its ``na_values`` documentation lists them. Arrow is given the same
+# values.
+NA_VALUES = (
+    '', '#N/A', '#N/A N/A', '#NA', '-1.#IND', '-1.#QNAN', '-NaN', '-nan',
+    '1.#IND', '1.#QNAN', '<NA>', 'N/A', 'NA', 'NULL', 'NaN', 'None',
+    'n/a', 'nan', 'null',
+)
+
+# Arrow reads blocks of CSV text. Parsed into a DataFrame of Python
+# strings, a block takes up several times its size.
+ARROW_BLOCK_MEMORY_RATIO = 16
+MIN_ARROW_BLOCK_BYTES = 1024 * 1024  # 1MB
+MAX_ARROW_BLOCK_BYTES = 64 * 1024 * 1024  # 64MB
+
+# Arrow types by pandas dtype, and the pandas dtypes they are read
+# back as
+ARROW_TYPES = {
+    'string': pyarrow.string(),
+    'Int64': pyarrow.int64(),
+    'Int8': pyarrow.int8(),
+    'Float64': pyarrow.float64(),
+}
+PANDAS_DTYPES = {
+    arrow_type: pandas.api.types.pandas_dtype(dtype)
+    for dtype, arrow_type in ARROW_TYPES.items()
+}
+
+
+class AdaptiveChunker:
+    """
+    Chooses how many rows of an export to read at a time, so that a
+    chunk fits in ``memory_budget`` bytes.
+
+    The first chunk is sized from an estimate of the bytes per row.
+    After that, chunks are sized from the bytes per row observed in the
+    previous chunk, or from the memory that the process peaked at while
+    it was loaded, whichever is larger.
+    """
+
+    def __init__(self, memory_budget, row_bytes):
+        self.memory_budget = memory_budget
+        self.row_bytes = row_bytes
+        self.peak_rss = 0
+        self._base_rss = get_rss()
+        self._last_peak_rss = get_peak_rss()
+
+    @property
+    def chunk_size(self):
+        """
+        >>> AdaptiveChunker(3_000_000, 100).chunk_size
+        10000
+        >>> AdaptiveChunker(3_000_000, 1_000_000).chunk_size
+        1000
+
+        """
+        rows = self.memory_budget // (self.row_bytes * CHUNK_MEMORY_OVERHEAD)
+        return int(min(max(rows, MIN_CHUNK_ROWS), MAX_CHUNK_ROWS))
+
+    def observe(self, df):
+        """
+        Updates the bytes per row from ``df``, a chunk that has been
+        loaded, and from the peak memory used by the process.
+
+        The peak is the highest the process has ever reached, so a
+        chunk is only measured by it if the chunk raised it.
+        """
+        peak_rss = get_peak_rss()
+        if len(df):
+            sample = df.head(SAMPLE_ROWS)
+            row_bytes = sample.memory_usage(deep=True, index=False).sum() / len(sample)
+            if self._base_rss and peak_rss > self._last_peak_rss:
+                # The memory taken by the chunk already includes
+                # CHUNK_MEMORY_OVERHEAD
+                peak_row_bytes = (peak_rss - self._base_rss) / len(df)
+                row_bytes = max(row_bytes, peak_row_bytes / CHUNK_MEMORY_OVERHEAD)
+            self.row_bytes = max(row_bytes, 1)
+        self.peak_rss = peak_rss
+        self._base_rss = get_rss()
+        self._last_peak_rss = peak_rss
+
+    def report(self, datasource_id):
+        tags = get_tags({"datasource": datasource_id})
+        if self.peak_rss:
+            statsd.gauge('cca.import.peak_rss_bytes', self.peak_rss, tags=tags)
+        statsd.gauge('cca.import.chunk_rows', self.chunk_size, tags=tags)
+        logger.info(
+            "Imported %s in chunks of %s rows of ~%.0f bytes; peak RSS %s bytes",
+            datasource_id,
+            self.chunk_size,
+            self.row_bytes,
+            self.peak_rss,
+        )
+
+
+def estimate_row_bytes(column_dtypes, date_columns, array_columns):
+    """
+    Estimates the bytes per row of a DataFrame with the columns returned
+    by ``get_column_dtypes()``.
+
+    >>> estimate_row_bytes({'doc_id': 'string', 'n': 'Int64'}, ['d'], [])
+    77
+
+    """
+    return (
+        sum(
+            DTYPE_BYTES.get(dtype, DTYPE_BYTES['string'])
+            for column, dtype in column_dtypes.items()
+            if column not in date_columns and column not in array_columns
+        )
+        + DATE_BYTES * len(date_columns)
+        + ARRAY_BYTES * len(array_columns)
+    )
+
+
+def read_export(csv_file, column_dtypes, chunker, skip_rows=0, engine=None):
+    """
+    Yields DataFrames of the rows of ``csv_file``, read with the CSV
+    engine named by ``engine``, "pandas" (the default) or "pyarrow".
+    The first ``skip_rows`` rows after the header are skipped.
+
+    A file with only a header yields one empty DataFrame.
+    """
+    engine = engine or 'pandas'
+    if engine not in CSV_ENGINES:
+        raise ValueError(f"Unknown CSV engine {engine!r}")
+    if engine == 'pyarrow':
+        return read_arrow_chunks(
+            csv_file,
+            column_dtypes,
+            get_arrow_block_size(chunker.memory_budget),
+            skip_rows,
+        )
+    reader = pandas.read_csv(
+        filepath_or_buffer=csv_file,
+        encoding="utf-8",
+        keep_default_na=True,
+        dtype=column_dtypes,
+        iterator=True,
+        low_memory=True,
+        skiprows=(lambda i: 0 < i <= skip_rows) if skip_rows else None,
+    )
+    return read_chunks(reader, chunker)
+
+
+def read_chunks(reader, chunker):
+    """
+    Yields chunks from ``reader``, a ``TextFileReader`` returned by
+    ``pandas.read_csv(..., iterator=True)``, of ``chunker.chunk_size``
+    rows.
+    """
+    while True:
+        try:
+            yield reader.get_chunk(chunker.chunk_size)
+        except StopIteration:
+            return
+
+
+def read_arrow_chunks(csv_file, column_dtypes, block_size, skip_rows=0):
+    """
+    Yields DataFrames of the rows of ``csv_file``, parsed by Arrow a
+    block of ``block_size`` bytes at a time.
+
+    Columns are converted to the same pandas dtypes, and the same
+    values are read as missing, as ``pandas.read_csv()`` with
+    ``dtype=column_dtypes``. Unlike pandas, Arrow does not strip
+    whitespace around numbers, and raises ``ArrowInvalid`` for them.
+    """
+    reader = arrow_csv.open_csv(
+        csv_file,
+        read_options=arrow_csv.ReadOptions(
+            use_threads=True,
+            block_size=block_size,
+            skip_rows_after_names=skip_rows,
+        ),
+        convert_options=arrow_csv.ConvertOptions(
+            column_types={
+                column: ARROW_TYPES.get(dtype, pyarrow.string())
+                for column, dtype in column_dtypes.items()
+            },
+            null_values=list(NA_VALUES),
+            strings_can_be_null=True,
+        ),
+    )
+    empty = True
+    for batch in reader:
+        empty = False
+        yield batch.to_pandas(types_mapper=PANDAS_DTYPES.get)
+    if empty:
+        yield reader.schema.empty_table().to_pandas(
+            types_mapper=PANDAS_DTYPES.get
+        )
+
+
+def get_arrow_block_size(memory_budget):
+    """
+    Returns the number of bytes of CSV for Arrow to parse at a time,
+    so that the DataFrame of a block fits in ``memory_budget``.
+
+    >>> get_arrow_block_size(256 * 1024 * 1024)
+    16777216
+    >>> get_arrow_block_size(1000)
+    1048576
+
+    """
+    block_size = memory_budget // ARROW_BLOCK_MEMORY_RATIO
+    return int(min(max(block_size, MIN_ARROW_BLOCK_BYTES), MAX_ARROW_BLOCK_BYTES))
+
+
+def get_rss():
+    """
+    Returns the resident set size of this process in bytes, or None
+    if it is not available.
+    """
+    try:
+        with open('/proc/self/statm') as f:
+            pages = int(f.read().split()[1])
+    except (OSError, IndexError, ValueError):
+        return None
+    return pages * os.sysconf('SC_PAGE_SIZE')
+
+
+def get_peak_rss():
+    """
+    Returns the highest resident set size that this process has
+    reached, in bytes.
+    """
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        return max_rss
+    # Linux reports kilobytes
+    return max_rss * 1024
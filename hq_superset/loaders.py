@@ -0,0 +1,931 @@
+"""
+Loaders write DataFrames parsed from UCR exports to the HQ database.
+"""
+import hashlib
+import io
+import logging
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import closing
+from datetime import datetime
+
+import pandas
+import sqlalchemy
+from datadog import statsd
+from psycopg2 import sql
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.sql import text
+from superset.sql_parse import Table
+
+from hq_superset.metrics import get_tags
+
+logger = logging.getLogger(__name__)
+
+STAGING_TABLE_SUFFIX = '_staging'
+
+# Longer PostgreSQL identifiers are truncated
+MAX_IDENTIFIER_LENGTH = 63
+
+DEFAULT_PARTITION_SUFFIX = 'default'
+PARTITION_BOUND_RE = re.compile(r"FROM \('([^']+)'\)")
+
+
+class DataFrameLoader:
+    """
+    Loads DataFrames using the database engine spec's ``df_to_sql()``,
+    which pandas turns into batched INSERT statements. Works with any
+    database that Superset supports.
+    """
+    name = 'df_to_sql'
+    # Chunks are committed in the order they are loaded, so the rows in
+    # the table are always the first rows of the export
+    commits_in_order = True
+    # The number of chunks the loader may hold in memory at a time
+    chunks_in_memory = 1
+    # Whether the table is created UNLOGGED
+    unlogged = False
+
+    def __init__(self, database, table, sql_dtypes):
+        self.database = database
+        self.table = table
+        self.sql_dtypes = sql_dtypes
+        self.row_count = 0
+        self.seconds = 0.0
+
+    def load(self, df, replace=False):
+        """
+        Writes ``df`` to ``self.table``. If ``replace`` is True, the
+        table is (re)created first.
+        """
+        start = time.monotonic()
+        self._load(df, replace)
+        self.seconds += time.monotonic() - start
+        self.row_count += len(df)
+
+    def wait(self):
+        """
+        Waits until all the chunks passed to ``load()`` have been
+        written. Chunks are written before ``load()`` returns, unless
+        they are loaded in parallel.
+        """
+
+    def cancel(self):
+        """
+        Stops loading chunks that have not been written yet.
+        """
+
+    def _load(self, df, replace):
+        self.database.db_engine_spec.df_to_sql(
+            self.database,
+            self.table,
+            df,
+            to_sql_kwargs={
+                "if_exists": "replace" if replace else "append",
+                "dtype": self.sql_dtypes,
+                "index": False,
+            },
+        )
+
+    @property
+    def rows_per_second(self):
+        if not self.seconds:
+            return 0.0
+        return self.row_count / self.seconds
+
+    def report_throughput(self, datasource_id):
+        tags = get_tags({"datasource": datasource_id, "loader": self.name})
+        statsd.gauge(
+            'cca.import.rows_per_second',
+            self.rows_per_second,
+            tags=tags,
+        )
+        statsd.increment('cca.import.rows', self.row_count, tags=tags)
+        logger.info(
+            "Loaded %s rows into %s using %s in %.2fs (%.0f rows/s)",
+            self.row_count,
+            self.table.table,
+            self.name,
+            self.seconds,
+            self.rows_per_second,
+        )
+
+
+class CopyLoader(DataFrameLoader):
+    """
+    Streams DataFrames into PostgreSQL using ``COPY ... FROM STDIN``.
+
+    The table is created by ``df_to_sql()`` from an empty DataFrame, so
+    that column types are exactly the same as they would be if all
+    rows were inserted by ``DataFrameLoader``.
+
+    If ``unlogged`` is True, the table is created UNLOGGED, so that
+    loading it does not write WAL. An unlogged table is emptied if
+    PostgreSQL crashes, and is not replicated, so it must be set
+    logged with ``set_table_logged()`` before it is swapped in.
+
+    If ``partition_column`` is given, the table is created partitioned
+    by month of that column, and the partitions for the months in each
+    chunk are created before the chunk is copied. Partitioned tables
+    are not created UNLOGGED.
+    """
+    name = 'copy'
+
+    def __init__(self, database, table, sql_dtypes, unlogged=False,
+                 partition_column=None):
+        super().__init__(database, table, sql_dtypes)
+        self.unlogged = unlogged and not partition_column
+        self.partition_column = partition_column
+        self._partition_months = set()
+
+    def _load(self, df, replace):
+        if replace:
+            super()._load(df.head(0), replace=True)
+            if self.partition_column:
+                partition_table(self.database, self.table, self.partition_column)
+                self._partition_months = set()
+            if self.unlogged:
+                set_table_logged(self.database, self.table, False)
+        if df.empty:
+            return
+        if self.partition_column:
+            self._create_partitions(df[self.partition_column])
+        with self.database.get_raw_connection() as conn:
+            self._copy(conn, df)
+
+    def _create_partitions(self, values):
+        months = get_months(values) - self._partition_months
+        if months:
+            create_partitions(
+                self.database, self.table, self.partition_column, months
+            )
+            self._partition_months |= months
+
+    def _copy(self, conn, df):
+        with conn.cursor() as cursor:
+            cursor.copy_expert(
+                self._copy_statement(df).as_string(cursor),
+                dataframe_to_csv(df, self.array_columns),
+            )
+        conn.commit()
+
+    @property
+    def array_columns(self):
+        return [
+            column for column, type_ in self.sql_dtypes.items()
+            if isinstance(type_, postgresql.ARRAY)
+        ]
+
+    def _copy_statement(self, df):
+        return sql.SQL("COPY {} ({}) FROM STDIN WITH (FORMAT csv)").format(
+            sql.Identifier(self.table.schema, self.table.table),
+            sql.SQL(", ").join(sql.Identifier(c) for c in df.columns),
+        )
+
+
+class ParallelCopyLoader(CopyLoader):
+    """
+    Copies chunks into PostgreSQL from a pool of worker threads, each
+    with its own connection, while the caller parses the next chunks.
+
+    The first chunk, which creates the table, is loaded before any
+    others. At most ``workers + 1`` chunks are waiting or being loaded
+    at a time; ``load()`` blocks until there is room for another.
+
+    Chunks can be committed in any order, so an interrupted import
+    cannot be resumed from the number of rows in the table.
+    """
+    name = 'parallel_copy'
+    commits_in_order = False
+
+    def __init__(self, database, table, sql_dtypes, workers, unlogged=False,
+                 partition_column=None):
+        super().__init__(
+            database, table, sql_dtypes, unlogged, partition_column
+        )
+        self.workers = workers
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(workers + 1)
+        self._futures = []
+        self._executor = None
+        self._engine_context = None
+        self._engine = None
+        self._started = None
+
+    @property
+    def chunks_in_memory(self):
+        # Chunks in the pool, plus the one the caller is parsing
+        return self.workers + 2
+
+    def load(self, df, replace=False):
+        if replace:
+            super().load(df, replace=True)
+            return
+        self._raise_worker_errors()
+        if self.partition_column and not df.empty:
+            # Partitions are created here, because workers have no app
+            # context
+            self._create_partitions(df[self.partition_column])
+        if self._executor is None:
+            self._start()
+        self._slots.acquire()
+        future = self._executor.submit(self._load_in_worker, df)
+        future.add_done_callback(lambda __: self._slots.release())
+        self._futures.append(future)
+
+    def wait(self):
+        if self._executor is None:
+            return
+        try:
+            self._executor.shutdown(wait=True)
+            self._raise_worker_errors()
+        finally:
+            self._stop()
+        self.seconds += time.monotonic() - self._started
+
+    def cancel(self):
+        if self._executor is None:
+            return
+        try:
+            self._executor.shutdown(wait=True, cancel_futures=True)
+        finally:
+            self._stop()
+
+    def _start(self):
+        # Workers take pooled connections from one engine, so that they
+        # don't look up the database's connection details in threads
+        # that have no app context
+        self._engine_context = self.database.get_sqla_engine_with_context(
+            nullpool=False
+        )
+        self._engine = self._engine_context.__enter__()
+        self._executor = ThreadPoolExecutor(
+            max_workers=self.workers,
+            thread_name_prefix='hq_loader',
+        )
+        self._started = time.monotonic()
+
+    def _stop(self):
+        self._executor = None
+        self._engine.dispose()
+        self._engine_context.__exit__(None, None, None)
+
+    def _load_in_worker(self, df):
+        if df.empty:
+            return
+        with closing(self._engine.raw_connection()) as conn:
+            self._copy(conn, df)
+        with self._lock:
+            self.row_count += len(df)
+
+    def _raise_worker_errors(self):
+        for future in self._futures:
+            if future.done() and future.exception():
+                raise future.exception()
+        self._futures = [f for f in self._futures if not f.done()]
+
+
+def get_dataframe_loader(
+    database,
+    table,
+    sql_dtypes,
+    workers=1,
+    unlogged=False,
+    partition_column=None,
+):
+    """
+    Returns a ``CopyLoader`` for PostgreSQL databases, or a
+    ``ParallelCopyLoader`` if ``workers`` is more than 1. Otherwise
+    returns a ``DataFrameLoader``, and ``unlogged`` and
+    ``partition_column`` are ignored.
+    """
+    if database.backend == 'postgresql':
+        if workers > 1:
+            return ParallelCopyLoader(
+                database, table, sql_dtypes, workers, unlogged,
+                partition_column,
+            )
+        return CopyLoader(
+            database, table, sql_dtypes, unlogged, partition_column
+        )
+    return DataFrameLoader(database, table, sql_dtypes)
+
+
+def get_staging_table(table):
+    """
+    Returns the table that an import loads into before it is swapped
+    in to replace ``table``.
+    """
+    return Table(table=f"{table.table}{STAGING_TABLE_SUFFIX}", schema=table.schema)
+
+
+def swap_staging_table(
+    database,
+    table,
+    staging_table,
+    index_columns=(),
+    before_swap=None,
+):
+    """
+    Replaces ``table`` with ``staging_table`` in a single transaction,
+    so that queries never see an empty or partially loaded table.
+
+    The table name does not change, so the Superset dataset, and the
+    charts that use it, are unaffected. Indexes on ``index_columns``
+    that were created by ``create_indexes()``, and partitions, are
+    renamed to match.
+
+    ``before_swap(connection)`` is called in the transaction once
+    ``table`` has been dropped, which blocks writes to it until the
+    transaction commits, and before ``staging_table`` is renamed.
+    """
+    with (
+        database.get_sqla_engine_with_context() as engine,
+        engine.begin() as connection
+    ):
+        preparer = engine.dialect.identifier_preparer
+        connection.execute(text(
+            f"DROP TABLE IF EXISTS {quote_table(preparer, table)}"
+        ))
+        if before_swap:
+            before_swap(connection)
+        connection.execute(text(
+            f"ALTER TABLE {quote_table(preparer, staging_table)} "
+            f"RENAME TO {preparer.quote(table.table)}"
+        ))
+        for column in index_columns:
+            staging_index = Table(
+                table=get_index_name(staging_table, column),
+                schema=staging_table.schema,
+            )
+            connection.execute(text(
+                f"ALTER INDEX IF EXISTS {quote_table(preparer, staging_index)} "
+                f"RENAME TO {preparer.quote(get_index_name(table, column))}"
+            ))
+        if database.backend == 'postgresql':
+            for name, month in get_partitions(connection, preparer, table):
+                partition = Table(table=name, schema=table.schema)
+                connection.execute(text(
+                    f"ALTER TABLE {quote_table(preparer, partition)} RENAME TO "
+                    f"{preparer.quote(get_partition_name(table, month))}"
+                ))
+
+
+def merge_staging_table(
+    database,
+    table,
+    staging_table,
+    key_column='doc_id',
+    after_merge=None,
+):
+    """
+    Merges the rows of ``staging_table`` into ``table`` in a single
+    transaction: Rows in ``table`` that have the same ``key_column``
+    value as a staged row are replaced by the staged row. The staging
+    table is dropped.
+
+    Other writes to ``table`` wait until the transaction commits.
+    ``after_merge(connection)`` is called in the transaction once the
+    staged rows have been inserted.
+    """
+    with (
+        database.get_sqla_engine_with_context() as engine,
+        engine.begin() as connection
+    ):
+        preparer = engine.dialect.identifier_preparer
+        live = quote_table(preparer, table)
+        staging = quote_table(preparer, staging_table)
+        key = preparer.quote(key_column)
+        columns = ', '.join(
+            preparer.quote(column['name'])
+            for column in sqlalchemy.inspect(connection).get_columns(
+                staging_table.table, schema=staging_table.schema
+            )
+        )
+        # Blocks writes, but not reads
+        connection.execute(text(
+            f"LOCK TABLE {live} IN SHARE ROW EXCLUSIVE MODE"
+        ))
+        connection.execute(text(
+            f"DELETE FROM {live} WHERE {key} IN "
+            f"(SELECT {key} FROM {staging})"
+        ))
+        connection.execute(text(
+            f"INSERT INTO {live} ({columns}) SELECT {columns} FROM {staging}"
+        ))
+        if after_merge:
+            after_merge(connection)
+        connection.execute(text(f"DROP TABLE {staging}"))
+
+
+def create_indexes(database, table, columns, concurrently=False):
+    """
+    Creates an index on each of ``columns`` of ``table`` that does not
+    have one already. Columns that ``table`` does not have are skipped.
+
+    Building an index after a table has been loaded is much faster
+    than updating it for every row that is inserted.
+
+    If ``concurrently`` is True, indexes are built with ``CREATE INDEX
+    CONCURRENTLY``, which does not block writes to a live table, but
+    cannot run in a transaction.
+    """
+    with database.get_sqla_engine_with_context() as engine:
+        if concurrently:
+            connect = engine.connect().execution_options(
+                isolation_level="AUTOCOMMIT"
+            )
+        else:
+            connect = engine.begin()
+        with connect as connection:
+            preparer = engine.dialect.identifier_preparer
+            table_columns = {
+                column['name']
+                for column in sqlalchemy.inspect(connection).get_columns(
+                    table.table, schema=table.schema
+                )
+            }
+            partitions = None
+            for column in columns:
+                if column not in table_columns:
+                    logger.warning(
+                        "Not indexing %s: %s has no such column",
+                        column,
+                        table.table,
+                    )
+                    continue
+                start = time.monotonic()
+                if not concurrently:
+                    connection.execute(text(
+                        "CREATE INDEX IF NOT EXISTS "
+                        f"{preparer.quote(get_index_name(table, column))} "
+                        f"ON {quote_table(preparer, table)} "
+                        f"({preparer.quote(column)})"
+                    ))
+                else:
+                    if partitions is None:
+                        partitions = get_partitions(connection, preparer, table)
+                    _create_index_concurrently(
+                        connection, preparer, table, column, partitions
+                    )
+                logger.info(
+                    "Indexed %s of %s in %.2fs",
+                    column,
+                    table.table,
+                    time.monotonic() - start,
+                )
+
+
+def _create_index_concurrently(connection, preparer, table, column, partitions):
+    """
+    Builds the index on ``column`` of ``table`` without blocking
+    writes. An index that an earlier build left invalid is rebuilt.
+
+    An index on a partitioned table cannot be built concurrently, so
+    it is created on the partitioned table alone, and the index of
+    each partition is built concurrently and attached to it.
+    """
+    index = Table(get_index_name(table, column), table.schema)
+    if _is_index_valid(connection, preparer, index):
+        return
+    if not partitions:
+        _build_index_concurrently(connection, preparer, table, column)
+        return
+    connection.execute(text(
+        f"CREATE INDEX IF NOT EXISTS {preparer.quote(index.table)} "
+        f"ON ONLY {quote_table(preparer, table)} ({preparer.quote(column)})"
+    ))
+    for partition_name, __ in partitions:
+        partition = Table(partition_name, table.schema)
+        partition_index = Table(get_index_name(partition, column), table.schema)
+        _build_index_concurrently(connection, preparer, partition, column)
+        connection.execute(text(
+            f"ALTER INDEX {quote_table(preparer, index)} "
+            f"ATTACH PARTITION {quote_table(preparer, partition_index)}"
+        ))
+
+
+def _build_index_concurrently(connection, preparer, table, column):
+    index = Table(get_index_name(table, column), table.schema)
+    if _is_index_valid(connection, preparer, index) is False:
+        connection.execute(text(
+            f"DROP INDEX CONCURRENTLY IF EXISTS {quote_table(preparer, index)}"
+        ))
+    connection.execute(text(
+        f"CREATE INDEX CONCURRENTLY IF NOT EXISTS {preparer.quote(index.table)} "
+        f"ON {quote_table(preparer, table)} ({preparer.quote(column)})"
+    ))
+
+
+def _is_index_valid(connection, preparer, index):
+    """
+    Returns whether ``index`` is valid, or None if it does not exist.
+    """
+    return connection.execute(
+        text(
+            "SELECT indisvalid FROM pg_index "
+            "WHERE indexrelid = to_regclass(:index)"
+        ),
+        {'index': quote_table(preparer, index)},
+    ).scalar()
+
+
+def set_table_logged(database, table, logged=True):
+    """
+    Makes ``table`` a logged or an UNLOGGED table. Setting a table
+    logged rewrites it, and writes it to the WAL in one pass.
+    """
+    with (
+        database.get_sqla_engine_with_context() as engine,
+        engine.begin() as connection
+    ):
+        preparer = engine.dialect.identifier_preparer
+        connection.execute(text(
+            f"ALTER TABLE {quote_table(preparer, table)} "
+            f"SET {'LOGGED' if logged else 'UNLOGGED'}"
+        ))
+
+
+def analyze_table(database, table):
+    """
+    Updates the planner statistics of ``table``, so that the first
+    queries after an import are planned for the rows it now has.
+    Only PostgreSQL tables are analyzed.
+    """
+    if database.backend != 'postgresql':
+        return
+    with (
+        database.get_sqla_engine_with_context() as engine,
+        engine.begin() as connection
+    ):
+        preparer = engine.dialect.identifier_preparer
+        connection.execute(text(f"ANALYZE {quote_table(preparer, table)}"))
+
+
+def get_index_name(table, column):
+    """
+    Returns the name of the index on ``column`` of ``table``. Names
+    that would be too long are shortened, and kept unique with a hash.
+
+    >>> get_index_name(Table(table='ucr1'), 'doc_id')
+    'ix_ucr1_doc_id'
+    >>> len(get_index_name(Table(table='ucr1' * 20), 'doc_id'))
+    63
+
+    """
+    return shorten_identifier(f"ix_{table.table}_{column}")
+
+
+def shorten_identifier(name):
+    """
+    Shortens ``name`` if it is too long to be an identifier, and keeps
+    it unique with a hash.
+    """
+    if len(name) > MAX_IDENTIFIER_LENGTH:
+        digest = hashlib.md5(name.encode('utf-8')).hexdigest()[:8]
+        name = f"{name[:MAX_IDENTIFIER_LENGTH - 9]}_{digest}"
+    return name
+
+
+def partition_table(database, table, column):
+    """
+    Replaces ``table``, which must be empty, with a table with the same
+    columns that is partitioned by range of ``column``. Rows that do
+    not fall in a monthly partition are stored in a default partition.
+    """
+    with (
+        database.get_sqla_engine_with_context() as engine,
+        engine.begin() as connection
+    ):
+        preparer = engine.dialect.identifier_preparer
+        new_table = Table(
+            table=shorten_identifier(f"{table.table}_new"), schema=table.schema
+        )
+        default = Table(table=get_partition_name(table), schema=table.schema)
+        connection.execute(text(
+            f"CREATE TABLE {quote_table(preparer, new_table)} "
+            f"(LIKE {quote_table(preparer, table)} INCLUDING DEFAULTS) "
+            f"PARTITION BY RANGE ({preparer.quote(column)})"
+        ))
+        connection.execute(text(f"DROP TABLE {quote_table(preparer, table)}"))
+        connection.execute(text(
+            f"ALTER TABLE {quote_table(preparer, new_table)} "
+            f"RENAME TO {preparer.quote(table.table)}"
+        ))
+        connection.execute(text(
+            f"CREATE TABLE {quote_table(preparer, default)} "
+            f"PARTITION OF {quote_table(preparer, table)} DEFAULT"
+        ))
+
+
+def create_partitions(database, table, column, months):
+    """
+    Creates the monthly partitions of ``table`` that start at each of
+    ``months`` and do not exist yet.
+
+    Rows in the default partition that belong in a new partition are
+    moved into it, which PostgreSQL requires before it can be created.
+    """
+    with (
+        database.get_sqla_engine_with_context() as engine,
+        engine.begin() as connection
+    ):
+        preparer = engine.dialect.identifier_preparer
+        partitions = dict(
+            (month, name)
+            for name, month in get_partitions(connection, preparer, table)
+        )
+        parent = quote_table(preparer, table)
+        default = None
+        if None in partitions:
+            default = quote_table(
+                preparer, Table(table=partitions[None], schema=table.schema)
+            )
+        quoted_column = preparer.quote(column)
+        for month in sorted(set(months) - set(partitions)):
+            partition = quote_table(preparer, Table(
+                table=get_partition_name(table, month), schema=table.schema,
+            ))
+            bounds = {'start': month, 'end': get_next_month(month)}
+            in_month = (
+                f"{quoted_column} >= :start AND {quoted_column} < :end"
+            )
+            has_default_rows = default and connection.execute(
+                text(f"SELECT EXISTS (SELECT 1 FROM {default} WHERE {in_month})"),
+                bounds,
+            ).scalar()
+            if has_default_rows:
+                connection.execute(text(
+                    f"ALTER TABLE {parent} DETACH PARTITION {default}"
+                ))
+            connection.execute(
+                text(
+                    f"CREATE TABLE {partition} PARTITION OF {parent} "
+                    "FOR VALUES FROM (:start) TO (:end)"
+                ),
+                bounds,
+            )
+            if has_default_rows:
+                connection.execute(
+                    text(
+                        f"INSERT INTO {partition} "
+                        f"SELECT * FROM {default} WHERE {in_month}"
+                    ),
+                    bounds,
+                )
+                connection.execute(
+                    text(f"DELETE FROM {default} WHERE {in_month}"), bounds
+                )
+                connection.execute(text(
+                    f"ALTER TABLE {parent} ATTACH PARTITION {default} DEFAULT"
+                ))
+
+
+def remove_partitions_before(database, table, before, drop=False):
+    """
+    Detaches the monthly partitions of ``table`` whose months end by
+    ``before``, and returns their names. Detached partitions are
+    renamed with a "_detached" suffix and the time they were detached,
+    so that a month can be detached again, and kept as ordinary tables.
+    If ``drop`` is True, they are dropped instead.
+
+    Either way, no rows are deleted one at a time, so this is cheap.
+    """
+    removed = []
+    detached_at = datetime.now().strftime('%Y%m%d%H%M%S%f')
+    with (
+        database.get_sqla_engine_with_context() as engine,
+        engine.begin() as connection
+    ):
+        preparer = engine.dialect.identifier_preparer
+        for name, month in get_partitions(connection, preparer, table):
+            if month is None or get_next_month(month) > before:
+                continue
+            partition = Table(table=name, schema=table.schema)
+            if drop:
+                connection.execute(text(
+                    f"DROP TABLE {quote_table(preparer, partition)}"
+                ))
+            else:
+                connection.execute(text(
+                    f"ALTER TABLE {quote_table(preparer, table)} "
+                    f"DETACH PARTITION {quote_table(preparer, partition)}"
+                ))
+                detached_name = shorten_identifier(
+                    f'{name}_detached_{detached_at}'
+                )
+                connection.execute(text(
+                    f"ALTER TABLE {quote_table(preparer, partition)} "
+                    f"RENAME TO {preparer.quote(detached_name)}"
+                ))
+            removed.append(name)
+    return removed
+
+
+def get_partitions(connection, preparer, table):
+    """
+    Returns the names of the partitions of ``table`` and the months
+    they start at. The month of the default partition is None.
+    """
+    rows = connection.execute(
+        text(
+            "SELECT c.relname, pg_get_expr(c.relpartbound, c.oid) "
+            "FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid "
+            "WHERE i.inhparent = to_regclass(:table)"
+        ),
+        {'table': quote_table(preparer, table)},
+    ).fetchall()
+    partitions = []
+    for name, bound in rows:
+        match = PARTITION_BOUND_RE.search(bound)
+        month = datetime.fromisoformat(match.group(1)) if match else None
+        partitions.append((name, month))
+    return partitions
+
+
+def is_partitioned(database, table):
+    if database.backend != 'postgresql':
+        return False
+    with database.get_sqla_engine_with_context() as engine:
+        preparer = engine.dialect.identifier_preparer
+        return bool(engine.execute(
+            text(
+                "SELECT EXISTS (SELECT 1 FROM pg_partitioned_table "
+                "WHERE partrelid = to_regclass(:table))"
+            ),
+            {'table': quote_table(preparer, table)},
+        ).scalar())
+
+
+def get_partitioned_tables(database, schema_prefix):
+    """
+    Returns the partitioned tables in schemas that start with
+    ``schema_prefix``, other than staging tables.
+    """
+    with database.get_sqla_engine_with_context() as engine:
+        rows = engine.execute(
+            text(
+                "SELECT n.nspname, c.relname FROM pg_partitioned_table p "
+                "JOIN pg_class c ON c.oid = p.partrelid "
+                "JOIN pg_namespace n ON n.oid = c.relnamespace "
+                "WHERE n.nspname LIKE :prefix AND c.relispartition = false"
+            ),
+            {'prefix': f"{schema_prefix}%"},
+        ).fetchall()
+    return [
+        Table(table=name, schema=schema)
+        for schema, name in rows
+        if not name.endswith(STAGING_TABLE_SUFFIX)
+    ]
+
+
+def get_partition_name(table, month=None):
+    """
+    Returns the name of the partition of ``table`` for ``month``, or
+    of its default partition.
+
+    >>> get_partition_name(Table(table='ucr1'), datetime(2023, 1, 1))
+    'ucr1_p2023_01'
+    >>> get_partition_name(Table(table='ucr1'))
+    'ucr1_default'
+
+    """
+    suffix = (
+        f"p{month:%Y_%m}" if month is not None else DEFAULT_PARTITION_SUFFIX
+    )
+    return shorten_identifier(f"{table.table}_{suffix}")
+
+
+def get_months(values):
+    """
+    Returns the first moments of the months of the datetimes in
+    ``values``, a pandas Series.
+
+    >>> sorted(get_months(pandas.Series(pandas.to_datetime(
+    ...     ['2023-01-31 23:59', None, '2023-01-01 00:00', '2023-03-02 12:00']
+    ... ))))
+    [datetime.datetime(2023, 1, 1, 0, 0), datetime.datetime(2023, 3, 1, 0, 0)]
+
+    """
+    return {
+        period.to_timestamp().to_pydatetime()
+        for period in values.dropna().dt.to_period('M').unique()
+    }
+
+
+def get_table_months(database, table, column):
+    """
+    Returns the first moments of the months of the values of
+    ``column`` in ``table``.
+    """
+    with database.get_sqla_engine_with_context() as engine:
+        preparer = engine.dialect.identifier_preparer
+        rows = engine.execute(text(
+            f"SELECT DISTINCT date_trunc('month', {preparer.quote(column)}) "
+            f"FROM {quote_table(preparer, table)} "
+            f"WHERE {preparer.quote(column)} IS NOT NULL"
+        )).fetchall()
+    return {month for month, in rows}
+
+
+def get_next_month(month):
+    """
+    >>> get_next_month(datetime(2023, 12, 1))
+    datetime.datetime(2024, 1, 1, 0, 0)
+
+    """
+    if month.month == 12:
+        return month.replace(year=month.year + 1, month=1)
+    return month.replace(month=month.month + 1)
+
+
+def get_row_count_and_max(database, table, column):
+    """
+    Returns the number of rows in ``table`` and the largest value of
+    ``column``, or ``(0, None)`` if the table does not exist.
+    """
+    with database.get_sqla_engine_with_context() as engine:
+        if not sqlalchemy.inspect(engine).has_table(
+            table.table, schema=table.schema
+        ):
+            return 0, None
+        preparer = engine.dialect.identifier_preparer
+        row_count, max_value = engine.execute(text(
+            f"SELECT count(*), max({preparer.quote(column)}) "
+            f"FROM {quote_table(preparer, table)}"
+        )).one()
+        return row_count, max_value
+
+
+def drop_table(database, table):
+    with (
+        database.get_sqla_engine_with_context() as engine,
+        engine.begin() as connection
+    ):
+        preparer = engine.dialect.identifier_preparer
+        connection.execute(text(
+            f"DROP TABLE IF EXISTS {quote_table(preparer, table)}"
+        ))
+
+
+def quote_table(preparer, table):
+    if table.schema:
+        return f"{preparer.quote_schema(table.schema)}.{preparer.quote(table.table)}"
+    return preparer.quote(table.table)
+
+
+def dataframe_to_csv(df, array_columns=()):
+    """
+    Returns ``df`` as a CSV file object that can be passed to
+    ``COPY ... FROM STDIN WITH (FORMAT csv)``.
+
+    Missing values are written as unquoted empty strings, which COPY
+    reads as NULL. (``pandas.read_csv()`` has already turned empty
+    strings in the export into missing values.)
+
+    >>> df = pandas.DataFrame({'doc_id': ['a1', None], 'tags': [['x'], []]})
+    >>> print(dataframe_to_csv(df, ['tags']).read())
+    a1,"{""x""}"
+    ,{}
+    <BLANKLINE>
+
+    """
+    if array_columns:
+        df = df.assign(**{
+            column: df[column].map(to_pg_array)
+            for column in array_columns
+            if column in df.columns
+        })
+    buffer = io.StringIO()
+    df.to_csv(buffer, index=False, header=False)
+    buffer.seek(0)
+    return buffer
+
+
+def to_pg_array(values):
+    """
+    Returns a PostgreSQL array literal for a list of values.
+
+    >>> to_pg_array(['hello', 'say "hi"'])
+    '{"hello","say \\\\"hi\\\\""}'
+    >>> to_pg_array([None, 1])
+    '{NULL,"1"}'
+    >>> to_pg_array([])
+    '{}'
+    >>> to_pg_array(None) is None
+    True
+
+    """
+    if not isinstance(values, (list, tuple)):
+        if pandas.isna(values):
+            return None
+        values = [values]
+
+    def quote(value):
+        if value is None:
+            return 'NULL'
+        escaped = str(value).replace('\\', '\\\\').replace('"', '\\"')
+        return f'"{escaped}"'
+
+    return '{' + ','.join(quote(v) for v in values) + '}'
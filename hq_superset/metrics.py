@@ -1,5 +1,11 @@
+import logging
+import time
+
+from datadog import statsd
 from superset_config import SERVER_ENVIRONMENT
 
+logger = logging.getLogger(__name__)
+
 
 def get_tags(tag_values: dict[str, str]) -> list[str]:
     tag_values.update({"env": SERVER_ENVIRONMENT})
@@ -7,3 +13,50 @@ def get_tags(tag_values: dict[str, str]) -> list[str]:
     return [
         f'{name}:{value}' for name, value in tag_values.items()
     ]
+
+
+class PhaseTimer:
+    """
+    Times the consecutive phases of an operation, and reports the
+    seconds spent in each phase as the histogram ``metric``, tagged
+    with the phase.
+    """
+
+    def __init__(self, metric, tag_values: dict[str, str]):
+        self.metric = metric
+        self.tag_values = tag_values
+        self.seconds = {}
+        self._phase = None
+        self._started = None
+
+    def start(self, name):
+        """
+        Ends the current phase, if any, and starts the phase ``name``.
+        """
+        self.stop()
+        self._phase = name
+        self._started = time.monotonic()
+
+    def stop(self):
+        if self._phase is None:
+            return
+        self.seconds[self._phase] = (
+            self.seconds.get(self._phase, 0.0)
+            + time.monotonic() - self._started
+        )
+        self._phase = None
+
+    def report(self):
+        self.stop()
+        for name, seconds in self.seconds.items():
+            statsd.histogram(
+                self.metric,
+                seconds,
+                tags=get_tags({**self.tag_values, "phase": name}),
+            )
+        logger.info(
+            "%s %s: %s",
+            self.metric,
+            self.tag_values,
+            ", ".join(f"{name} {s:.2f}s" for name, s in self.seconds.items()),
+        )
@@ -1,4 +1,6 @@
+from collections import defaultdict
 from dataclasses import dataclass
+from functools import partial
 from typing import Any, Optional
 
 from authlib.integrations.sqla_oauth2 import (
@@ -7,16 +9,33 @@ from authlib.integrations.sqla_oauth2 import (
 )
 from cryptography.fernet import MultiFernet
 from datadog import statsd
+from sqlalchemy import (
+    Text,
+    any_,
+    bindparam,
+    literal,
+    literal_column,
+    select,
+    text,
+)
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.exc import DataError
 from superset import db
+from superset.connectors.sqla.models import SqlaTable
+from superset.sql_parse import Table
 from superset_config import SKIP_DATASET_CHANGE_FOR_DOMAINS
 
+from hq_superset.casters import RowCaster
 from hq_superset.const import OAUTH2_DATABASE_NAME
 from hq_superset.exceptions import TableMissing
-from hq_superset.utils import (
-    cast_data_for_table,
-    get_fernet_keys,
-    get_hq_database,
+from hq_superset.profiling import (
+    clear_column_types,
+    get_column_types,
+    widen_columns,
 )
+from hq_superset.row_diff import diff_rows, is_diff_apply_enabled
+from hq_superset.table_cache import get_cached_table, invalidate_table
+from hq_superset.utils import get_fernet_keys, get_hq_database
 from hq_superset.metrics import get_tags
 
 import logging
@@ -36,6 +55,36 @@ class DataSetChange:
     data: list[dict[str, Any]]
     doc_ids: Optional[list[str]] = None
 
+    @classmethod
+    def combine(cls, changes):
+        """
+        Returns one change that has the same effect as applying
+        ``changes``, to the same datasource, in order.
+
+        The combined change deletes the rows of every document that the
+        changes delete. Of the rows that they insert, it keeps the rows
+        of each document that the last change to the document inserts.
+        """
+        last_change_index = {}
+        for index, change in enumerate(changes):
+            for doc_id in change.get_doc_ids():
+                last_change_index[doc_id] = index
+        data = [
+            row
+            for index, change in enumerate(changes)
+            for row in change.data
+            if last_change_index.get(row.get('doc_id'), index) == index
+        ]
+        return cls(
+            data_source_id=changes[-1].data_source_id,
+            doc_id=changes[-1].doc_id,
+            data=data,
+            doc_ids=list(last_change_index),
+        )
+
+    def get_doc_ids(self):
+        return self.doc_ids or [self.doc_id]
+
     def update_dataset(self):
         with statsd.timed('cca.dataset_change.timer', tags=get_tags({"datasource": self.data_source_id})):
             self._update_dataset()
@@ -49,33 +98,149 @@ class DataSetChange:
         the form or case has been deleted, then the list will be empty.
         """
         database = get_hq_database()
-        try:
-            sqla_table = next((
-                table for table in database.tables
-                if table.table_name == self.data_source_id
-            ))
-        except StopIteration:
-            raise TableMissing(f'{self.data_source_id} table not found.')
-        table = sqla_table.get_sqla_table_object()
+        table, column_types, caster = get_cached_table(
+            self.data_source_id,
+            partial(self._resolve_table, database),
+        )
 
         if table.schema and table.schema in SKIP_DATASET_CHANGE_FOR_SCHEMAS:
             logger.info("Skipped change for schema {0}".format(table.schema))
             return
 
+        try:
+            self._write_rows(database, table, caster)
+        except (DataError, ValueError):
+            if not column_types:
+                raise
+            # The change does not fit the narrowed columns. Widen them
+            # back to the types of their UCR data types, and try again.
+            logger.info(
+                "Widening narrowed columns of %s", self.data_source_id
+            )
+            sqla_table = self._get_sqla_table(database)
+            widen_columns(
+                database,
+                Table(table=table.name, schema=table.schema),
+                column_types,
+            )
+            clear_column_types(sqla_table)
+            sqla_table.fetch_metadata()
+            db.session.commit()
+            invalidate_table(self.data_source_id)
+            table = sqla_table.get_sqla_table_object()
+            self._write_rows(database, table, RowCaster(table))
+
+    def _get_sqla_table(self, database):
+        sqla_table = (
+            db.session.query(SqlaTable)
+            .filter_by(table_name=self.data_source_id, database_id=database.id)
+            .first()
+        )
+        if sqla_table is None:
+            raise TableMissing(f'{self.data_source_id} table not found.')
+        return sqla_table
+
+    def _resolve_table(self, database):
+        """
+        Returns the reflected table of the dataset, the types that its
+        columns were narrowed to, and a caster for its rows.
+        """
+        sqla_table = self._get_sqla_table(database)
+        table = sqla_table.get_sqla_table_object()
+        column_types = get_column_types(sqla_table)
+        return table, column_types, RowCaster(table, column_types)
+
+    def _write_rows(self, database, table, caster):
         with (
             database.get_sqla_engine_with_context() as engine,
             engine.connect() as connection,
             connection.begin()  # Commit on leaving context
         ):
-            if self.doc_ids:
-                delete_stmt = table.delete().where(table.c.doc_id.in_(self.doc_ids))
-            else:
-                delete_stmt = table.delete().where(table.c.doc_id == self.doc_id)
-            connection.execute(delete_stmt)
-            if self.data:
-                rows = list(cast_data_for_table(self.data, table))
-                insert_stmt = table.insert().values(rows)
-                connection.execute(insert_stmt)
+            self.write_rows(connection, table, caster)
+
+    def write_rows(self, connection, table, caster):
+        """
+        Replaces the rows of the changed documents in ``table``, using
+        the transaction of ``connection``.
+        """
+        rows = caster.cast_rows(self.data)
+        if is_diff_apply_enabled():
+            self._write_diff(connection, table, rows)
+            return
+        connection.execute(table.delete().where(self._doc_id_clause(table)))
+        if rows:
+            # Executed as multi-row INSERTs of up to 1000 rows each
+            connection.execute(table.insert(), rows)
+
+    def _write_diff(self, connection, table, rows):
+        """
+        Writes only the rows that differ from the rows of the documents
+        that the table already has.
+        """
+        column_names = [column.name for column in table.columns]
+        select_stmt = (
+            select(literal_column('tableoid'), literal_column('ctid'), table)
+            .where(self._doc_id_clause(table))
+            .with_for_update()
+        )
+        existing = [
+            ((result[0], result[1]), dict(zip(column_names, result[2:])))
+            for result in connection.execute(select_stmt)
+        ]
+        diff = diff_rows(existing, rows, column_names)
+
+        where_row = text(
+            'tableoid = :row_tableoid AND ctid = CAST(:row_ctid AS tid)'
+        )
+        updates_by_columns = defaultdict(list)
+        for key, values in diff.updates:
+            updates_by_columns[tuple(values)].append((key, values))
+        for columns, updates in updates_by_columns.items():
+            # Parameter names are numbered, because column names can be
+            # anything
+            update_stmt = table.update().where(where_row).values({
+                column: bindparam(f'value_{i}', type_=table.c[column].type)
+                for i, column in enumerate(columns)
+            })
+            connection.execute(update_stmt, [
+                {
+                    'row_tableoid': tableoid,
+                    'row_ctid': ctid,
+                    **{f'value_{i}': values[c] for i, c in enumerate(columns)},
+                }
+                for (tableoid, ctid), values in updates
+            ])
+        if diff.deletes:
+            connection.execute(table.delete().where(where_row), [
+                {'row_tableoid': tableoid, 'row_ctid': ctid}
+                for tableoid, ctid in diff.deletes
+            ])
+        if diff.inserts:
+            connection.execute(table.insert(), diff.inserts)
+
+        for action, count in [
+            ('skipped', diff.unchanged),
+            ('updated', len(diff.updates)),
+            ('inserted', len(diff.inserts)),
+            ('deleted', len(diff.deletes)),
+        ]:
+            if count:
+                statsd.increment(
+                    'cca.dataset_change.rows',
+                    count,
+                    tags=get_tags({
+                        "datasource": self.data_source_id,
+                        "action": action,
+                    }),
+                )
+
+    def _doc_id_clause(self, table):
+        if self.doc_ids:
+            # One array parameter, however many documents changed
+            return table.c.doc_id == any_(
+                literal(self.doc_ids, type_=postgresql.ARRAY(Text))
+            )
+        return table.c.doc_id == self.doc_id
 
 
 class OAuth2Client(db.Model, OAuth2ClientMixin):
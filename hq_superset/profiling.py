@@ -0,0 +1,252 @@
+"""
+Profiles the columns of an import, to store them in narrower types
+than their UCR data types map to.
+
+Integer columns whose values fit are stored as SMALLINT or INTEGER
+instead of BIGINT, and text columns that only hold one spelling each
+of "true" and "false", or of "yes" and "no", are stored as BOOLEAN.
+The choices are kept in the dataset's import metadata. If a later
+change does not fit, the columns are widened again.
+"""
+import json
+
+from sqlalchemy.sql import text
+
+from hq_superset.const import IMPORT_METADATA_KEY
+from hq_superset.loaders import quote_table
+
+COLUMN_TYPES_KEY = 'column_types'
+
+INTEGER_TYPES = [
+    ('smallint', -2 ** 15, 2 ** 15 - 1),
+    ('integer', -2 ** 31, 2 ** 31 - 1),
+]
+BOOLEAN_SPELLINGS = [('true', 'false'), ('yes', 'no')]
+
+# The types that UCR data types map to, which narrowed columns are
+# widened back to
+WIDE_TYPES = {
+    'smallint': 'bigint',
+    'integer': 'bigint',
+    'boolean': 'text',
+}
+
+
+class ColumnProfiler:
+    """
+    Observes the chunks of an import, and chooses narrower types for
+    the columns whose values allow it.
+    """
+
+    def __init__(self, integer_columns, text_columns):
+        # The smallest and largest value of each integer column
+        self._ranges = {column: None for column in integer_columns}
+        # The spellings of boolean-like values of each text column, by
+        # lowercase value, or None if the column is not boolean-like
+        self._spellings = {column: {} for column in text_columns}
+
+    @classmethod
+    def for_datasource(cls, datasource_defn):
+        integer_columns = []
+        text_columns = []
+        for ind in datasource_defn['configured_indicators']:
+            datatype = ind.get('datatype', 'string')
+            if datatype == 'integer':
+                integer_columns.append(ind['column_id'])
+            elif datatype == 'string':
+                text_columns.append(ind['column_id'])
+        return cls(integer_columns, text_columns)
+
+    def observe(self, df):
+        for column, bounds in self._ranges.items():
+            values = df[column].dropna()
+            if values.empty:
+                continue
+            low, high = int(values.min()), int(values.max())
+            if bounds:
+                low, high = min(low, bounds[0]), max(high, bounds[1])
+            self._ranges[column] = (low, high)
+        for column, spellings in self._spellings.items():
+            if spellings is None:
+                continue
+            for value in df[column].dropna().unique():
+                key = value.strip().lower()
+                # Each value must have one spelling, so that widening
+                # the column again restores it
+                if (
+                    not any(key in pair for pair in BOOLEAN_SPELLINGS)
+                    or spellings.setdefault(key, value) != value
+                ):
+                    spellings = None
+                    break
+            if spellings is not None and _get_boolean_pair(spellings) is None:
+                spellings = None
+            self._spellings[column] = spellings
+
+    def get_column_types(self):
+        """
+        Returns the narrower types chosen for columns, as a dictionary
+        that can be stored as JSON.
+        """
+        column_types = {}
+        for column, bounds in self._ranges.items():
+            if bounds is None:
+                continue
+            sql_type = get_integer_type(*bounds)
+            if sql_type:
+                column_types[column] = {'type': sql_type}
+        for column, spellings in self._spellings.items():
+            if not spellings:
+                continue
+            true, false = _get_boolean_pair(spellings)
+            column_types[column] = {
+                'type': 'boolean',
+                'true': spellings.get(true, true),
+                'false': spellings.get(false, false),
+            }
+        return column_types
+
+    def get_unfit_columns(self, column_types):
+        """
+        Returns the columns of ``column_types`` that have observed
+        values that their chosen types cannot store.
+        """
+        unfit = []
+        for column, column_type in column_types.items():
+            if column_type['type'] == 'boolean':
+                spellings = self._spellings.get(column)
+                fits = spellings is not None and set(spellings.values()) <= {
+                    column_type['true'], column_type['false']
+                }
+            else:
+                bounds = self._ranges.get(column)
+                fits = bounds is None or _fits_integer_type(
+                    column_type['type'], *bounds
+                )
+            if not fits:
+                unfit.append(column)
+        return unfit
+
+
+def get_integer_type(low, high):
+    """
+    Returns the narrowest integer type for values from ``low`` to
+    ``high``, or None if they need a BIGINT.
+
+    >>> get_integer_type(-5, 40_000)
+    'integer'
+    >>> get_integer_type(0, 2 ** 40) is None
+    True
+
+    """
+    for sql_type, *__ in INTEGER_TYPES:
+        if _fits_integer_type(sql_type, low, high):
+            return sql_type
+    return None
+
+
+def _fits_integer_type(sql_type, low, high):
+    __, min_value, max_value = next(
+        t for t in INTEGER_TYPES if t[0] == sql_type
+    )
+    return min_value <= low and high <= max_value
+
+
+def _get_boolean_pair(spellings):
+    """
+    Returns the pair of boolean values that the lowercase keys of
+    ``spellings`` belong to, or None.
+    """
+    return next(
+        (pair for pair in BOOLEAN_SPELLINGS if set(spellings) <= set(pair)),
+        None,
+    )
+
+
+def narrow_columns(database, table, column_types):
+    """
+    Alters the columns of ``table`` to the types in ``column_types``,
+    rewriting the table once.
+    """
+    _alter_columns(database, table, {
+        column: (column_type['type'], _narrow_expression(column_type))
+        for column, column_type in column_types.items()
+    })
+
+
+def widen_columns(database, table, column_types):
+    """
+    Alters the columns in ``column_types`` back to the types that their
+    UCR data types map to.
+    """
+    _alter_columns(database, table, {
+        column: (
+            WIDE_TYPES[column_type['type']],
+            _widen_expression(column_type),
+        )
+        for column, column_type in column_types.items()
+    })
+
+
+def _alter_columns(database, table, columns):
+    if not columns:
+        return
+    with (
+        database.get_sqla_engine_with_context() as engine,
+        engine.begin() as connection
+    ):
+        preparer = engine.dialect.identifier_preparer
+        clauses = ', '.join(
+            f"ALTER COLUMN {preparer.quote(column)} TYPE {sql_type} "
+            f"USING {expression.format(column=preparer.quote(column))}"
+            for column, (sql_type, expression) in columns.items()
+        )
+        connection.execute(text(
+            f"ALTER TABLE {quote_table(preparer, table)} {clauses}"
+        ))
+
+
+def _narrow_expression(column_type):
+    if column_type['type'] == 'boolean':
+        return (
+            f"CASE {{column}} "
+            f"WHEN {_quote_literal(column_type['true'])} THEN true "
+            f"WHEN {_quote_literal(column_type['false'])} THEN false END"
+        )
+    return f"{{column}}::{column_type['type']}"
+
+
+def _widen_expression(column_type):
+    if column_type['type'] == 'boolean':
+        return (
+            f"CASE WHEN {{column}} THEN {_quote_literal(column_type['true'])} "
+            f"WHEN NOT {{column}} THEN {_quote_literal(column_type['false'])} "
+            "END"
+        )
+    return f"{{column}}::{WIDE_TYPES[column_type['type']]}"
+
+
+def _quote_literal(value):
+    """
+    >>> print(_quote_literal("it's"))
+    'it''s'
+
+    """
+    return "'{}'".format(value.replace("'", "''"))
+
+
+def get_column_types(sqla_table):
+    """
+    Returns the narrowed column types stored with a dataset.
+    """
+    return (
+        sqla_table.extra_dict
+        .get(IMPORT_METADATA_KEY, {})
+        .get(COLUMN_TYPES_KEY, {})
+    )
+
+
+def clear_column_types(sqla_table):
+    extra = sqla_table.extra_dict
+    extra.get(IMPORT_METADATA_KEY, {}).pop(COLUMN_TYPES_KEY, None)
+    sqla_table.extra = json.dumps(extra)
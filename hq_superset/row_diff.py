@@ -0,0 +1,94 @@
+"""
+Compares the rows that a dataset change writes for its documents with
+the rows that the table already has for them, so that only the
+difference is written.
+
+Replacing every row of a document deletes and inserts a tuple for each
+row, even if the row has not changed. Each deleted tuple is left for
+autovacuum, and both are written to the WAL. Rows that are the same
+are skipped instead, and rows that changed are updated in place.
+
+Existing rows are identified by ``(tableoid, ctid)``, because the
+``ctid`` of a row is only unique within its partition.
+"""
+from collections import defaultdict
+from dataclasses import dataclass, field
+from typing import Any
+
+from flask import current_app
+
+
+@dataclass
+class RowDiff:
+    # The number of rows that are the same
+    unchanged: int = 0
+    # The key of each row to update, and its changed values
+    updates: list[tuple[tuple, dict[str, Any]]] = field(default_factory=list)
+    inserts: list[dict[str, Any]] = field(default_factory=list)
+    # The keys of the rows to delete
+    deletes: list[tuple] = field(default_factory=list)
+
+
+def is_diff_apply_enabled():
+    return bool(current_app.config.get("HQ_DATASET_CHANGE_APPLY_DIFF"))
+
+
+def diff_rows(existing, incoming, column_names):
+    """
+    Returns the changes that turn the ``existing`` rows of some
+    documents into the ``incoming`` rows.
+
+    ``existing`` is a list of ``(key, row)`` pairs. Columns that are
+    missing from an incoming row are NULL, as they would be if the row
+    was inserted.
+
+    >>> existing = [
+    ...     (1, {'doc_id': 'a', 'n': 1}),
+    ...     (2, {'doc_id': 'a', 'n': 2}),
+    ...     (3, {'doc_id': 'b', 'n': 1}),
+    ... ]
+    >>> incoming = [{'doc_id': 'a', 'n': 2}, {'doc_id': 'a', 'n': 3}]
+    >>> diff_rows(existing, incoming, ['doc_id', 'n'])
+    RowDiff(unchanged=1, updates=[(1, {'n': 3})], inserts=[], deletes=[3])
+    """
+    diff = RowDiff()
+    existing_by_doc = defaultdict(list)
+    for key, row in existing:
+        existing_by_doc[row['doc_id']].append((key, row))
+    incoming_by_doc = defaultdict(list)
+    for row in incoming:
+        incoming_by_doc[row.get('doc_id')].append(row)
+
+    for doc_id in existing_by_doc.keys() | incoming_by_doc.keys():
+        # Match the rows that are the same first
+        unmatched = defaultdict(list)
+        for key, row in existing_by_doc.get(doc_id, []):
+            unmatched[_get_signature(row, column_names)].append((key, row))
+        new_rows = []
+        for row in incoming_by_doc.get(doc_id, []):
+            same = unmatched.get(_get_signature(row, column_names))
+            if same:
+                same.pop()
+                diff.unchanged += 1
+            else:
+                new_rows.append(row)
+        old_rows = [pair for pairs in unmatched.values() for pair in pairs]
+
+        # Update the rest in place, and insert or delete the rows left
+        # over
+        for (key, old_row), new_row in zip(old_rows, new_rows):
+            diff.updates.append((key, {
+                column: new_row.get(column)
+                for column in column_names
+                if new_row.get(column) != old_row[column]
+            }))
+        diff.inserts.extend(new_rows[len(old_rows):])
+        diff.deletes.extend(key for key, __ in old_rows[len(new_rows):])
+    return diff
+
+
+def _get_signature(row, column_names):
+    return tuple(
+        tuple(value) if isinstance(value, list) else value
+        for value in (row.get(column) for column in column_names)
+    )
@@ -1,18 +1,27 @@
+import json
 import logging
 import os
+import time
 import uuid
+from collections import namedtuple
+from contextlib import contextmanager
 from datetime import datetime
 
 import pandas
-import sqlalchemy
 import superset
+from datadog import statsd
 from flask import current_app, g, request
-from sqlalchemy.dialects import postgresql
 from superset import db
 from superset.connectors.sqla.models import SqlaTable
 from superset.extensions import cache_manager
 from superset.sql_parse import Table
 
+from hq_superset.change_log import (
+    replay_recorded_changes,
+    start_recording_changes,
+    stop_recording_changes,
+)
+from hq_superset.const import IMPORT_METADATA_KEY
 from hq_superset.exceptions import HQAPIException
 from hq_superset.hq_requests import HQRequest
 from hq_superset.hq_url import (
@@ -21,23 +30,96 @@ from hq_superset.hq_url import (
     datasource_subscribe,
     datasource_unsubscribe,
 )
+from hq_superset.import_cost import record_import_throughput
+from hq_superset.ingest import (
+    DEFAULT_MEMORY_BUDGET_BYTES,
+    AdaptiveChunker,
+    estimate_row_bytes,
+    read_export,
+)
+from hq_superset.loaders import (
+    analyze_table,
+    create_indexes,
+    create_partitions,
+    drop_table,
+    get_dataframe_loader,
+    get_table_months,
+    get_row_count_and_max,
+    get_staging_table,
+    is_partitioned,
+    merge_staging_table,
+    set_table_logged,
+    swap_staging_table,
+)
+from hq_superset.metrics import PhaseTimer, get_tags
 from hq_superset.models import OAuth2Client
+from hq_superset.profiling import (
+    COLUMN_TYPES_KEY,
+    ColumnProfiler,
+    narrow_columns,
+    widen_columns,
+)
+from hq_superset.snapshots import (
+    apply_snapshot_retention,
+    get_snapshot_max_bytes,
+    get_snapshot_writer,
+    is_snapshot_file,
+    is_snapshot_partitioned,
+    read_snapshot,
+    remove_snapshot,
+)
+from hq_superset.table_cache import invalidate_table
 from hq_superset.utils import (
-    convert_to_array,
+    convert_array_column,
     generate_secret,
     get_column_dtypes,
+    get_datasource_defn_hash,
     get_datasource_file,
+    get_datasource_file_hash,
+    get_datasource_file_size,
+    get_eta_seconds,
     get_hq_database,
     get_schema_name_for_domain,
-    parse_date,
+    get_sql_dtypes,
+    parse_date_columns,
 )
 
 logger = logging.getLogger(__name__)
 
+EXPORT_DOWNLOAD_BLOCK_SIZE = 1024 * 1024  # 1MB
 
-def download_and_subscribe_to_datasource(domain, datasource_id):
-    hq_request = HQRequest(url=datasource_export(domain, datasource_id))
-    response = hq_request.get()
+DatasourceExport = namedtuple(
+    'DatasourceExport', ['path', 'size', 'content_hash']
+)
+
+
+def download_and_subscribe_to_datasource(
+    domain,
+    datasource_id,
+    inserted_after=None,
+):
+    """
+    Downloads the UCR export of the datasource, and subscribes to its
+    changes. Returns a ``DatasourceExport``.
+    """
+    export = download_datasource(domain, datasource_id, inserted_after)
+    subscribe_to_hq_datasource(domain, datasource_id)
+    return export
+
+
+def download_datasource(domain, datasource_id, inserted_after=None):
+    """
+    Downloads the UCR export of the datasource. If ``inserted_after``
+    is given, only rows inserted since then are exported.
+
+    Returns a ``DatasourceExport``. Its ``content_hash`` is the hash of
+    the data in the export, so that unchanged exports can be skipped.
+    Incremental exports are not compared, so they are not hashed.
+    """
+    hq_request = HQRequest(
+        url=datasource_export(domain, datasource_id, inserted_after)
+    )
+    response = hq_request.get(stream=True)
 
     if response.status_code != 200:
         raise HQAPIException("Error downloading the UCR export from HQ")
@@ -51,12 +133,65 @@ def download_and_subscribe_to_datasource(domain, datasource_id):
     if not os.path.exists(directory):
         os.makedirs(directory)
 
-    with open(path, "wb") as f:
-        f.write(response.content)
+    size = _write_export(response, path, datasource_id)
+    content_hash = None
+    if inserted_after is None:
+        content_hash = get_datasource_file_hash(path)
 
-    subscribe_to_hq_datasource(domain, datasource_id)
+    return DatasourceExport(path, size, content_hash)
+
+
+def _write_export(response, path, datasource_id):
+    """
+    Streams the body of ``response`` to ``path`` in fixed-size blocks,
+    and returns the number of bytes written.
 
-    return path, len(response.content)
+    The export is written to a temporary file which is renamed to
+    ``path`` when the download is complete, so that a partial download
+    never looks like a complete export.
+    """
+    max_size = current_app.config.get("HQ_DATASOURCE_EXPORT_MAX_BYTES")
+    too_large = HQAPIException(
+        f"The UCR export is larger than the limit of {max_size} bytes"
+    )
+    temp_path = f"{path}.part"
+    size = 0
+    start = time.monotonic()
+    try:
+        content_length = int(response.headers.get("Content-Length") or 0)
+        if max_size and content_length > max_size:
+            raise too_large
+        with open(temp_path, "wb") as f:
+            for block in response.iter_content(
+                chunk_size=EXPORT_DOWNLOAD_BLOCK_SIZE
+            ):
+                size += len(block)
+                if max_size and size > max_size:
+                    raise too_large
+                f.write(block)
+        os.replace(temp_path, path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+    finally:
+        response.close()
+
+    seconds = time.monotonic() - start
+    bytes_per_second = size / seconds if seconds else 0.0
+    statsd.gauge(
+        'cca.import.download.bytes_per_second',
+        bytes_per_second,
+        tags=get_tags({"datasource": datasource_id}),
+    )
+    logger.info(
+        "Downloaded %s bytes of %s in %.2fs (%.0f bytes/s)",
+        size,
+        datasource_id,
+        seconds,
+        bytes_per_second,
+    )
+    return size
 
 
 def get_datasource_defn(domain, datasource_id):
@@ -77,74 +212,290 @@ def refresh_hq_datasource(
     file_path,
     datasource_defn,
     user_id=None,
+    incremental=False,
+    content_hash=None,
+    resumable=False,
 ):
     """
     Pulls the data from CommCare HQ and creates/replaces the
     corresponding Superset dataset.
 
+    Data is loaded into a staging table, which replaces the existing
+    table only once all the data has been loaded. If ``incremental`` is
+    True, the file only contains rows inserted since the last import,
+    and the staged rows are merged into the existing table instead.
+
+    ``content_hash`` is stored with the dataset, for
+    ``is_export_unchanged()`` to compare with later exports.
+
+    If ``resumable`` is True, as it is for background imports, progress
+    and a checkpoint are saved after each chunk is loaded. If the import
+    is interrupted, calling this function again with the same file
+    skips the rows that are already in the staging table.
+
+    If ``HQ_IMPORT_UNLOGGED_STAGING`` is set, the staging table is
+    loaded UNLOGGED, and set logged once it is complete. Indexes are
+    built after the data is loaded, and the table is analyzed before
+    the dataset's metadata is fetched. The time spent in each phase is
+    reported as "cca.import.phase_seconds".
+
+    A full import of an export of at least
+    ``HQ_DATASOURCE_PARTITION_MIN_BYTES`` creates a table partitioned
+    by month of ``inserted_at``. Incremental imports into a partitioned
+    table create the partitions for the months of their rows.
+
+    If ``HQ_IMPORT_NARROW_COLUMN_TYPES`` is set, each chunk is profiled
+    to choose narrower column types (see ``hq_superset.profiling``).
+    Incremental imports widen the columns whose new rows do not fit.
+
+    If snapshots are enabled, a full import also writes a Parquet
+    snapshot of the export, and the file path can be a copy of a
+    snapshot (see ``copy_snapshot()``) to rebuild the table from it.
+    Other imports remove the snapshot, which would otherwise be
+    missing their rows.
+
+    Changes to the datasource that arrive during the import are
+    recorded, and replayed onto the staging table before it is swapped
+    in, or onto the live table after the staged rows are merged into it
+    (see ``hq_superset.change_log``).
+
     The file on the file path passed is not removed and
     should be done outside this function.
     """
     # See `CsvToDatabaseView.form_post()` in
     # https://github.com/apache/superset/blob/master/superset/views/database/views.py
 
-    def dataframe_to_sql(df, replace=False):
-        """
-        Upload Pandas DataFrame ``df`` to ``database``.
-        """
-        database.db_engine_spec.df_to_sql(
-            database,
-            csv_table,
-            df,
-            to_sql_kwargs={
-                "if_exists": "replace" if replace else "append",
-                "dtype": sql_converters,
-                "index": False,
-            },
-        )
-
     database = get_hq_database()
     schema = get_schema_name_for_domain(domain)
     csv_table = Table(table=datasource_id, schema=schema)
+    staging_table = get_staging_table(csv_table)
     column_dtypes, date_columns, array_columns = get_column_dtypes(
         datasource_defn
     )
-    converters = {
-        column_name: convert_to_array for column_name in array_columns
-    }
-    sql_converters = {
-        # Assumes all array values will be of type TEXT
-        column_name: postgresql.ARRAY(sqlalchemy.types.TEXT)
-        for column_name in array_columns
-    }
+    # Date and array columns are read as strings, and converted a
+    # column at a time
+    column_dtypes.update({
+        column_name: 'string'
+        for column_name in date_columns + array_columns
+    })
+    sql_dtypes = get_sql_dtypes(datasource_defn)
+    # Incremental imports merge the staging table into the live table,
+    # so only a full import's staging table needs to be set logged
+    unlogged = bool(current_app.config.get("HQ_IMPORT_UNLOGGED_STAGING"))
+    partition_column = None
+    if not incremental and should_partition(file_path):
+        partition_column = 'inserted_at'
+    loader = get_dataframe_loader(
+        database,
+        staging_table,
+        sql_dtypes,
+        get_loader_workers(),
+        unlogged,
+        partition_column,
+    )
+    timer = PhaseTimer(
+        'cca.import.phase_seconds', {"datasource": datasource_id}
+    )
+    chunker = AdaptiveChunker(
+        get_memory_budget() // loader.chunks_in_memory,
+        estimate_row_bytes(column_dtypes, date_columns, array_columns),
+    )
+    unparseable_date_count = 0
+    max_inserted_at = None
+    decoded_arrays = {column_name: {} for column_name in array_columns}
+    import_helper = (
+        AsyncImportHelper(domain, datasource_id) if resumable else None
+    )
+    # Chunks loaded in parallel are not committed in order, so the
+    # import cannot be resumed from the rows in the staging table
+    use_checkpoints = bool(import_helper) and loader.commits_in_order
+    resume_from = 0
+    if use_checkpoints and import_helper.has_checkpoint(file_path):
+        # Chunks are committed one at a time, so the staging table,
+        # not the checkpoint, says how many rows have been loaded
+        resume_from, max_inserted_at = get_row_count_and_max(
+            database, staging_table, 'inserted_at'
+        )
+        logger.info(
+            "Resuming the import of %s after %s rows",
+            datasource_id,
+            resume_from,
+        )
+    # Incremental imports must profile their rows if the table has
+    # narrowed columns, to check that the rows fit
+    narrowed_column_types = {}
+    if incremental:
+        narrowed_column_types = (
+            _get_import_metadata(domain, datasource_id, datasource_defn) or {}
+        ).get(COLUMN_TYPES_KEY, {})
+    profiler = None
+    if not resume_from and (
+        narrowed_column_types
+        or current_app.config.get("HQ_IMPORT_NARROW_COLUMN_TYPES")
+    ):
+        profiler = ColumnProfiler.for_datasource(datasource_defn)
+    from_snapshot = is_snapshot_file(file_path)
+    snapshot_writer = None
+    if not (incremental or resume_from or from_snapshot):
+        snapshot_writer = get_snapshot_writer(
+            domain,
+            datasource_id,
+            datasource_defn,
+            display_name,
+            content_hash,
+            partitioned=partition_column is not None,
+        )
+
+    def convert_columns(df):
+        nonlocal unparseable_date_count, max_inserted_at
+        if snapshot_writer:
+            # Chunks are converted in place, so they are written to the
+            # snapshot as they were parsed
+            snapshot_writer.write(df)
+        unparseable_date_count += parse_date_columns(df, date_columns)
+        chunk_max_inserted_at = df['inserted_at'].max()
+        if not pandas.isna(chunk_max_inserted_at) and (
+            max_inserted_at is None
+            or chunk_max_inserted_at > max_inserted_at
+        ):
+            max_inserted_at = chunk_max_inserted_at
+        for column_name in array_columns:
+            df[column_name] = convert_array_column(
+                df[column_name],
+                decoded_arrays[column_name],
+            )
+        if profiler:
+            profiler.observe(df)
+        return df
+
+    def load_chunk(df, replace=False):
+        df = convert_columns(df)
+        loader.load(df, replace=replace)
+        # Observed after the load, so that the memory taken by the CSV
+        # that is copied to the database is counted
+        chunker.observe(df)
+
+    def chunk_loaded(csv_file, total_bytes):
+        row_count = resume_from + loader.row_count
+        if use_checkpoints:
+            import_helper.save_checkpoint(file_path, row_count)
+        import_helper.set_progress(
+            'loading',
+            rows=row_count,
+            bytes_read=csv_file.tell(),
+            total_bytes=total_bytes,
+        )
 
     try:
-        with get_datasource_file(file_path) as csv_file:
-            dataframes = pandas.read_csv(
-                chunksize=10000,
-                filepath_or_buffer=csv_file,
-                encoding="utf-8",
-                parse_dates=date_columns,
-                date_parser=parse_date,
-                keep_default_na=True,
-                dtype=column_dtypes,
-                converters=converters,
-                iterator=True,
-                low_memory=True,
+        # Recording usually starts before the export is downloaded
+        start_recording_changes(datasource_id, restart=False)
+        if import_helper:
+            import_helper.start_progress()
+        timer.start('load')
+        with open_export(
+            file_path, column_dtypes, chunker, resume_from
+        ) as (csv_file, dataframes):
+            total_bytes = (
+                get_export_file_size(file_path) if import_helper else None
             )
-            dataframe_to_sql(next(dataframes), replace=True)
+            if not resume_from:
+                load_chunk(next(dataframes), replace=True)
+                if import_helper:
+                    chunk_loaded(csv_file, total_bytes)
             for df in dataframes:
-                dataframe_to_sql(df, replace=False)
-
-        sqla_table = (
-            db.session.query(SqlaTable)
-            .filter_by(
-                table_name=datasource_id,
-                schema=csv_table.schema,
-                database_id=database.id,
+                load_chunk(df)
+                if import_helper:
+                    chunk_loaded(csv_file, total_bytes)
+        loader.wait()
+        loader.report_throughput(datasource_id)
+        chunker.report(datasource_id)
+        if unparseable_date_count:
+            logger.warning(
+                "%s values in date columns of %s could not be parsed",
+                unparseable_date_count,
+                datasource_id,
             )
-            .one_or_none()
-        )
+            statsd.increment(
+                'cca.import.unparseable_dates',
+                unparseable_date_count,
+                tags=get_tags({"datasource": datasource_id}),
+            )
+        if import_helper:
+            import_helper.set_progress(
+                'indexing', rows=resume_from + loader.row_count
+            )
+        index_columns = get_index_columns()
+        column_types = {}
+        if incremental:
+            timer.start('narrow')
+            # A resumed import has not profiled all of its rows
+            unfit_columns = (
+                profiler.get_unfit_columns(narrowed_column_types)
+                if profiler else list(narrowed_column_types)
+            )
+            widen_columns(database, csv_table, {
+                column: narrowed_column_types[column]
+                for column in unfit_columns
+            })
+            column_types = {
+                column: column_type
+                for column, column_type in narrowed_column_types.items()
+                if column not in unfit_columns
+            }
+            # The staged rows are inserted into the live table
+            narrow_columns(database, staging_table, column_types)
+            timer.start('merge')
+            if is_partitioned(database, csv_table):
+                create_partitions(
+                    database,
+                    csv_table,
+                    'inserted_at',
+                    get_table_months(database, staging_table, 'inserted_at'),
+                )
+            merge_staging_table(
+                database,
+                csv_table,
+                staging_table,
+                after_merge=lambda connection: replay_recorded_changes(
+                    connection, datasource_id, csv_table, column_types
+                ),
+            )
+            # Tables imported before indexes were added need them too
+            timer.start('index')
+            create_indexes(
+                database, csv_table, index_columns, concurrently=True
+            )
+        else:
+            if profiler:
+                timer.start('narrow')
+                column_types = profiler.get_column_types()
+                narrow_columns(database, staging_table, column_types)
+            # Setting a table logged rewrites it and its indexes, so
+            # indexes are only built after it
+            if loader.unlogged:
+                timer.start('set_logged')
+                set_table_logged(database, staging_table)
+            timer.start('index')
+            create_indexes(database, staging_table, index_columns)
+            timer.start('swap')
+            swap_staging_table(
+                database,
+                csv_table,
+                staging_table,
+                index_columns,
+                before_swap=lambda connection: replay_recorded_changes(
+                    connection, datasource_id, staging_table, column_types
+                ),
+            )
+        timer.start('analyze')
+        analyze_table(database, csv_table)
+
+        if import_helper:
+            import_helper.set_progress(
+                'updating_metadata', rows=resume_from + loader.row_count
+            )
+        timer.start('metadata')
+        sqla_table = get_sqla_table(database, csv_table)
         if sqla_table:
             sqla_table.description = display_name
             sqla_table.fetch_metadata()
@@ -164,12 +515,193 @@ def refresh_hq_datasource(
             sqla_table.schema = csv_table.schema
             sqla_table.fetch_metadata()
             db.session.add(sqla_table)
+        _set_import_metadata(
+            sqla_table,
+            datasource_defn,
+            max_inserted_at,
+            incremental,
+            content_hash,
+            column_types,
+        )
         db.session.commit()
+        # Dataset changes must not be applied to the replaced table, or
+        # with the column types it had before
+        invalidate_table(datasource_id)
+        stop_recording_changes(datasource_id)
+        timer.report()
+        if not resume_from:
+            # Date and array columns are in ``column_dtypes`` too
+            record_import_throughput(
+                loader.row_count,
+                len(column_dtypes),
+                sum(timer.seconds.values()),
+            )
+        if snapshot_writer:
+            snapshot_writer.commit()
+            apply_snapshot_retention(get_snapshot_max_bytes())
+        elif not from_snapshot:
+            remove_snapshot(domain, datasource_id)
+        if import_helper:
+            import_helper.clear_checkpoint()
+            import_helper.clear_progress()
     except Exception as ex:  # pylint: disable=broad-except
         db.session.rollback()
+        # The table may have been swapped or altered before the error
+        invalidate_table(datasource_id)
+        stop_recording_changes(datasource_id)
+        loader.cancel()
+        if snapshot_writer:
+            snapshot_writer.abort()
+        drop_table(database, staging_table)
+        if import_helper:
+            import_helper.clear_checkpoint()
+            import_helper.clear_progress()
         raise ex
 
 
+@contextmanager
+def open_export(file_path, column_dtypes, chunker, skip_rows=0):
+    """
+    Opens a downloaded export, or a copy of a snapshot, and yields the
+    open file and an iterator of its chunks.
+    """
+    if is_snapshot_file(file_path):
+        with open(file_path, 'rb') as f:
+            yield f, read_snapshot(f, chunker.chunk_size, skip_rows)
+    else:
+        with get_datasource_file(file_path) as csv_file:
+            yield csv_file, read_export(
+                csv_file,
+                column_dtypes,
+                chunker,
+                skip_rows,
+                engine=current_app.config.get("HQ_IMPORT_CSV_ENGINE"),
+            )
+
+
+def get_export_file_size(file_path):
+    if is_snapshot_file(file_path):
+        return os.path.getsize(file_path)
+    return get_datasource_file_size(file_path)
+
+
+def get_memory_budget():
+    return (
+        current_app.config.get("HQ_IMPORT_MEMORY_BUDGET_BYTES")
+        or DEFAULT_MEMORY_BUDGET_BYTES
+    )
+
+
+def should_partition(file_path):
+    """
+    Returns whether to partition the table that ``file_path`` is
+    imported into. A snapshot is partitioned like the import that wrote
+    it, because its compressed size cannot be compared with
+    ``HQ_DATASOURCE_PARTITION_MIN_BYTES``.
+    """
+    if is_snapshot_file(file_path):
+        return is_snapshot_partitioned(file_path)
+    min_bytes = current_app.config.get("HQ_DATASOURCE_PARTITION_MIN_BYTES")
+    return bool(min_bytes) and get_datasource_file_size(file_path) >= min_bytes
+
+
+def get_loader_workers():
+    return current_app.config.get("HQ_IMPORT_LOADER_WORKERS") or 1
+
+
+def get_index_columns():
+    """
+    Returns the columns to index on imported tables. ``doc_id`` is
+    always indexed, because ``DataSetChange`` looks up rows by it.
+    """
+    configured = current_app.config.get("HQ_DATASOURCE_INDEX_COLUMNS") or []
+    return ['doc_id'] + [
+        column for column in configured if column != 'doc_id'
+    ]
+
+
+def get_sqla_table(database, table):
+    return (
+        db.session.query(SqlaTable)
+        .filter_by(
+            table_name=table.table,
+            schema=table.schema,
+            database_id=database.id,
+        )
+        .one_or_none()
+    )
+
+
+def get_incremental_watermark(domain, datasource_id, datasource_defn):
+    """
+    Returns the latest ``inserted_at`` value of the rows imported so
+    far, or None if the datasource must be imported in full because it
+    has not been imported, or its definition has changed since.
+    """
+    metadata = _get_import_metadata(domain, datasource_id, datasource_defn)
+    if not metadata:
+        return None
+    inserted_at = metadata.get('inserted_at')
+    return datetime.fromisoformat(inserted_at) if inserted_at else None
+
+
+def is_export_unchanged(domain, datasource_id, datasource_defn, content_hash):
+    """
+    Returns True if the last import of the datasource was a full
+    import of an export with the same data and definition.
+    """
+    metadata = _get_import_metadata(domain, datasource_id, datasource_defn)
+    return bool(metadata) and metadata.get('content_hash') == content_hash
+
+
+def _get_import_metadata(domain, datasource_id, datasource_defn):
+    """
+    Returns the metadata of the last import of the datasource, or None
+    if it has not been imported, or its definition has changed since.
+    """
+    table = Table(
+        table=datasource_id,
+        schema=get_schema_name_for_domain(domain),
+    )
+    sqla_table = get_sqla_table(get_hq_database(), table)
+    if not sqla_table:
+        return None
+    metadata = sqla_table.extra_dict.get(IMPORT_METADATA_KEY, {})
+    if metadata.get('definition_hash') != get_datasource_defn_hash(
+        datasource_defn
+    ):
+        return None
+    return metadata
+
+
+def _set_import_metadata(
+    sqla_table,
+    datasource_defn,
+    inserted_at,
+    incremental,
+    content_hash,
+    column_types=None,
+):
+    extra = sqla_table.extra_dict
+    # A full import starts over. An incremental import keeps the
+    # watermark if it found no new rows.
+    metadata = extra.get(IMPORT_METADATA_KEY, {}) if incremental else {}
+    metadata['definition_hash'] = get_datasource_defn_hash(datasource_defn)
+    if inserted_at is not None:
+        metadata['inserted_at'] = inserted_at.isoformat()
+    if incremental:
+        # The table no longer matches the last full export
+        metadata.pop('content_hash', None)
+    elif content_hash:
+        metadata['content_hash'] = content_hash
+    if column_types:
+        metadata[COLUMN_TYPES_KEY] = column_types
+    else:
+        metadata.pop(COLUMN_TYPES_KEY, None)
+    extra[IMPORT_METADATA_KEY] = metadata
+    sqla_table.extra = json.dumps(extra)
+
+
 def subscribe_to_hq_datasource(domain, datasource_id):
     client = _get_or_create_oauth2client(domain)
     hq_request = HQRequest(url=datasource_subscribe(domain, datasource_id))
@@ -276,6 +808,72 @@ class AsyncImportHelper:
 
     def mark_as_in_progress(self, task_id):
         cache_manager.cache.set(self.progress_key, task_id)
+        self.start_progress('queued')
 
     def mark_as_complete(self):
         cache_manager.cache.delete(self.progress_key)
+
+    @property
+    def checkpoint_key(self):
+        return f"{self.domain}_{self.datasource_id}_import_checkpoint"
+
+    def has_checkpoint(self, export_path):
+        checkpoint = cache_manager.cache.get(self.checkpoint_key)
+        return bool(checkpoint) and checkpoint['export_path'] == export_path
+
+    def save_checkpoint(self, export_path, row_count):
+        # Keep the checkpoint for as long as the export is kept
+        timeout = superset.config.REMOVE_SHARED_FILES_AFTER * 86400
+        cache_manager.cache.set(
+            self.checkpoint_key,
+            {'export_path': export_path, 'row_count': row_count},
+            timeout=timeout,
+        )
+
+    def clear_checkpoint(self):
+        cache_manager.cache.delete(self.checkpoint_key)
+
+    @property
+    def progress_data_key(self):
+        return f"{self.domain}_{self.datasource_id}_import_progress"
+
+    def get_progress(self):
+        """
+        Returns a dict of the stage of the import, the rows loaded and
+        bytes of the export read so far, when the import started, and
+        an estimate of the seconds left, or None.
+        """
+        return cache_manager.cache.get(self.progress_data_key)
+
+    def start_progress(self, stage='starting'):
+        self._save_progress({
+            'stage': stage,
+            'rows': 0,
+            'bytes_read': 0,
+            'total_bytes': None,
+            'started_at': time.time(),
+            'eta_seconds': None,
+        })
+
+    def set_progress(self, stage, rows=0, bytes_read=None, total_bytes=None):
+        progress = self.get_progress() or {'started_at': time.time()}
+        progress.update({'stage': stage, 'rows': rows})
+        if bytes_read is not None:
+            progress['bytes_read'] = bytes_read
+        if total_bytes is not None:
+            progress['total_bytes'] = total_bytes
+        progress['eta_seconds'] = get_eta_seconds(
+            time.time() - progress['started_at'],
+            progress.get('bytes_read'),
+            progress.get('total_bytes'),
+        )
+        self._save_progress(progress)
+
+    def clear_progress(self):
+        cache_manager.cache.delete(self.progress_data_key)
+
+    def _save_progress(self, progress):
+        timeout = superset.config.REMOVE_SHARED_FILES_AFTER * 86400
+        cache_manager.cache.set(
+            self.progress_data_key, progress, timeout=timeout
+        )
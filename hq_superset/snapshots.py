@@ -0,0 +1,227 @@
+"""
+Parquet snapshots of imported UCR exports, for rebuilding a table
+without downloading its export from CommCare HQ again.
+
+A snapshot holds the rows of the last full import of a datasource as
+they were parsed, before date and array columns were converted, along
+with the datasource definition needed to import them again, and
+whether the import partitioned its table.
+"""
+import json
+import logging
+import os
+import uuid
+from collections import namedtuple
+
+import pyarrow
+import superset
+from flask import current_app
+from pyarrow import parquet
+
+from hq_superset.ingest import PANDAS_DTYPES
+
+logger = logging.getLogger(__name__)
+
+SNAPSHOT_DIRNAME = 'snapshots'
+SNAPSHOT_SUFFIX = '.parquet'
+SNAPSHOT_METADATA_KEY = b'hq_snapshot'
+
+Snapshot = namedtuple(
+    'Snapshot',
+    ['path', 'size', 'datasource_defn', 'display_name', 'content_hash'],
+)
+
+
+class SnapshotWriter:
+    """
+    Writes the chunks of an export to a snapshot.
+
+    Chunks are written to a temporary file, which replaces the
+    snapshot when the import is committed, so that a failed import
+    leaves the last snapshot in place.
+    """
+
+    def __init__(self, path, datasource_defn, display_name, content_hash,
+                 partitioned=False):
+        self.path = path
+        self.temp_path = f"{path}.part"
+        self.metadata = {
+            SNAPSHOT_METADATA_KEY: json.dumps({
+                'datasource_defn': datasource_defn,
+                'display_name': display_name,
+                'content_hash': content_hash,
+                'partitioned': partitioned,
+            })
+        }
+        self._schema = None
+        self._writer = None
+
+    def write(self, df):
+        """
+        Appends ``df``, a chunk as it was parsed, to the snapshot. The
+        schema of the snapshot is taken from the first chunk.
+        """
+        if self._writer is None:
+            self._schema = pyarrow.Schema.from_pandas(
+                df, preserve_index=False
+            ).with_metadata(self.metadata)
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            self._writer = parquet.ParquetWriter(self.temp_path, self._schema)
+        self._writer.write_table(
+            pyarrow.Table.from_pandas(
+                df, schema=self._schema, preserve_index=False
+            )
+        )
+
+    def commit(self):
+        if self._writer is None:
+            return
+        self._writer.close()
+        os.replace(self.temp_path, self.path)
+
+    def abort(self):
+        if self._writer is None:
+            return
+        self._writer.close()
+        if os.path.exists(self.temp_path):
+            os.remove(self.temp_path)
+
+
+def get_snapshot_dir():
+    return os.path.join(superset.config.SHARED_DIR, SNAPSHOT_DIRNAME)
+
+
+def get_snapshot_path(domain, datasource_id):
+    return os.path.join(
+        get_snapshot_dir(), domain, f"{datasource_id}{SNAPSHOT_SUFFIX}"
+    )
+
+
+def get_snapshot_max_bytes():
+    """
+    Returns the most bytes that snapshots may take up in total. If it
+    is 0, snapshots are not written.
+    """
+    return current_app.config.get("HQ_DATASOURCE_SNAPSHOTS_MAX_BYTES") or 0
+
+
+def is_snapshot_file(path):
+    return path.endswith(SNAPSHOT_SUFFIX)
+
+
+def get_snapshot_writer(domain, datasource_id, datasource_defn, display_name,
+                        content_hash, partitioned=False):
+    """
+    Returns a ``SnapshotWriter`` for the datasource, or None if
+    snapshots are disabled.
+    """
+    if not get_snapshot_max_bytes():
+        return None
+    return SnapshotWriter(
+        get_snapshot_path(domain, datasource_id),
+        datasource_defn,
+        display_name,
+        content_hash,
+        partitioned,
+    )
+
+
+def get_snapshot(domain, datasource_id):
+    """
+    Returns the ``Snapshot`` of the datasource, or None if there is
+    none.
+    """
+    path = get_snapshot_path(domain, datasource_id)
+    try:
+        metadata = _read_metadata(path)
+        size = os.path.getsize(path)
+    except (OSError, pyarrow.ArrowInvalid):
+        return None
+    return Snapshot(
+        path,
+        size,
+        metadata['datasource_defn'],
+        metadata['display_name'],
+        metadata['content_hash'],
+    )
+
+
+def is_snapshot_partitioned(path):
+    """
+    Returns whether the import that wrote the snapshot at ``path``
+    partitioned its table.
+    """
+    return bool(_read_metadata(path).get('partitioned'))
+
+
+def _read_metadata(path):
+    schema = parquet.read_schema(path)
+    return json.loads((schema.metadata or {})[SNAPSHOT_METADATA_KEY])
+
+
+def has_snapshot(domain, datasource_id):
+    return os.path.exists(get_snapshot_path(domain, datasource_id))
+
+
+def copy_snapshot(snapshot):
+    """
+    Links the snapshot into ``SHARED_DIR`` like a downloaded export,
+    so that it can be imported, and removed after, without affecting
+    the snapshot or snapshots written in the meantime.
+    """
+    path = os.path.join(
+        superset.config.SHARED_DIR, f"{uuid.uuid4().hex}{SNAPSHOT_SUFFIX}"
+    )
+    os.link(snapshot.path, path)
+    return path
+
+
+def remove_snapshot(domain, datasource_id):
+    path = get_snapshot_path(domain, datasource_id)
+    if os.path.exists(path):
+        os.remove(path)
+
+
+def read_snapshot(file, chunk_size, skip_rows=0):
+    """
+    Yields DataFrames of ``chunk_size`` rows from the snapshot in
+    ``file``, with the dtypes they were parsed with. The first
+    ``skip_rows`` rows are skipped.
+
+    A snapshot with no rows yields one empty DataFrame.
+    """
+    parquet_file = parquet.ParquetFile(file)
+    empty = True
+    for batch in parquet_file.iter_batches(batch_size=chunk_size):
+        if skip_rows >= batch.num_rows:
+            skip_rows -= batch.num_rows
+            continue
+        batch = batch.slice(skip_rows)
+        skip_rows = 0
+        empty = False
+        yield batch.to_pandas(types_mapper=PANDAS_DTYPES.get)
+    if empty:
+        yield parquet_file.schema_arrow.empty_table().to_pandas(
+            types_mapper=PANDAS_DTYPES.get
+        )
+
+
+def apply_snapshot_retention(max_bytes):
+    """
+    Removes the least recently written snapshots until all snapshots
+    take up no more than ``max_bytes``.
+    """
+    snapshots = []
+    for dirpath, __, filenames in os.walk(get_snapshot_dir()):
+        for filename in filenames:
+            if is_snapshot_file(filename):
+                stat = os.stat(os.path.join(dirpath, filename))
+                snapshots.append(
+                    (stat.st_mtime, stat.st_size, os.path.join(dirpath, filename))
+                )
+    total_bytes = 0
+    for __, size, path in sorted(snapshots, reverse=True):
+        total_bytes += size
+        if total_bytes > max_bytes:
+            logger.info("Removing snapshot %s to stay under %s bytes", path, max_bytes)
+            os.remove(path)
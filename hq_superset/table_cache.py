@@ -0,0 +1,60 @@
+"""
+Caches the tables that dataset changes are applied to, in each worker
+process, so that applying a change does not need to look up its
+dataset and reflect its table.
+
+Each datasource has a version in the cache that all processes share.
+It is replaced with a new, random version when the datasource's table
+is replaced, altered or deleted, which invalidates the table cached by
+every process. Checking the version costs one cache lookup per change.
+"""
+import uuid
+from collections import namedtuple
+
+from superset.extensions import cache_manager
+
+CachedTable = namedtuple('CachedTable', ['version', 'value'])
+
+# Cached values by data source ID
+_tables = {}
+
+
+def get_version_key(data_source_id):
+    return f"hq_table_version_{data_source_id}"
+
+
+def get_table_version(data_source_id):
+    return cache_manager.cache.get(get_version_key(data_source_id))
+
+
+def get_cached_table(data_source_id, resolve):
+    """
+    Returns the value cached for the table of ``data_source_id``, or
+    calls ``resolve()`` to get the value and caches it.
+    """
+    # The version is read before the table is resolved, so a table
+    # that is replaced in the meantime is resolved again next time
+    version = get_table_version(data_source_id)
+    cached = _tables.get(data_source_id)
+    if cached and cached.version == version:
+        return cached.value
+    value = resolve()
+    _tables[data_source_id] = CachedTable(version, value)
+    return value
+
+
+def invalidate_table(data_source_id):
+    """
+    Invalidates the table of ``data_source_id`` cached by all
+    processes. Call this after the table is replaced, altered or
+    deleted.
+    """
+    _tables.pop(data_source_id, None)
+    # A timeout of 0 keeps the version until the cache is cleared
+    cache_manager.cache.set(
+        get_version_key(data_source_id), uuid.uuid4().hex, timeout=0
+    )
+
+
+def clear_table_cache():
+    _tables.clear()
@@ -1,18 +1,49 @@
+import logging
 import os
 import superset
 import time
+from collections import defaultdict
+from datetime import datetime
 
+import pandas
+from flask import current_app
 from superset.extensions import celery_app
 
+from hq_superset.change_batches import (
+    apply_batch,
+    apply_dataset_changes,
+    get_batch_seconds,
+    get_batch_size,
+    get_queued_data_source_ids,
+    push_dataset_change,
+    push_dataset_changes,
+)
+from hq_superset.change_log import record_dataset_changes
+from hq_superset.const import DOMAIN_PREFIX
 from hq_superset.exceptions import TableMissing
+from hq_superset.loaders import (
+    create_partitions,
+    get_next_month,
+    get_partitioned_tables,
+    remove_partitions_before,
+)
 from hq_superset.models import DataSetChange
 from hq_superset.services import AsyncImportHelper, refresh_hq_datasource
+from hq_superset.utils import get_hq_database
 
+logger = logging.getLogger(__name__)
 
-@celery_app.task(name='refresh_hq_datasource_task')
-def refresh_hq_datasource_task(domain, datasource_id, display_name, export_path, datasource_defn, user_id):
+
+# If the worker is killed, the task is redelivered, and resumes the
+# import from its last checkpoint.
+@celery_app.task(
+    name='refresh_hq_datasource_task',
+    acks_late=True,
+    reject_on_worker_lost=True,
+)
+def refresh_hq_datasource_task(domain, datasource_id, display_name, export_path, datasource_defn, user_id, incremental=False, content_hash=None):
     try:
-        refresh_hq_datasource(domain, datasource_id, display_name, export_path, datasource_defn, user_id)
+        refresh_hq_datasource(domain, datasource_id, display_name, export_path, datasource_defn, user_id, incremental, content_hash, resumable=True)
     except Exception:
         AsyncImportHelper(domain, datasource_id).mark_as_complete()
         raise
@@ -30,6 +61,85 @@ def process_dataset_change(request_json):
         pass
 
 
+def queue_dataset_change(request_json):
+    """
+    Queues a change to be applied in a batch with other changes to its
+    datasource, or on its own if changes are not batched.
+    """
+    record_dataset_changes(request_json['data_source_id'], [request_json])
+    batch_seconds = get_batch_seconds()
+    if not batch_seconds:
+        process_dataset_change.delay(request_json)
+        return
+    length = push_dataset_change(request_json)
+    _schedule_dataset_changes(request_json['data_source_id'], length, 1)
+
+
+def queue_dataset_changes(request_jsons):
+    """
+    Queues changes that arrived together. The changes to each
+    datasource are pushed onto its list in one call, or, if changes are
+    not batched, are applied in order by one task for each batch.
+    """
+    changes_by_source = defaultdict(list)
+    for request_json in request_jsons:
+        changes_by_source[request_json['data_source_id']].append(request_json)
+
+    batch_seconds = get_batch_seconds()
+    batch_size = get_batch_size()
+    for data_source_id, changes in changes_by_source.items():
+        record_dataset_changes(data_source_id, changes)
+        if not batch_seconds:
+            for start in range(0, len(changes), batch_size):
+                process_dataset_change_batch.delay(
+                    changes[start:start + batch_size]
+                )
+            continue
+        length = push_dataset_changes(data_source_id, changes)
+        _schedule_dataset_changes(data_source_id, length, len(changes))
+
+
+def _schedule_dataset_changes(data_source_id, length, count):
+    """
+    Schedules the list of changes to the datasource to be applied,
+    after ``count`` changes were pushed onto it and it is ``length``
+    changes long.
+    """
+    previous_length = length - count
+    if previous_length < get_batch_size() <= length:
+        process_dataset_changes.delay(data_source_id)
+    elif previous_length == 0:
+        process_dataset_changes.apply_async(
+            (data_source_id,), countdown=get_batch_seconds()
+        )
+
+
+@celery_app.task(name='process_dataset_change_batch', ignore_result=True, store_errors_even_if_ignored=True)
+def process_dataset_change_batch(request_jsons):
+    apply_batch([DataSetChange(**request_json) for request_json in request_jsons])
+
+
+@celery_app.task(name='process_dataset_changes', ignore_result=True, store_errors_even_if_ignored=True)
+def process_dataset_changes(data_source_id):
+    if not apply_dataset_changes(data_source_id):
+        # Another worker is applying a batch. Try again after it.
+        process_dataset_changes.apply_async(
+            (data_source_id,), countdown=get_batch_seconds()
+        )
+
+
+@celery_app.task(name='drain_dataset_changes', ignore_result=True, store_errors_even_if_ignored=True)
+def drain_dataset_changes():
+    """
+    Schedules the changes of every datasource that has changes waiting
+    to be applied. A list is only scheduled when changes are pushed onto
+    it, so a list whose task was lost would otherwise wait for the next
+    change, or forever.
+    """
+    for data_source_id in get_queued_data_source_ids():
+        process_dataset_changes.delay(data_source_id)
+
+
 @celery_app.task(name='delete_redundant_shared_files')
 def delete_redundant_shared_files():
     """
@@ -45,3 +155,52 @@ def delete_redundant_shared_files():
         if os.stat(file_path).st_mtime < redundant_timestamp:
             if os.path.isfile(file_path):
                 os.remove(file_path)
+
+
+@celery_app.task(name='maintain_datasource_partitions')
+def maintain_datasource_partitions():
+    """
+    Creates this month's and next month's partitions of partitioned
+    datasource tables ahead of time, so that new rows are not stored
+    in their default partitions.
+
+    If HQ_DATASOURCE_PARTITION_RETENTION_MONTHS is set, partitions of
+    older months are detached, or dropped if
+    HQ_DATASOURCE_PARTITION_DROP_EXPIRED is set.
+
+    A table that fails is logged and skipped, so that the rest are
+    still maintained.
+    """
+    database = get_hq_database()
+    this_month = datetime.now().replace(
+        day=1, hour=0, minute=0, second=0, microsecond=0
+    )
+    retention_months = current_app.config.get(
+        "HQ_DATASOURCE_PARTITION_RETENTION_MONTHS"
+    )
+    for table in get_partitioned_tables(database, DOMAIN_PREFIX):
+        try:
+            create_partitions(
+                database,
+                table,
+                'inserted_at',
+                {this_month, get_next_month(this_month)},
+            )
+            if retention_months:
+                remove_partitions_before(
+                    database,
+                    table,
+                    (
+                        pandas.Timestamp(this_month)
+                        - pandas.DateOffset(months=retention_months)
+                    ).to_pydatetime(),
+                    drop=bool(current_app.config.get(
+                        "HQ_DATASOURCE_PARTITION_DROP_EXPIRED"
+                    )),
+                )
+        except Exception:
+            logger.exception(
+                "Failed to maintain the partitions of %s.%s",
+                table.schema,
+                table.table,
+            )
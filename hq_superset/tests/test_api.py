@@ -19,7 +19,7 @@ class TestAPI(HQDBTestCase):
         }
         with (
             patch_oauth_validation(),
-            patch('hq_superset.api.process_dataset_change.delay')
+            patch('hq_superset.api.queue_dataset_change')
         ):
             response = self.client.post(
                 '/commcarehq_dataset/change/',
@@ -40,7 +40,7 @@ class TestAPI(HQDBTestCase):
         }
         with (
             patch_oauth_validation(),
-            patch('hq_superset.api.process_dataset_change.delay')
+            patch('hq_superset.api.queue_dataset_change')
         ):
             response = self.client.post(
                 '/commcarehq_dataset/change/',
@@ -97,6 +97,96 @@ class TestAPI(HQDBTestCase):
         assert response.status_code == 413
         assert response.json == {'error': 'Entity is too large'}
 
+    def test_post_dataset_changes(self):
+        lines = [
+            json.dumps({
+                "data_source_id": "abc123",
+                "doc_id": "def123",
+                "data": [{"doc_id": "def123", "foo": "bar"}],
+            }),
+            '',
+            'invalid json',
+            json.dumps({"foo": "bar"}),
+            json.dumps({
+                "data_source_id": "abc123",
+                "doc_id": "",
+                "doc_ids": ["def456"],
+                "data": [],
+            }),
+        ]
+        with (
+            patch_oauth_validation(),
+            patch('hq_superset.api.queue_dataset_changes') as queue_mock
+        ):
+            response = self.client.post(
+                '/commcarehq_dataset/changes/',
+                data='\n'.join(lines) + '\n',
+                content_type='application/x-ndjson',
+                headers={"Authorization": "Bearer test-token"}
+            )
+        assert response.status_code == 202
+        assert response.json == {
+            'accepted': 2,
+            'rejected': 2,
+            'results': [
+                {'line': 1, 'status': 'accepted'},
+                {'line': 3, 'error': 'Invalid JSON syntax'},
+                {'line': 4, 'error': 'Could not parse change request'},
+                {'line': 5, 'status': 'accepted'},
+            ],
+        }
+        queue_mock.assert_called_once_with([
+            json.loads(lines[0]),
+            json.loads(lines[4]),
+        ])
+
+    def test_post_dataset_changes_queued_in_batches(self):
+        line = json.dumps({"data_source_id": "abc123", "doc_id": "def123", "data": []})
+        with (
+            patch_oauth_validation(),
+            patch('hq_superset.api.DataSetChangeAPI.BULK_QUEUE_SIZE', 2),
+            patch('hq_superset.api.queue_dataset_changes') as queue_mock
+        ):
+            response = self.client.post(
+                '/commcarehq_dataset/changes/',
+                data='\n'.join([line] * 5),
+                content_type='application/x-ndjson',
+                headers={"Authorization": "Bearer test-token"}
+            )
+        assert response.status_code == 202
+        assert response.json['accepted'] == 5
+        assert [len(kall.args[0]) for kall in queue_mock.call_args_list] == [2, 2, 1]
+
+    def test_post_dataset_changes_line_too_large(self):
+        line = json.dumps({"data_source_id": "abc123", "doc_id": "def123", "data": []})
+        with (
+            patch_oauth_validation(),
+            patch('hq_superset.api.DataSetChangeAPI.MAX_REQUEST_LENGTH', 100),
+            patch('hq_superset.api.queue_dataset_changes') as queue_mock
+        ):
+            response = self.client.post(
+                '/commcarehq_dataset/changes/',
+                data='\n'.join([line, 'x' * 250, line]),
+                content_type='application/x-ndjson',
+                headers={"Authorization": "Bearer test-token"}
+            )
+        assert response.status_code == 202
+        assert response.json['results'][1] == {
+            'line': 2, 'error': 'Entity is too large'
+        }
+        assert len(queue_mock.call_args.args[0]) == 2
+
+    def test_post_dataset_changes_none_valid(self):
+        with patch_oauth_validation():
+            response = self.client.post(
+                '/commcarehq_dataset/changes/',
+                data='invalid json\n',
+                content_type='application/x-ndjson',
+                headers={"Authorization": "Bearer test-token"}
+            )
+        assert response.status_code == 400
+        assert response.json['rejected'] == 1
+
 
 @contextmanager
 def patch_oauth_validation():
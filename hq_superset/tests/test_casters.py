@@ -0,0 +1,93 @@
+import doctest
+from datetime import date, datetime
+
+import pytest
+from sqlalchemy import Column, MetaData, Table, types
+from sqlalchemy.dialects import postgresql
+
+import hq_superset.casters
+from hq_superset.casters import RowCaster
+
+TABLE = Table(
+    'test1_ucr1',
+    MetaData(),
+    Column('doc_id', types.TEXT),
+    Column('inserted_at', postgresql.TIMESTAMP),
+    Column('visit_date', types.DATE),
+    Column('visit_number', types.BIGINT),
+    Column('weight', postgresql.DOUBLE_PRECISION),
+    Column('symptoms', postgresql.ARRAY(types.TEXT)),
+    Column('referred', types.BOOLEAN),
+)
+COLUMN_TYPES = {'referred': {'type': 'boolean', 'true': 'yes', 'false': 'no'}}
+
+
+def test_cast_row():
+    caster = RowCaster(TABLE, COLUMN_TYPES)
+    row = caster.cast_row({
+        'doc_id': 'a1',
+        'inserted_at': '2024-02-24T14:01:25.397469Z',
+        'visit_date': '2024-02-22',
+        'visit_number': '3',
+        'weight': '61.5',
+        'symptoms': "['cough', 'fever']",
+        'referred': 'yes',
+    })
+    assert row == {
+        'doc_id': 'a1',
+        'inserted_at': datetime(2024, 2, 24, 14, 1, 25, 397469),
+        'visit_date': date(2024, 2, 22),
+        'visit_number': 3,
+        'weight': 61.5,
+        'symptoms': ['cough', 'fever'],
+        'referred': True,
+    }
+
+
+def test_cast_row_missing_values():
+    caster = RowCaster(TABLE, COLUMN_TYPES)
+    row = caster.cast_row({
+        'doc_id': 'a1',
+        'inserted_at': None,
+        'visit_date': '',
+        'visit_number': None,
+        'symptoms': None,
+        'referred': None,
+    })
+    assert row == {
+        'doc_id': 'a1',
+        'inserted_at': None,
+        'visit_date': None,
+        'visit_number': None,
+        'symptoms': [],
+        'referred': None,
+    }
+
+
+def test_cast_row_errors():
+    caster = RowCaster(TABLE, COLUMN_TYPES)
+    with pytest.raises(ValueError):
+        caster.cast_row({'referred': 'true'})
+    with pytest.raises(ValueError):
+        caster.cast_row({'visit_number': 'not a number'})
+    with pytest.raises(KeyError):
+        caster.cast_row({'unknown': 1})
+
+
+def test_cast_columns():
+    caster = RowCaster(TABLE)
+    columns = caster.cast_columns([
+        {'visit_number': 1, 'doc_id': 'a1'},
+        {'doc_id': 'a2', 'visit_date': '2024-02-22'},
+    ])
+    assert list(columns) == ['doc_id', 'visit_date', 'visit_number']
+    assert columns == {
+        'doc_id': ['a1', 'a2'],
+        'visit_date': [None, date(2024, 2, 22)],
+        'visit_number': [1, None],
+    }
+
+
+def test_doctests():
+    results = doctest.testmod(hq_superset.casters)
+    assert results.failed == 0
@@ -0,0 +1,340 @@
+from unittest.mock import call, patch
+
+from sqlalchemy.sql import text
+from superset import db
+from superset.connectors.sqla.models import SqlaTable
+
+from hq_superset.models import DataSetChange
+from hq_superset.tests.base_test import HQDBTestCase
+
+DATA_SOURCE_ID = 'test1_ucr1'
+
+
+def get_change(doc_id, *rows, doc_ids=None):
+    return {
+        'data_source_id': DATA_SOURCE_ID,
+        'doc_id': doc_id,
+        'doc_ids': doc_ids,
+        'data': [
+            {'doc_id': doc_id, 'visit_number': visit_number}
+            for visit_number in rows
+        ],
+    }
+
+
+def test_combine():
+    changes = [
+        DataSetChange(**get_change('a1', 1, 2)),
+        DataSetChange(**get_change('a2', 1)),
+        DataSetChange(**get_change('a1', 3)),
+        DataSetChange(**get_change('', doc_ids=['a2', 'a3'])),
+    ]
+    combined = DataSetChange.combine(changes)
+    assert combined.doc_ids == ['a1', 'a2', 'a3']
+    assert combined.data == [{'doc_id': 'a1', 'visit_number': 3}]
+
+
+class TestChangeBatches(HQDBTestCase):
+
+    def setUp(self):
+        super().setUp()
+        from hq_superset.change_batches import (
+            get_processing_key,
+            get_queue_key,
+            get_redis_client,
+        )
+        from hq_superset.table_cache import invalidate_table
+
+        with self.hq_db.get_sqla_engine_with_context() as engine:
+            engine.execute(text(
+                'CREATE SCHEMA IF NOT EXISTS hqdomain_test1; '
+                'CREATE TABLE hqdomain_test1.test1_ucr1 '
+                '(doc_id TEXT, visit_number BIGINT); '
+                "INSERT INTO hqdomain_test1.test1_ucr1 VALUES ('a3', 1)"
+            ))
+        sqla_table = SqlaTable(
+            table_name=DATA_SOURCE_ID,
+            schema='hqdomain_test1',
+            database=self.hq_db,
+        )
+        db.session.add(sqla_table)
+        db.session.commit()
+        invalidate_table(DATA_SOURCE_ID)
+        self.addCleanup(self._delete_sqla_table, sqla_table)
+
+        keys = [
+            get_queue_key(DATA_SOURCE_ID),
+            get_processing_key(DATA_SOURCE_ID),
+            f"{get_queue_key(DATA_SOURCE_ID)}:lock",
+        ]
+        get_redis_client().delete(*keys)
+        self.addCleanup(get_redis_client().delete, *keys)
+
+        patcher = patch.dict(self.app.config, {
+            'HQ_DATASET_CHANGE_BATCH_SECONDS': 5,
+            'HQ_DATASET_CHANGE_BATCH_SIZE': 10,
+        })
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    @staticmethod
+    def _delete_sqla_table(sqla_table):
+        db.session.delete(sqla_table)
+        db.session.commit()
+
+    def _select_rows(self):
+        with self.hq_db.get_sqla_engine_with_context() as engine:
+            return engine.execute(text(
+                'SELECT doc_id, visit_number '
+                'FROM hqdomain_test1.test1_ucr1 ORDER BY doc_id, visit_number'
+            )).fetchall()
+
+    def test_changes_are_applied_in_one_batch(self):
+        from hq_superset.tasks import (
+            process_dataset_changes,
+            queue_dataset_change,
+        )
+
+        with (
+            patch.object(process_dataset_changes, 'apply_async') as apply_async_mock,
+            patch.object(process_dataset_changes, 'delay') as delay_mock,
+        ):
+            queue_dataset_change(get_change('a1', 1, 2))
+            queue_dataset_change(get_change('a2', 1))
+            queue_dataset_change(get_change('a1', 3))
+            queue_dataset_change(get_change('', doc_ids=['a2', 'a3']))
+        # The first change schedules the batch
+        apply_async_mock.assert_called_once_with(
+            (DATA_SOURCE_ID,), countdown=5
+        )
+        delay_mock.assert_not_called()
+        self.assertEqual(self._select_rows(), [('a3', 1)])
+
+        with patch('hq_superset.change_batches.statsd') as statsd_mock:
+            process_dataset_changes(DATA_SOURCE_ID)
+        statsd_mock.histogram.assert_called_once()
+        self.assertEqual(statsd_mock.histogram.call_args.args[1], 4)
+        self.assertEqual(self._select_rows(), [('a1', 3)])
+
+    def test_full_batch_is_applied_straight_away(self):
+        from hq_superset.tasks import (
+            process_dataset_changes,
+            queue_dataset_change,
+        )
+
+        with (
+            patch.dict(self.app.config, {'HQ_DATASET_CHANGE_BATCH_SIZE': 2}),
+            patch.object(process_dataset_changes, 'apply_async'),
+            patch.object(process_dataset_changes, 'delay') as delay_mock,
+        ):
+            queue_dataset_change(get_change('a1', 1))
+            delay_mock.assert_not_called()
+            queue_dataset_change(get_change('a2', 1))
+            delay_mock.assert_called_once_with(DATA_SOURCE_ID)
+
+    def test_failed_batch_is_applied_one_change_at_a_time(self):
+        from hq_superset.change_batches import (
+            apply_dataset_changes,
+            push_dataset_change,
+        )
+
+        push_dataset_change(get_change('a1', 1))
+        push_dataset_change(get_change('a2', 'not a number'))
+        push_dataset_change(get_change('a4', 1))
+
+        self.assertTrue(apply_dataset_changes(DATA_SOURCE_ID))
+        self.assertEqual(
+            self._select_rows(), [('a1', 1), ('a3', 1), ('a4', 1)]
+        )
+
+    def test_batch_is_kept_until_it_is_applied(self):
+        from hq_superset.change_batches import (
+            apply_dataset_changes,
+            get_processing_key,
+            get_queue_key,
+            get_redis_client,
+            push_dataset_change,
+        )
+
+        push_dataset_change(get_change('a1', 1))
+        push_dataset_change(get_change('a2', 1))
+        # The worker dies while it applies the batch
+        with (
+            patch.dict(self.app.config, {'HQ_DATASET_CHANGE_BATCH_SIZE': 1}),
+            patch(
+                'hq_superset.change_batches.apply_batch',
+                side_effect=SystemExit,
+            ),
+            self.assertRaises(SystemExit),
+        ):
+            apply_dataset_changes(DATA_SOURCE_ID)
+        client = get_redis_client()
+        self.assertEqual(client.llen(get_processing_key(DATA_SOURCE_ID)), 1)
+        self.assertEqual(client.llen(get_queue_key(DATA_SOURCE_ID)), 1)
+
+        # The next worker applies it before the rest
+        self.assertTrue(apply_dataset_changes(DATA_SOURCE_ID))
+        self.assertEqual(self._select_rows(), [('a1', 1), ('a2', 1), ('a3', 1)])
+        self.assertFalse(client.exists(
+            get_queue_key(DATA_SOURCE_ID), get_processing_key(DATA_SOURCE_ID)
+        ))
+
+    def test_lock_is_renewed_for_each_batch(self):
+        import time
+
+        from hq_superset.change_batches import (
+            apply_batch,
+            apply_dataset_changes,
+            push_dataset_change,
+        )
+
+        def apply_slowly(changes):
+            time.sleep(0.6)
+            apply_batch(changes)
+
+        for doc_id in ('a1', 'a2', 'a4'):
+            push_dataset_change(get_change(doc_id, 1))
+        # Draining the list takes longer than the lock timeout, but each
+        # batch takes less
+        with (
+            patch.dict(self.app.config, {'HQ_DATASET_CHANGE_BATCH_SIZE': 1}),
+            patch('hq_superset.change_batches.LOCK_TIMEOUT_SECONDS', 1),
+            patch(
+                'hq_superset.change_batches.apply_batch',
+                side_effect=apply_slowly,
+            ),
+            patch('hq_superset.change_batches.logger') as logger_mock,
+        ):
+            self.assertTrue(apply_dataset_changes(DATA_SOURCE_ID))
+        logger_mock.error.assert_not_called()
+        self.assertEqual(
+            self._select_rows(), [('a1', 1), ('a2', 1), ('a3', 1), ('a4', 1)]
+        )
+
+    def test_lock_expires_while_a_batch_is_applied(self):
+        from hq_superset.change_batches import (
+            apply_dataset_changes,
+            get_processing_key,
+            get_queue_key,
+            get_redis_client,
+            push_dataset_change,
+        )
+
+        client = get_redis_client()
+        lock_key = f"{get_queue_key(DATA_SOURCE_ID)}:lock"
+
+        def expire_lock(changes):
+            # The lock expires, and another worker takes it
+            client.set(lock_key, 'other worker', px=60_000)
+
+        push_dataset_change(get_change('a1', 1))
+        push_dataset_change(get_change('a2', 1))
+        with (
+            patch.dict(self.app.config, {'HQ_DATASET_CHANGE_BATCH_SIZE': 1}),
+            patch(
+                'hq_superset.change_batches.apply_batch',
+                side_effect=expire_lock,
+            ) as apply_batch_mock,
+            patch('hq_superset.change_batches.logger') as logger_mock,
+        ):
+            self.assertTrue(apply_dataset_changes(DATA_SOURCE_ID))
+        # The worker stops after the batch, and leaves it and the rest
+        # of the list to the worker that holds the lock
+        apply_batch_mock.assert_called_once()
+        logger_mock.error.assert_called_once()
+        self.assertEqual(client.llen(get_processing_key(DATA_SOURCE_ID)), 1)
+        self.assertEqual(client.llen(get_queue_key(DATA_SOURCE_ID)), 1)
+        self.assertEqual(client.get(lock_key), b'other worker')
+
+    def test_drain_dataset_changes(self):
+        from hq_superset.change_batches import (
+            get_processing_key,
+            get_redis_client,
+            push_dataset_change,
+        )
+        from hq_superset.tasks import (
+            drain_dataset_changes,
+            process_dataset_changes,
+        )
+
+        client = get_redis_client()
+        other_id = 'test1_ucr2'
+        self.addCleanup(client.delete, get_processing_key(other_id))
+        push_dataset_change(get_change('a1', 1))
+        client.rpush(get_processing_key(other_id), '{}')
+        with patch.object(process_dataset_changes, 'delay') as delay_mock:
+            # Without the app context of the task, which would detach
+            # the test's objects from the session
+            drain_dataset_changes.run()
+        self.assertEqual(
+            sorted(kall.args[0] for kall in delay_mock.call_args_list),
+            [DATA_SOURCE_ID, other_id],
+        )
+
+    def test_changes_are_not_batched_without_a_window(self):
+        from hq_superset.tasks import (
+            process_dataset_change,
+            queue_dataset_change,
+        )
+
+        change = get_change('a1', 1)
+        with (
+            patch.dict(self.app.config, {'HQ_DATASET_CHANGE_BATCH_SECONDS': 0}),
+            patch.object(process_dataset_change, 'delay') as delay_mock,
+        ):
+            queue_dataset_change(change)
+        delay_mock.assert_called_once_with(change)
+
+    def test_queue_dataset_changes(self):
+        from hq_superset.change_batches import get_queue_key, get_redis_client
+        from hq_superset.tasks import (
+            process_dataset_changes,
+            queue_dataset_changes,
+        )
+
+        with (
+            patch.object(process_dataset_changes, 'apply_async') as apply_async_mock,
+            patch.object(process_dataset_changes, 'delay') as delay_mock,
+        ):
+            queue_dataset_changes([get_change('a1', 1), get_change('a2', 1)])
+            apply_async_mock.assert_called_once_with(
+                (DATA_SOURCE_ID,), countdown=5
+            )
+            delay_mock.assert_not_called()
+
+            # The batch is full
+            queue_dataset_changes([get_change(f'b{i}', 1) for i in range(8)])
+            apply_async_mock.assert_called_once()
+            delay_mock.assert_called_once_with(DATA_SOURCE_ID)
+        self.assertEqual(
+            get_redis_client().llen(get_queue_key(DATA_SOURCE_ID)), 10
+        )
+
+    def test_queue_dataset_changes_without_a_window(self):
+        from hq_superset.tasks import (
+            process_dataset_change_batch,
+            queue_dataset_changes,
+        )
+
+        changes = [get_change(f'a{i}', 1) for i in range(3)]
+        with (
+            patch.dict(self.app.config, {
+                'HQ_DATASET_CHANGE_BATCH_SECONDS': 0,
+                'HQ_DATASET_CHANGE_BATCH_SIZE': 2,
+            }),
+            patch.object(process_dataset_change_batch, 'delay') as delay_mock,
+        ):
+            queue_dataset_changes(changes)
+        self.assertEqual(delay_mock.call_args_list, [
+            call(changes[:2]),
+            call(changes[2:]),
+        ])
+
+    def test_process_dataset_change_batch(self):
+        from hq_superset.tasks import process_dataset_change_batch
+
+        process_dataset_change_batch([
+            get_change('a1', 1, 2),
+            get_change('', doc_ids=['a3']),
+        ])
+        self.assertEqual(self._select_rows(), [('a1', 1), ('a1', 2)])
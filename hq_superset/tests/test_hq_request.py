@@ -1,4 +1,10 @@
-from hq_superset.hq_requests import HQRequest
+import threading
+import time
+from unittest.mock import patch
+
+from flask import request
+
+from hq_superset.hq_requests import HQCallGroup, HQRequest
 from hq_superset.tests.base_test import SupersetTestCase
 
 
@@ -19,3 +25,38 @@ class TestAbsoluteUrl(SupersetTestCase):
             hq_request.absolute_url,
             'http://127.0.0.1:8000/test-url'
         )
+
+
+class TestHQCallGroup(SupersetTestCase):
+
+    @patch('hq_superset.hq_requests.get_valid_cchq_oauth_token')
+    def test_calls_run_concurrently_in_request_context(self, token_mock):
+        # Both calls wait for each other, so they must run at once
+        barrier = threading.Barrier(2, timeout=5)
+
+        def get_path():
+            barrier.wait()
+            time.sleep(0.1)
+            return request.path
+
+        with (
+            self.app.test_request_context('/hq_datasource/update/ucr1'),
+            patch('hq_superset.hq_requests.statsd') as statsd_mock,
+        ):
+            hq_calls = HQCallGroup({"datasource": "ucr1"})
+            future = hq_calls.submit('definition', get_path)
+            self.assertEqual(
+                hq_calls.call('export', get_path),
+                '/hq_datasource/update/ucr1',
+            )
+            self.assertEqual(future.result(), '/hq_datasource/update/ucr1')
+            hq_calls.report()
+
+        # The token is refreshed once, before the calls
+        token_mock.assert_called_once()
+        self.assertEqual(set(hq_calls.seconds), {'definition', 'export'})
+        saved = {
+            call.args[0]: call.args[1]
+            for call in statsd_mock.histogram.call_args_list
+        }['cca.hq_request.saved_seconds']
+        self.assertGreater(saved, 0.05)
@@ -0,0 +1,70 @@
+import doctest
+import os
+import tempfile
+from unittest.mock import patch
+from zipfile import ZIP_DEFLATED, ZipFile
+
+from superset.extensions import cache_manager
+
+from hq_superset.tests.base_test import SupersetTestCase
+from hq_superset.tests.const import TEST_DATASOURCE
+
+
+class TestImportCost(SupersetTestCase):
+
+    def setUp(self):
+        super().setUp()
+        from hq_superset.import_cost import THROUGHPUT_CACHE_KEY
+
+        cache_manager.cache.delete(THROUGHPUT_CACHE_KEY)
+        self.addCleanup(cache_manager.cache.delete, THROUGHPUT_CACHE_KEY)
+
+    def write_export(self, row_count):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        path = os.path.join(directory.name, 'export.zip')
+        rows = ''.join(
+            f'a{i:06d},2021-12-20,2022-01-19,{i % 10},2022-02-20,text\n'
+            for i in range(row_count)
+        )
+        with ZipFile(path, 'w', compression=ZIP_DEFLATED) as zipfile:
+            zipfile.writestr('export.csv', 'doc_id,inserted_at,a,b,c,d\n' + rows)
+        return path
+
+    def test_estimate_import_cost(self):
+        from hq_superset.import_cost import (
+            DEFAULT_CELLS_PER_SECOND,
+            estimate_import_cost,
+        )
+
+        # The rows are the same size, so the estimate is exact
+        cost = estimate_import_cost(self.write_export(100_000), TEST_DATASOURCE)
+        self.assertEqual(cost.rows, 100_000)
+        self.assertEqual(cost.columns, 6)
+        self.assertEqual(
+            cost.seconds, 100_000 * 6 / DEFAULT_CELLS_PER_SECOND
+        )
+
+        cost = estimate_import_cost(self.write_export(3), TEST_DATASOURCE)
+        self.assertEqual(cost.rows, 3)
+
+    def test_record_import_throughput(self):
+        from hq_superset.import_cost import (
+            get_cells_per_second,
+            record_import_throughput,
+        )
+
+        # Small imports are not recorded
+        record_import_throughput(100, 6, 1.0)
+        self.assertEqual(get_cells_per_second(), 500_000)
+
+        record_import_throughput(100_000, 6, 1.0)
+        self.assertEqual(get_cells_per_second(), 600_000)
+        with patch('hq_superset.import_cost.THROUGHPUT_WEIGHT', 0.5):
+            record_import_throughput(100_000, 6, 0.5)
+        self.assertEqual(get_cells_per_second(), 900_000)
+
+    def test_doctests(self):
+        import hq_superset.import_cost
+        results = doctest.testmod(hq_superset.import_cost)
+        self.assertEqual(results.failed, 0)
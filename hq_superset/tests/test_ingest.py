@@ -0,0 +1,150 @@
+import doctest
+from io import BytesIO, StringIO
+from unittest.mock import patch
+
+import pandas
+import pytest
+
+from hq_superset.ingest import (
+    MIN_CHUNK_ROWS,
+    NA_VALUES,
+    AdaptiveChunker,
+    read_arrow_chunks,
+    read_chunks,
+    read_export,
+)
+
+PARITY_CSV = (
+    'doc_id,inserted_at,name,count,small,amount,tags\n'
+    'a1,2023-01-01 10:00:00.123456,Alice,1,0,1.5,"[\'x\', \'y\']"\n'
+    'a2,2023-01-02 11:00:00,"Smith, Bob",,1,,[]\n'
+    'a3,,NA,-3,,2.25,\n'
+    'a4,2023-01-04,"",400000,1,N/A,"[\'z\']"\n'
+    'a5,2023-01-05 00:00:00,Zoë,5,0,-0.5,null\n'
+).encode('utf-8')
+PARITY_DTYPES = {
+    'doc_id': 'string',
+    'inserted_at': 'string',
+    'name': 'string',
+    'count': 'Int64',
+    'small': 'Int8',
+    'amount': 'Float64',
+    'tags': 'string',
+}
+
+
+def test_doctests():
+    import hq_superset.ingest
+    results = doctest.testmod(hq_superset.ingest)
+    assert results.failed == 0
+
+
+def test_chunk_size_adapts_to_observed_rows():
+    wide = pandas.DataFrame({
+        f'column_{i}': pandas.Series(['x' * 100] * 10, dtype='string')
+        for i in range(10)
+    })
+    narrow = pandas.DataFrame({
+        'doc_id': pandas.Series(['a'] * 1000, dtype='string'),
+    })
+    with (
+        patch('hq_superset.ingest.get_rss', return_value=100_000_000),
+        patch('hq_superset.ingest.get_peak_rss') as peak_rss_mock,
+    ):
+        peak_rss_mock.return_value = 200_000_000
+        chunker = AdaptiveChunker(memory_budget=30_000_000, row_bytes=100)
+        assert chunker.chunk_size == 100_000
+
+        # The peak was reached before the import, so the chunk is
+        # measured by its rows
+        chunker.observe(wide)
+        assert chunker.row_bytes > 1000
+        assert chunker.chunk_size < 10_000
+        chunker.observe(narrow)
+        assert chunker.row_bytes < 100
+        assert chunker.chunk_size > 100_000
+
+        # Loading the next chunk raised the peak, e.g. while its CSV was
+        # built, to 300MB above what the process used before it
+        peak_rss_mock.return_value = 400_000_000
+        chunker.observe(narrow)
+        assert chunker.row_bytes == 100_000
+        assert chunker.chunk_size == MIN_CHUNK_ROWS
+        assert chunker.peak_rss == 400_000_000
+
+
+def test_read_chunks():
+    csv = 'doc_id,n\n' + ''.join(f'a{i},{i}\n' for i in range(2500))
+    reader = pandas.read_csv(StringIO(csv), iterator=True)
+    chunker = AdaptiveChunker(memory_budget=3_000_000, row_bytes=1000)
+    sizes = []
+    for df in read_chunks(reader, chunker):
+        sizes.append(len(df))
+        # Halve the next chunk
+        chunker.row_bytes *= 2
+    assert sizes == [1000, 1000, 500]
+
+
+def read_all(csv, engine, skip_rows=0):
+    chunker = AdaptiveChunker(memory_budget=3_000_000, row_bytes=1000)
+    chunks = list(
+        read_export(BytesIO(csv), PARITY_DTYPES, chunker, skip_rows, engine)
+    )
+    return chunks, pandas.concat(chunks, ignore_index=True)
+
+
+@pytest.mark.parametrize('skip_rows', [0, 2])
+def test_arrow_engine_parity(skip_rows):
+    __, expected = read_all(PARITY_CSV, 'pandas', skip_rows)
+    __, actual = read_all(PARITY_CSV, 'pyarrow', skip_rows)
+    pandas.testing.assert_frame_equal(actual, expected)
+    assert len(actual) == 5 - skip_rows
+
+
+def test_na_values_match_pandas():
+    # Values that look missing, but pandas does not read as missing
+    others = ['NONE', 'Nan', 'NAN', 'nil', 'N.A.', '-', '#N/A ']
+    values = list(NA_VALUES) + others
+    csv = 'doc_id,name\n' + ''.join(
+        f'a{i},"{value}"\n' for i, value in enumerate(values)
+    )
+    df = pandas.read_csv(StringIO(csv), dtype='string')
+    assert [
+        value for value, missing in zip(values, df['name'].isna()) if missing
+    ] == list(NA_VALUES)
+
+    chunker = AdaptiveChunker(memory_budget=3_000_000, row_bytes=1000)
+    dtypes = {'doc_id': 'string', 'name': 'string'}
+    for engine in ('pandas', 'pyarrow'):
+        actual = pandas.concat(
+            read_export(BytesIO(csv.encode('utf-8')), dtypes, chunker, 0, engine),
+            ignore_index=True,
+        )
+        pandas.testing.assert_frame_equal(actual, df)
+
+
+def test_arrow_engine_header_only():
+    csv = PARITY_CSV.splitlines(keepends=True)[0]
+    for engine in ('pandas', 'pyarrow'):
+        chunks, df = read_all(csv, engine)
+        assert len(chunks) == 1
+        assert list(df.columns) == list(PARITY_DTYPES)
+        assert len(df) == 0
+
+
+def test_read_arrow_chunks_in_blocks():
+    csv = 'doc_id,n\n' + ''.join(f'a{i},{i}\n' for i in range(20_000))
+    chunks = list(read_arrow_chunks(
+        BytesIO(csv.encode()),
+        {'doc_id': 'string', 'n': 'Int64'},
+        block_size=64 * 1024,
+    ))
+    assert len(chunks) > 1
+    df = pandas.concat(chunks, ignore_index=True)
+    assert df['n'].dtype == 'Int64'
+    assert df['n'].tolist() == list(range(20_000))
+
+
+def test_read_export_unknown_engine():
+    with pytest.raises(ValueError):
+        read_all(PARITY_CSV, 'polars')
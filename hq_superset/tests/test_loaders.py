@@ -0,0 +1,414 @@
+import doctest
+from datetime import datetime
+
+import pandas
+import sqlalchemy
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.sql import text
+from superset.sql_parse import Table
+
+from hq_superset.tests.base_test import HQDBTestCase
+
+
+def test_doctests():
+    import hq_superset.loaders
+    results = doctest.testmod(hq_superset.loaders)
+    assert results.failed == 0
+
+
+class TestLoaders(HQDBTestCase):
+
+    def setUp(self):
+        super().setUp()
+        with self.hq_db.get_sqla_engine_with_context() as engine:
+            engine.execute(text('CREATE SCHEMA IF NOT EXISTS hqdomain_test1'))
+        self.table = Table(table='test1_ucr1', schema='hqdomain_test1')
+        self.sql_dtypes = {'tags': postgresql.ARRAY(sqlalchemy.types.TEXT)}
+
+    def _get_dataframe(self, doc_ids):
+        return pandas.DataFrame({
+            'doc_id': pandas.Series(doc_ids, dtype='string'),
+            'visit_number': pandas.Series(
+                range(len(doc_ids)), dtype='Int64'
+            ),
+            'tags': [['a', 'say "hi"'], [], None][:len(doc_ids)],
+        })
+
+    def _select_rows(self):
+        with self.hq_db.get_sqla_engine_with_context() as engine:
+            return engine.execute(text(
+                'SELECT doc_id, visit_number, tags '
+                'FROM hqdomain_test1.test1_ucr1 ORDER BY visit_number, doc_id'
+            )).fetchall()
+
+    def test_get_dataframe_loader(self):
+        from hq_superset.loaders import (
+            CopyLoader,
+            ParallelCopyLoader,
+            get_dataframe_loader,
+        )
+
+        loader = get_dataframe_loader(self.hq_db, self.table, {})
+        self.assertIsInstance(loader, CopyLoader)
+        loader = get_dataframe_loader(self.hq_db, self.table, {}, workers=4)
+        self.assertIsInstance(loader, ParallelCopyLoader)
+
+    def test_loaders_write_the_same_rows(self):
+        from hq_superset.loaders import CopyLoader, DataFrameLoader
+
+        for loader_class in (DataFrameLoader, CopyLoader):
+            loader = loader_class(self.hq_db, self.table, self.sql_dtypes)
+            loader.load(self._get_dataframe(['a1', 'a2']), replace=True)
+            loader.load(self._get_dataframe(['a3', None, 'a5']))
+
+            self.assertEqual(loader.row_count, 5)
+            self.assertEqual(self._select_rows(), [
+                ('a1', 0, ['a', 'say "hi"']),
+                ('a3', 0, ['a', 'say "hi"']),
+                ('a2', 1, []),
+                (None, 1, []),
+                ('a5', 2, None),
+            ])
+
+    def test_swap_staging_table(self):
+        from hq_superset.loaders import (
+            CopyLoader,
+            get_staging_table,
+            swap_staging_table,
+        )
+
+        loader = CopyLoader(self.hq_db, self.table, self.sql_dtypes)
+        loader.load(self._get_dataframe(['a1']), replace=True)
+        staging_table = get_staging_table(self.table)
+        loader = CopyLoader(self.hq_db, staging_table, self.sql_dtypes)
+        loader.load(self._get_dataframe(['b1', 'b2']), replace=True)
+        # The live table is untouched until the staging table is swapped in
+        self.assertEqual(self._select_rows(), [('a1', 0, ['a', 'say "hi"'])])
+
+        swap_staging_table(self.hq_db, self.table, staging_table)
+        self.assertEqual(self._select_rows(), [
+            ('b1', 0, ['a', 'say "hi"']),
+            ('b2', 1, []),
+        ])
+        with self.hq_db.get_sqla_engine_with_context() as engine:
+            self.assertFalse(sqlalchemy.inspect(engine).has_table(
+                staging_table.table, schema=staging_table.schema
+            ))
+
+    def _get_persistence(self):
+        with self.hq_db.get_sqla_engine_with_context() as engine:
+            return engine.execute(text(
+                "SELECT relpersistence FROM pg_class "
+                "WHERE oid = 'hqdomain_test1.test1_ucr1'::regclass"
+            )).scalar()
+
+    def test_unlogged_copy_loader(self):
+        from hq_superset.loaders import (
+            CopyLoader,
+            analyze_table,
+            set_table_logged,
+        )
+
+        loader = CopyLoader(
+            self.hq_db, self.table, self.sql_dtypes, unlogged=True
+        )
+        loader.load(self._get_dataframe(['a1', 'a2']), replace=True)
+        loader.load(self._get_dataframe(['a3']))
+        self.assertEqual(self._get_persistence(), 'u')
+
+        set_table_logged(self.hq_db, self.table)
+        self.assertEqual(self._get_persistence(), 'p')
+        self.assertEqual(len(self._select_rows()), 3)
+
+        analyze_table(self.hq_db, self.table)
+        with self.hq_db.get_sqla_engine_with_context() as engine:
+            reltuples = engine.execute(text(
+                "SELECT reltuples FROM pg_class "
+                "WHERE oid = 'hqdomain_test1.test1_ucr1'::regclass"
+            )).scalar()
+        self.assertEqual(reltuples, 3)
+
+    def test_merge_staging_table(self):
+        from hq_superset.loaders import (
+            CopyLoader,
+            get_staging_table,
+            merge_staging_table,
+        )
+
+        loader = CopyLoader(self.hq_db, self.table, self.sql_dtypes)
+        loader.load(self._get_dataframe(['a1', 'a2']), replace=True)
+        staging_table = get_staging_table(self.table)
+        loader = CopyLoader(self.hq_db, staging_table, self.sql_dtypes)
+        loader.load(self._get_dataframe(['b1', 'a1']), replace=True)
+
+        merge_staging_table(self.hq_db, self.table, staging_table)
+        self.assertEqual(self._select_rows(), [
+            ('b1', 0, ['a', 'say "hi"']),
+            ('a1', 1, []),
+            ('a2', 1, []),
+        ])
+        with self.hq_db.get_sqla_engine_with_context() as engine:
+            self.assertFalse(sqlalchemy.inspect(engine).has_table(
+                staging_table.table, schema=staging_table.schema
+            ))
+
+    def test_indexes_are_renamed_on_swap(self):
+        from hq_superset.loaders import (
+            CopyLoader,
+            create_indexes,
+            get_staging_table,
+            swap_staging_table,
+        )
+
+        for _ in range(2):
+            staging_table = get_staging_table(self.table)
+            loader = CopyLoader(self.hq_db, staging_table, self.sql_dtypes)
+            loader.load(self._get_dataframe(['a1', 'a2']), replace=True)
+            create_indexes(
+                self.hq_db, staging_table, ['doc_id', 'missing_column']
+            )
+            swap_staging_table(
+                self.hq_db, self.table, staging_table, ['doc_id']
+            )
+
+            with self.hq_db.get_sqla_engine_with_context() as engine:
+                indexes = sqlalchemy.inspect(engine).get_indexes(
+                    self.table.table, schema=self.table.schema
+                )
+            self.assertEqual(
+                [(i['name'], i['column_names']) for i in indexes],
+                [('ix_test1_ucr1_doc_id', ['doc_id'])],
+            )
+
+    def _get_indexes(self, table):
+        with self.hq_db.get_sqla_engine_with_context() as engine:
+            return engine.execute(text(
+                "SELECT c.relname, i.indisvalid FROM pg_index i "
+                "JOIN pg_class c ON c.oid = i.indexrelid "
+                "WHERE i.indrelid = to_regclass(:table) ORDER BY c.relname"
+            ), {'table': f'hqdomain_test1.{table}'}).fetchall()
+
+    def test_create_indexes_concurrently(self):
+        from hq_superset.loaders import CopyLoader, create_indexes
+
+        loader = CopyLoader(self.hq_db, self.table, self.sql_dtypes)
+        loader.load(self._get_dataframe(['a1', 'a2']), replace=True)
+        with self.hq_db.get_sqla_engine_with_context() as engine:
+            # Left by a concurrent build that failed
+            engine.execute(text(
+                'CREATE INDEX ix_test1_ucr1_visit_number '
+                'ON hqdomain_test1.test1_ucr1 (visit_number); '
+                'UPDATE pg_index SET indisvalid = false '
+                "WHERE indexrelid = 'hqdomain_test1.ix_test1_ucr1_visit_number'::regclass"
+            ))
+        create_indexes(
+            self.hq_db, self.table, ['doc_id', 'visit_number'],
+            concurrently=True,
+        )
+        self.assertEqual(self._get_indexes('test1_ucr1'), [
+            ('ix_test1_ucr1_doc_id', True),
+            ('ix_test1_ucr1_visit_number', True),
+        ])
+
+    def test_create_indexes_concurrently_partitioned(self):
+        from hq_superset.loaders import CopyLoader, create_indexes
+
+        loader = CopyLoader(
+            self.hq_db, self.table, {}, partition_column='inserted_at'
+        )
+        loader.load(self._get_partitioned_dataframe([
+            ('a1', '2023-01-05'), ('a2', None),
+        ]), replace=True)
+        for _ in range(2):
+            create_indexes(
+                self.hq_db, self.table, ['doc_id'], concurrently=True
+            )
+        self.assertEqual(self._get_indexes('test1_ucr1'), [
+            ('ix_test1_ucr1_doc_id', True),
+        ])
+        self.assertEqual(self._get_indexes('test1_ucr1_p2023_01'), [
+            ('ix_test1_ucr1_p2023_01_doc_id', True),
+        ])
+
+    def test_parallel_copy_loader(self):
+        from hq_superset.loaders import ParallelCopyLoader
+
+        loader = ParallelCopyLoader(
+            self.hq_db, self.table, self.sql_dtypes, workers=3
+        )
+        loader.load(self._get_dataframe(['a1', 'a2']), replace=True)
+        for i in range(10):
+            loader.load(self._get_dataframe([f'b{i}', None, f'c{i}']))
+        loader.wait()
+
+        self.assertEqual(loader.row_count, 32)
+        rows = self._select_rows()
+        self.assertEqual(len(rows), 32)
+        self.assertEqual(
+            sorted(doc_id for doc_id, *__ in rows if doc_id),
+            sorted(['a1', 'a2'] + [f'{c}{i}' for c in 'bc' for i in range(10)]),
+        )
+
+    def test_parallel_copy_loader_raises_worker_errors(self):
+        from hq_superset.loaders import ParallelCopyLoader
+
+        loader = ParallelCopyLoader(
+            self.hq_db, self.table, self.sql_dtypes, workers=2
+        )
+        loader.load(self._get_dataframe(['a1']), replace=True)
+        bad_df = self._get_dataframe(['b1']).assign(no_such_column=1)
+        with self.assertRaises(Exception):
+            loader.load(bad_df)
+            loader.wait()
+
+    def _get_partitioned_dataframe(self, rows):
+        return pandas.DataFrame({
+            'doc_id': pandas.Series([doc_id for doc_id, __ in rows], dtype='string'),
+            'inserted_at': pandas.to_datetime(
+                pandas.Series([inserted_at for __, inserted_at in rows]),
+                format='ISO8601',
+            ),
+        })
+
+    def _select_partition_rows(self, table):
+        with self.hq_db.get_sqla_engine_with_context() as engine:
+            return engine.execute(text(
+                'SELECT tableoid::regclass::text, doc_id '
+                f'FROM hqdomain_test1.{table} ORDER BY doc_id'
+            )).fetchall()
+
+    def test_partitioned_copy_loader(self):
+        from hq_superset.loaders import (
+            ParallelCopyLoader,
+            get_staging_table,
+            is_partitioned,
+            swap_staging_table,
+        )
+
+        for _ in range(2):
+            staging_table = get_staging_table(self.table)
+            loader = ParallelCopyLoader(
+                self.hq_db, staging_table, {}, workers=2,
+                unlogged=True, partition_column='inserted_at',
+            )
+            loader.load(self._get_partitioned_dataframe([
+                ('a1', '2023-01-05'), ('a2', None),
+            ]), replace=True)
+            loader.load(self._get_partitioned_dataframe([
+                ('a3', '2023-02-01'), ('a4', '2023-01-31 23:59:59'),
+            ]))
+            loader.load(self._get_partitioned_dataframe([('a5', '2023-02-10')]))
+            loader.wait()
+            self.assertTrue(is_partitioned(self.hq_db, staging_table))
+            # Partitioned tables are not unlogged
+            self.assertFalse(loader.unlogged)
+
+            swap_staging_table(self.hq_db, self.table, staging_table)
+            # Partitions are renamed with the table
+            self.assertEqual(self._select_partition_rows('test1_ucr1'), [
+                ('hqdomain_test1.test1_ucr1_p2023_01', 'a1'),
+                ('hqdomain_test1.test1_ucr1_default', 'a2'),
+                ('hqdomain_test1.test1_ucr1_p2023_02', 'a3'),
+                ('hqdomain_test1.test1_ucr1_p2023_01', 'a4'),
+                ('hqdomain_test1.test1_ucr1_p2023_02', 'a5'),
+            ])
+
+    def test_create_partitions_moves_default_rows(self):
+        from hq_superset.loaders import CopyLoader, create_partitions
+
+        loader = CopyLoader(
+            self.hq_db, self.table, {}, partition_column='inserted_at'
+        )
+        loader.load(self._get_partitioned_dataframe([('a1', '2023-01-05')]), replace=True)
+        with self.hq_db.get_sqla_engine_with_context() as engine:
+            # Rows inserted by DataSetChange go to the default partition
+            # if their month has no partition
+            engine.execute(text(
+                "INSERT INTO hqdomain_test1.test1_ucr1 VALUES "
+                "('a2', '2023-03-02'), ('a3', '2023-04-02')"
+            ))
+        create_partitions(
+            self.hq_db, self.table, 'inserted_at', [datetime(2023, 3, 1)]
+        )
+        self.assertEqual(self._select_partition_rows('test1_ucr1'), [
+            ('hqdomain_test1.test1_ucr1_p2023_01', 'a1'),
+            ('hqdomain_test1.test1_ucr1_p2023_03', 'a2'),
+            ('hqdomain_test1.test1_ucr1_default', 'a3'),
+        ])
+
+    def test_remove_partitions_before(self):
+        from hq_superset.loaders import CopyLoader, remove_partitions_before
+
+        loader = CopyLoader(
+            self.hq_db, self.table, {}, partition_column='inserted_at'
+        )
+        loader.load(self._get_partitioned_dataframe([
+            ('a1', '2023-01-05'), ('a2', '2023-02-05'), ('a3', '2023-03-05'),
+        ]), replace=True)
+
+        removed = remove_partitions_before(
+            self.hq_db, self.table, datetime(2023, 2, 1)
+        )
+        self.assertEqual(removed, ['test1_ucr1_p2023_01'])
+        removed = remove_partitions_before(
+            self.hq_db, self.table, datetime(2023, 3, 1), drop=True
+        )
+        self.assertEqual(removed, ['test1_ucr1_p2023_02'])
+        self.assertEqual(
+            [doc_id for __, doc_id in self._select_partition_rows('test1_ucr1')],
+            ['a3'],
+        )
+        # The detached partition is kept as a table
+        detached, = self._get_detached_tables('test1_ucr1_p2023_01')
+        self.assertEqual(
+            self._select_partition_rows(detached),
+            [(f'hqdomain_test1.{detached}', 'a1')],
+        )
+
+    def _get_detached_tables(self, partition):
+        with self.hq_db.get_sqla_engine_with_context() as engine:
+            return [
+                name for name in sqlalchemy.inspect(engine).get_table_names(
+                    schema='hqdomain_test1'
+                )
+                if name.startswith(f'{partition}_detached_')
+            ]
+
+    def test_remove_partitions_before_detaches_a_month_twice(self):
+        from hq_superset.loaders import (
+            CopyLoader,
+            create_partitions,
+            remove_partitions_before,
+        )
+
+        loader = CopyLoader(
+            self.hq_db, self.table, {}, partition_column='inserted_at'
+        )
+        loader.load(self._get_partitioned_dataframe([
+            ('a1', '2023-01-05'), ('a2', '2023-02-05'),
+        ]), replace=True)
+        remove_partitions_before(self.hq_db, self.table, datetime(2023, 2, 1))
+
+        # Late rows for the month are given a new partition
+        create_partitions(
+            self.hq_db, self.table, 'inserted_at', [datetime(2023, 1, 1)]
+        )
+        with self.hq_db.get_sqla_engine_with_context() as engine:
+            engine.execute(text(
+                "INSERT INTO hqdomain_test1.test1_ucr1 VALUES "
+                "('a3', '2023-01-20')"
+            ))
+        removed = remove_partitions_before(
+            self.hq_db, self.table, datetime(2023, 2, 1)
+        )
+        self.assertEqual(removed, ['test1_ucr1_p2023_01'])
+        detached = self._get_detached_tables('test1_ucr1_p2023_01')
+        self.assertEqual(len(detached), 2)
+        self.assertEqual(
+            sorted(
+                doc_id
+                for table in detached
+                for __, doc_id in self._select_partition_rows(table)
+            ),
+            ['a1', 'a3'],
+        )
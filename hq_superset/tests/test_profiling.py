@@ -0,0 +1,82 @@
+import doctest
+
+import pandas
+
+from hq_superset.profiling import ColumnProfiler
+
+
+def get_profiler(*chunks):
+    profiler = ColumnProfiler(['n', 'big'], ['flag', 'answer', 'comment'])
+    for chunk in chunks:
+        profiler.observe(pandas.DataFrame(chunk).astype({
+            'n': 'Int64',
+            'big': 'Int64',
+            'flag': 'string',
+            'answer': 'string',
+            'comment': 'string',
+        }))
+    return profiler
+
+
+def test_get_column_types():
+    profiler = get_profiler(
+        {
+            'n': [1, None],
+            'big': [1, 2 ** 40],
+            'flag': ['true', None],
+            'answer': ['Yes', 'No'],
+            'comment': ['yes', 'maybe'],
+        },
+        {
+            'n': [40_000, -3],
+            'big': [None, None],
+            'flag': ['false', 'false'],
+            'answer': ['Yes', None],
+            'comment': ['no', 'no'],
+        },
+    )
+    assert profiler.get_column_types() == {
+        'n': {'type': 'integer'},
+        'flag': {'type': 'boolean', 'true': 'true', 'false': 'false'},
+        'answer': {'type': 'boolean', 'true': 'Yes', 'false': 'No'},
+    }
+
+
+def test_mixed_spellings_are_not_boolean():
+    profiler = get_profiler({
+        'n': [None],
+        'big': [None],
+        'flag': ['true'],
+        'answer': ['yes'],
+        'comment': [None],
+    }, {
+        'n': [None],
+        'big': [None],
+        'flag': ['True'],
+        'answer': ['true'],
+        'comment': [None],
+    })
+    assert profiler.get_column_types() == {}
+
+
+def test_get_unfit_columns():
+    column_types = {
+        'n': {'type': 'smallint'},
+        'big': {'type': 'integer'},
+        'flag': {'type': 'boolean', 'true': 'true', 'false': 'false'},
+        'answer': {'type': 'boolean', 'true': 'yes', 'false': 'no'},
+    }
+    profiler = get_profiler({
+        'n': [40_000],
+        'big': [None],
+        'flag': ['false'],
+        'answer': ['Yes'],
+        'comment': [None],
+    })
+    assert profiler.get_unfit_columns(column_types) == ['n', 'answer']
+
+
+def test_doctests():
+    import hq_superset.profiling
+    results = doctest.testmod(hq_superset.profiling)
+    assert results.failed == 0
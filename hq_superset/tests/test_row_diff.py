@@ -0,0 +1,134 @@
+import doctest
+from unittest.mock import call, patch
+
+from sqlalchemy.sql import text
+from superset import db
+from superset.connectors.sqla.models import SqlaTable
+
+import hq_superset.row_diff
+from hq_superset.models import DataSetChange
+from hq_superset.tests.base_test import HQDBTestCase
+
+DATA_SOURCE_ID = 'test1_ucr1'
+
+
+def get_change(doc_id, *rows):
+    return DataSetChange(
+        data_source_id=DATA_SOURCE_ID,
+        doc_id=doc_id,
+        data=[
+            {'doc_id': doc_id, 'visit_number': visit_number, 'comment': comment}
+            for visit_number, comment in rows
+        ],
+    )
+
+
+def test_doctests():
+    results = doctest.testmod(hq_superset.row_diff)
+    assert results.failed == 0
+
+
+class TestDiffApply(HQDBTestCase):
+
+    def setUp(self):
+        super().setUp()
+        from hq_superset.table_cache import invalidate_table
+
+        # Partitioned, so that rows in different partitions can have
+        # the same ctid
+        with self.hq_db.get_sqla_engine_with_context() as engine:
+            engine.execute(text(
+                'CREATE SCHEMA IF NOT EXISTS hqdomain_test1; '
+                'CREATE TABLE hqdomain_test1.test1_ucr1 '
+                '(doc_id TEXT, visit_number BIGINT, comment TEXT) '
+                'PARTITION BY RANGE (visit_number); '
+                'CREATE TABLE hqdomain_test1.test1_ucr1_low '
+                'PARTITION OF hqdomain_test1.test1_ucr1 FOR VALUES FROM (0) TO (10); '
+                'CREATE TABLE hqdomain_test1.test1_ucr1_high '
+                'PARTITION OF hqdomain_test1.test1_ucr1 FOR VALUES FROM (10) TO (100); '
+                "INSERT INTO hqdomain_test1.test1_ucr1 VALUES "
+                "('a1', 1, 'first'), ('a1', 11, 'second'), ('a1', 12, 'third'), "
+                "('a2', 2, 'other')"
+            ))
+        sqla_table = SqlaTable(
+            table_name=DATA_SOURCE_ID,
+            schema='hqdomain_test1',
+            database=self.hq_db,
+        )
+        db.session.add(sqla_table)
+        db.session.commit()
+        invalidate_table(DATA_SOURCE_ID)
+        self.addCleanup(self._delete_sqla_table, sqla_table)
+
+        patcher = patch.dict(self.app.config, {'HQ_DATASET_CHANGE_APPLY_DIFF': True})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    @staticmethod
+    def _delete_sqla_table(sqla_table):
+        db.session.delete(sqla_table)
+        db.session.commit()
+
+    def _select_rows(self):
+        with self.hq_db.get_sqla_engine_with_context() as engine:
+            return engine.execute(text(
+                'SELECT doc_id, visit_number, comment '
+                'FROM hqdomain_test1.test1_ucr1 ORDER BY doc_id, visit_number'
+            )).fetchall()
+
+    def _get_row_counts(self, statsd_mock):
+        return {
+            kall.kwargs['tags'][1]: kall.args[1]
+            for kall in statsd_mock.increment.call_args_list
+        }
+
+    def test_only_changed_rows_are_written(self):
+        change = get_change('a1', (1, 'first'), (11, 'changed'))
+        with patch('hq_superset.models.statsd') as statsd_mock:
+            change.update_dataset()
+        self.assertEqual(self._select_rows(), [
+            ('a1', 1, 'first'),
+            ('a1', 11, 'changed'),
+            ('a2', 2, 'other'),
+        ])
+        self.assertEqual(self._get_row_counts(statsd_mock), {
+            'action:skipped': 1,
+            'action:updated': 1,
+            'action:deleted': 1,
+        })
+
+    def test_rows_are_moved_between_partitions(self):
+        change = get_change('a1', (1, 'first'), (3, 'second'), (12, 'third'), (13, 'new'))
+        with patch('hq_superset.models.statsd') as statsd_mock:
+            change.update_dataset()
+        self.assertEqual(self._select_rows(), [
+            ('a1', 1, 'first'),
+            ('a1', 3, 'second'),
+            ('a1', 12, 'third'),
+            ('a1', 13, 'new'),
+            ('a2', 2, 'other'),
+        ])
+        self.assertEqual(self._get_row_counts(statsd_mock), {
+            'action:skipped': 2,
+            'action:updated': 1,
+            'action:inserted': 1,
+        })
+
+    def test_deleted_documents(self):
+        change = DataSetChange(
+            data_source_id=DATA_SOURCE_ID,
+            doc_id='',
+            data=[],
+            doc_ids=['a1', 'a2'],
+        )
+        with patch('hq_superset.models.statsd') as statsd_mock:
+            change.update_dataset()
+        self.assertEqual(self._select_rows(), [])
+        self.assertIn(
+            call('cca.dataset_change.rows', 4, tags=[
+                f'datasource:{DATA_SOURCE_ID}',
+                'action:deleted',
+                'env:test',
+            ]),
+            statsd_mock.increment.call_args_list,
+        )
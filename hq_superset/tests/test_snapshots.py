@@ -0,0 +1,102 @@
+import os
+import tempfile
+from unittest.mock import patch
+
+import pandas
+import superset
+
+from hq_superset.tests.base_test import SupersetTestCase
+from hq_superset.tests.const import TEST_DATASOURCE
+
+
+class TestSnapshots(SupersetTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.shared_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.shared_dir.cleanup)
+        patcher = patch.object(
+            superset.config, 'SHARED_DIR', self.shared_dir.name
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def write_snapshot(self, datasource_id, chunks):
+        from hq_superset.snapshots import SnapshotWriter, get_snapshot_path
+
+        writer = SnapshotWriter(
+            get_snapshot_path('test1', datasource_id),
+            TEST_DATASOURCE,
+            'ds1',
+            'abc',
+        )
+        for chunk in chunks:
+            writer.write(chunk)
+        writer.commit()
+
+    def test_write_and_read_snapshot(self):
+        from hq_superset.snapshots import get_snapshot, read_snapshot
+
+        chunks = [
+            pandas.DataFrame({
+                'doc_id': pandas.Series(['a1', 'a2'], dtype='string'),
+                'n': pandas.Series([1, None], dtype='Int64'),
+                'x': pandas.Series([0.5, None], dtype='Float64'),
+            }),
+            pandas.DataFrame({
+                'doc_id': pandas.Series(['a3'], dtype='string'),
+                'n': pandas.Series([None], dtype='Int64'),
+                'x': pandas.Series([None], dtype='Float64'),
+            }),
+        ]
+        self.write_snapshot('ucr1', chunks)
+
+        snapshot = get_snapshot('test1', 'ucr1')
+        self.assertEqual(snapshot.datasource_defn, TEST_DATASOURCE)
+        self.assertEqual(snapshot.display_name, 'ds1')
+        self.assertEqual(snapshot.content_hash, 'abc')
+        self.assertIsNone(get_snapshot('test1', 'ucr2'))
+
+        with open(snapshot.path, 'rb') as f:
+            df = pandas.concat(list(read_snapshot(f, 2)), ignore_index=True)
+        pandas.testing.assert_frame_equal(
+            df, pandas.concat(chunks, ignore_index=True)
+        )
+        with open(snapshot.path, 'rb') as f:
+            df = pandas.concat(list(read_snapshot(f, 2, skip_rows=2)))
+        self.assertEqual(df['doc_id'].tolist(), ['a3'])
+
+    def test_aborted_snapshot_leaves_last_snapshot(self):
+        from hq_superset.snapshots import (
+            SnapshotWriter,
+            get_snapshot,
+            get_snapshot_path,
+        )
+
+        chunk = pandas.DataFrame({'doc_id': pandas.Series(['a1'], dtype='string')})
+        self.write_snapshot('ucr1', [chunk])
+        writer = SnapshotWriter(
+            get_snapshot_path('test1', 'ucr1'), TEST_DATASOURCE, 'ds1', 'def'
+        )
+        writer.write(chunk)
+        writer.abort()
+        self.assertEqual(get_snapshot('test1', 'ucr1').content_hash, 'abc')
+        self.assertFalse(os.path.exists(writer.temp_path))
+
+    def test_apply_snapshot_retention(self):
+        from hq_superset.snapshots import (
+            apply_snapshot_retention,
+            get_snapshot_path,
+            has_snapshot,
+        )
+
+        chunk = pandas.DataFrame({'doc_id': pandas.Series(['a1'], dtype='string')})
+        for i, datasource_id in enumerate(['ucr1', 'ucr2', 'ucr3']):
+            self.write_snapshot(datasource_id, [chunk])
+            os.utime(get_snapshot_path('test1', datasource_id), (i, i))
+        size = os.path.getsize(get_snapshot_path('test1', 'ucr1'))
+
+        apply_snapshot_retention(size * 2)
+        self.assertFalse(has_snapshot('test1', 'ucr1'))
+        self.assertTrue(has_snapshot('test1', 'ucr2'))
+        self.assertTrue(has_snapshot('test1', 'ucr3'))
@@ -0,0 +1,38 @@
+from unittest.mock import Mock
+
+from superset.extensions import cache_manager
+
+from hq_superset.tests.base_test import SupersetTestCase
+
+
+class TestTableCache(SupersetTestCase):
+
+    def setUp(self):
+        super().setUp()
+        from hq_superset.table_cache import clear_table_cache, get_version_key
+
+        clear_table_cache()
+        cache_manager.cache.delete(get_version_key('ucr1'))
+        self.addCleanup(clear_table_cache)
+        self.addCleanup(cache_manager.cache.delete, get_version_key('ucr1'))
+
+    def test_table_is_cached_until_invalidated(self):
+        from hq_superset.table_cache import (
+            get_cached_table,
+            get_version_key,
+            invalidate_table,
+        )
+
+        resolve = Mock(side_effect=['table1', 'table2', 'table3'])
+        self.assertEqual(get_cached_table('ucr1', resolve), 'table1')
+        self.assertEqual(get_cached_table('ucr1', resolve), 'table1')
+        self.assertEqual(resolve.call_count, 1)
+
+        invalidate_table('ucr1')
+        self.assertEqual(get_cached_table('ucr1', resolve), 'table2')
+
+        # Another process invalidates the table
+        cache_manager.cache.set(get_version_key('ucr1'), 'abc')
+        self.assertEqual(get_cached_table('ucr1', resolve), 'table3')
+        self.assertEqual(get_cached_table('ucr1', resolve), 'table3')
+        self.assertEqual(resolve.call_count, 3)
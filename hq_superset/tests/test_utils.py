@@ -1,12 +1,25 @@
 import doctest
+import hashlib
+import os
+import tempfile
 from unittest.mock import patch
+from zipfile import ZipFile, ZipInfo
 
+import pandas
+import sqlalchemy
 from flask import session
 
 from hq_superset.const import READ_ONLY_ROLE_NAME, SESSION_DOMAIN_ROLE_LAST_SYNCED_AT
 from hq_superset.tests.base_test import LoginUserTestMixin, SupersetTestCase
 from hq_superset.tests.const import TEST_DATASOURCE
-from hq_superset.utils import DomainSyncUtil, get_column_dtypes
+from hq_superset.utils import (
+    DomainSyncUtil,
+    convert_array_column,
+    convert_to_array,
+    get_column_dtypes,
+    get_datasource_file_hash,
+    get_sql_dtypes,
+)
 from hq_superset.hq_requests import HQRequest
 
 
@@ -25,6 +38,73 @@ def test_get_column_dtypes():
     }
 
 
+def test_get_sql_dtypes():
+    sql_dtypes = get_sql_dtypes(TEST_DATASOURCE)
+    assert sql_dtypes == {
+        'data_visit_date_eaece89e': sqlalchemy.types.Date,
+        'data_lmp_date_5e24b993': sqlalchemy.types.Date,
+    }
+
+
+def test_convert_to_array():
+    # Same results as ``ast.literal_eval()``, for the values it can parse
+    assert convert_to_array("['a', 'b c', '']") == ['a', 'b c', '']
+    assert convert_to_array('["it\'s", "a"]') == ["it's", 'a']
+    assert convert_to_array("['say \\'hi\\'']") == ["say 'hi'"]
+    assert convert_to_array("['a','b']") == ['a', 'b']
+    assert convert_to_array("('a', 'b')") == ['a', 'b']
+    assert convert_to_array("'a', ") == ['a']
+    assert convert_to_array("[1, -2, 3.5, None]") == [1, -2, 3.5, None]
+    assert convert_to_array("[['a']]") == [['a']]
+    assert convert_to_array("'a'") == 'a'
+    assert convert_to_array("[]") == []
+    assert convert_to_array("()") == []
+    assert convert_to_array("[None]") == []
+    # Malformed values
+    assert convert_to_array("[01]") == []
+    assert convert_to_array("['a'") == []
+    assert convert_to_array("[']") == []
+    assert convert_to_array("") == []
+
+
+def test_convert_array_column_limits_decoded_values():
+    values = pandas.Series(
+        ["['a']", "['b']", "['c']", "['a']", "['c']"], dtype='string'
+    )
+    decoded = {}
+    with patch('hq_superset.utils.MAX_DECODED_ARRAYS', 2):
+        arrays = convert_array_column(values, decoded)
+    assert arrays.tolist() == [['a'], ['b'], ['c'], ['a'], ['c']]
+    assert list(decoded) == ["['a']", "['b']"]
+
+
+def test_get_datasource_file_hash():
+    data = b'doc_id,inserted_at\na1,2021-12-20\n'
+    exports = [
+        (data, (2024, 1, 1, 0, 0, 0)),
+        (data, (2024, 2, 1, 0, 0, 0)),
+        (data.replace(b'a1', b'a2'), (2024, 1, 1, 0, 0, 0)),
+    ]
+    with tempfile.TemporaryDirectory() as directory:
+        hashes = []
+        for i, (export_data, date_time) in enumerate(exports):
+            path = os.path.join(directory, f'export{i}.zip')
+            with ZipFile(path, 'w') as zipfile:
+                zipfile.writestr(ZipInfo('export.csv', date_time), export_data)
+            with patch('hq_superset.utils.get_datasource_file') as open_mock:
+                hashes.append(get_datasource_file_hash(path))
+            # The export is not decompressed
+            open_mock.assert_not_called()
+        path = os.path.join(directory, 'export.csv')
+        with open(path, 'wb') as f:
+            f.write(data)
+        csv_hash = get_datasource_file_hash(path)
+    # Zip timestamps don't affect the hash, but the data does
+    assert hashes[0] == hashes[1]
+    assert hashes[0] != hashes[2]
+    assert csv_hash == hashlib.sha256(data).hexdigest()
+
+
 def test_doctests():
     import hq_superset.utils
     results = doctest.testmod(hq_superset.utils)
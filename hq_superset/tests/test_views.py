@@ -1,12 +1,17 @@
+import hashlib
 import json
 import os
 import pickle
+import shutil
+from datetime import datetime
 from io import StringIO
 from unittest.mock import patch
 
 import jwt
+import superset
 from flask import redirect, session
 from sqlalchemy.sql import text
+from superset.sql_parse import Table
 
 from hq_superset.const import (
     SESSION_DOMAIN_ROLE_LAST_SYNCED_AT,
@@ -148,13 +153,30 @@ class TestViews(HQDBTestCase):
             refresh_mock.assert_called_once_with(
                 'test1',
                 ucr_id,
-                'ds1'
+                'ds1',
+                False,
+            )
+            refresh_mock.reset_mock()
+            client.get(f'/hq_datasource/update/{ucr_id}?name=ds1&incremental=1', follow_redirects=True)
+            refresh_mock.assert_called_once_with(
+                'test1',
+                ucr_id,
+                'ds1',
+                True,
             )
         self.logout(client)
 
+    @patch('hq_superset.hq_requests.get_valid_cchq_oauth_token', return_value={})
     @patch.object(DomainSyncUtil, "sync_domain_role", return_value=True)
-    def test_trigger_datasource_refresh_with_api_exception(self, *args):
-        with patch("hq_superset.views.download_and_subscribe_to_datasource", side_effect=HQAPIException('mocked error')):
+    @patch('hq_superset.views.unsubscribe_from_hq_datasource')
+    @patch('hq_superset.views.subscribe_to_hq_datasource')
+    def test_trigger_datasource_refresh_with_api_exception(self, subscribe_mock, unsubscribe_mock, *args):
+        with (
+            patch("hq_superset.views.get_datasource_defn", return_value=TEST_DATASOURCE),
+            patch("hq_superset.views.download_datasource", side_effect=HQAPIException('mocked error')),
+            # The datasource has not been imported
+            patch("hq_superset.views.get_sqla_table", return_value=None),
+        ):
             client = self.app.test_client()
             self.login(client)
             client.get('/domain/select/test1/', follow_redirects=True)
@@ -167,21 +189,47 @@ class TestViews(HQDBTestCase):
                     flash_danger_message,
                     'The datasource refresh failed: mocked error. Please try again or report if issue persists.'
                 )
+            # The datasource is subscribed to while the export
+            # downloads, and unsubscribed from because it has not been
+            # imported
+            subscribe_mock.assert_called_once_with('test1', ucr_id)
+            unsubscribe_mock.assert_called_once_with('test1', ucr_id)
             self.assertEqual(response.status_code, 302)
             self.assertEqual(response.location, "/tablemodelview/list/")
             self.logout(client)
 
+    @patch('hq_superset.hq_requests.get_valid_cchq_oauth_token', return_value={})
+    @patch('hq_superset.views.unsubscribe_from_hq_datasource')
+    @patch('hq_superset.views.subscribe_to_hq_datasource')
+    def test_failed_refresh_keeps_the_subscription_of_imported_datasource(
+        self, subscribe_mock, unsubscribe_mock, *args
+    ):
+        from hq_superset.views import trigger_datasource_refresh
+
+        with (
+            patch("hq_superset.views.get_datasource_defn", return_value=TEST_DATASOURCE),
+            patch("hq_superset.views.download_datasource", side_effect=HQAPIException('mocked error')),
+            patch("hq_superset.views.get_sqla_table", return_value=object()),
+            self.app.test_request_context(),
+        ):
+            response = trigger_datasource_refresh('test1', 'ucr1', 'ds_name')
+        self.assertEqual(response.status_code, 302)
+        subscribe_mock.assert_called_once_with('test1', 'ucr1')
+        # Its dataset is still updated with its changes
+        unsubscribe_mock.assert_not_called()
+
+    @patch('hq_superset.hq_requests.get_valid_cchq_oauth_token', return_value={})
+    @patch('hq_superset.views.subscribe_to_hq_datasource')
     def test_trigger_datasource_refresh_with_errors(self, *args):
-        from hq_superset.views import (
-            ASYNC_DATASOURCE_IMPORT_LIMIT_IN_BYTES,
-            trigger_datasource_refresh,
-        )
+        from hq_superset.import_cost import ImportCost
+        from hq_superset.services import DatasourceExport
+        from hq_superset.views import trigger_datasource_refresh
 
         file_path = '/file_path/towards/dimagi'
-        file_size = ASYNC_DATASOURCE_IMPORT_LIMIT_IN_BYTES - 1
         with (
-            patch("hq_superset.views.download_and_subscribe_to_datasource", return_value=(file_path, file_size)),
+            patch("hq_superset.views.download_datasource", return_value=DatasourceExport(file_path, 100, 'abc')),
             patch("hq_superset.views.get_datasource_defn", return_value=TEST_DATASOURCE),
+            patch("hq_superset.views.estimate_import_cost", return_value=ImportCost(2, 6, 1.0)),
             patch("hq_superset.views.refresh_hq_datasource", side_effect=Exception('mocked error')),
             patch('hq_superset.views.os.remove') as os_remove_mock
         ):
@@ -192,29 +240,68 @@ class TestViews(HQDBTestCase):
             os_remove_mock.assert_called_once_with(file_path)
 
     @patch('hq_superset.hq_requests.get_valid_cchq_oauth_token', return_value={})
-    @patch('hq_superset.services.subscribe_to_hq_datasource')
+    @patch('hq_superset.views.unsubscribe_from_hq_datasource')
+    @patch('hq_superset.views.subscribe_to_hq_datasource')
+    def test_trigger_datasource_refresh_cleans_up_after_errors(self, *args):
+        from hq_superset.change_batches import get_redis_client
+        from hq_superset.change_log import get_recording_key
+        from hq_superset.services import DatasourceExport
+        from hq_superset.views import trigger_datasource_refresh
+
+        directory = superset.config.SHARED_DIR
+        os.makedirs(directory, exist_ok=True)
+        file_path = os.path.join(directory, 'ucr1_export.zip')
+        for patcher in (
+            patch("hq_superset.views.get_datasource_defn", side_effect=OSError('mocked error')),
+            patch("hq_superset.views.estimate_import_cost", side_effect=ValueError('mocked error')),
+        ):
+            with open(file_path, 'wb') as f:
+                f.write(b'export')
+            with (
+                patch(
+                    "hq_superset.views.download_datasource",
+                    return_value=DatasourceExport(file_path, 6, 'abc'),
+                ),
+                patch("hq_superset.views.get_datasource_defn", return_value=TEST_DATASOURCE),
+                patch("hq_superset.views.is_export_unchanged", return_value=False),
+                patch("hq_superset.views.get_sqla_table", return_value=None),
+                patcher,
+                self.assertRaises((OSError, ValueError)),
+            ):
+                trigger_datasource_refresh('test1', 'ucr1', 'ds_name')
+            # The export is not left on disk, and changes are not
+            # recorded until the recording expires
+            self.assertFalse(os.path.exists(file_path))
+            self.assertFalse(get_redis_client().exists(get_recording_key('ucr1')))
+
+    @patch('hq_superset.hq_requests.get_valid_cchq_oauth_token', return_value={})
+    @patch('hq_superset.views.subscribe_to_hq_datasource')
     @patch('hq_superset.views.os.remove')
     def test_trigger_datasource_refresh(self, *args):
-        from hq_superset.views import (
-            ASYNC_DATASOURCE_IMPORT_LIMIT_IN_BYTES,
-            trigger_datasource_refresh,
-        )
+        from hq_superset.import_cost import ImportCost
+        from hq_superset.services import DatasourceExport
+        from hq_superset.views import trigger_datasource_refresh
 
         domain = 'test1'
         ds_name = 'ds_name'
         file_path = '/file_path'
         ucr_id = self.oauth_mock.test1_datasources['objects'][0]['id']
 
-        def _test_sync_or_async(ds_size, routing_method, user_id):
+        def _test_sync_or_async(seconds, routing_method, user_id):
 
             with (
-                patch("hq_superset.views.download_and_subscribe_to_datasource") as download_ds_mock,
+                patch("hq_superset.views.download_datasource") as download_ds_mock,
                 patch("hq_superset.views.get_datasource_defn") as ds_defn_mock,
+                patch(
+                    "hq_superset.views.estimate_import_cost",
+                    return_value=ImportCost(1000, 6, seconds),
+                ),
+                patch.dict(self.app.config, {'HQ_IMPORT_SYNC_BUDGET_SECONDS': 20}),
                 patch(routing_method) as refresh_mock,
                 patch("hq_superset.views.g") as mock_g
             ):
                 mock_g.user = UserMock()
-                download_ds_mock.return_value = file_path, ds_size
+                download_ds_mock.return_value = DatasourceExport(file_path, 100, 'abc')
                 ds_defn_mock.return_value = TEST_DATASOURCE
                 trigger_datasource_refresh(domain, ucr_id, ds_name)
                 refresh_mock.assert_called_once_with(
@@ -223,20 +310,22 @@ class TestViews(HQDBTestCase):
                     ds_name,
                     file_path,
                     TEST_DATASOURCE,
-                    user_id
+                    user_id,
+                    False,
+                    'abc',
                 )
 
-        # When datasource size is more than the limit, it should get
-        #   queued via celery
+        # When the import is expected to take longer than the budget,
+        #   it should get queued via celery
         _test_sync_or_async(
-            ASYNC_DATASOURCE_IMPORT_LIMIT_IN_BYTES + 1,
+            21,
             "hq_superset.views.queue_refresh_task",
             UserMock().user_id
         )
-        # When datasource size is within the limit, it should get
-        #   refreshed directly
+        # When the import is expected to take no longer than the
+        #   budget, it should get refreshed directly
         _test_sync_or_async(
-            ASYNC_DATASOURCE_IMPORT_LIMIT_IN_BYTES - 1,
+            19,
             "hq_superset.views.refresh_hq_datasource",
             None
         )
@@ -252,7 +341,7 @@ class TestViews(HQDBTestCase):
             status_code=200,
         )
         ucr_id = self.oauth_mock.test1_datasources['objects'][0]['id']
-        path, size = download_and_subscribe_to_datasource('test1', ucr_id)
+        path, size, content_hash = download_and_subscribe_to_datasource('test1', ucr_id)
         subscribe_mock.assert_called_once_with(
             'test1',
             ucr_id,
@@ -260,8 +349,53 @@ class TestViews(HQDBTestCase):
         with open(path, 'rb') as f:
             self.assertEqual(pickle.load(f), TEST_UCR_CSV_V1)
             self.assertEqual(size, len(pickle.dumps(TEST_UCR_CSV_V1)))
+        self.assertEqual(
+            content_hash,
+            hashlib.sha256(pickle.dumps(TEST_UCR_CSV_V1)).hexdigest(),
+        )
         os.remove(path)
 
+    @patch('hq_superset.hq_requests.get_valid_cchq_oauth_token', return_value={})
+    @patch('hq_superset.services.get_datasource_file_hash')
+    @patch('hq_superset.hq_requests.HQRequest.get')
+    def test_download_datasource_incremental(self, hq_request_get_mock, hash_mock, *args):
+        from hq_superset.services import download_datasource
+
+        hq_request_get_mock.return_value = MockResponse(
+            json_data=TEST_UCR_CSV_V1,
+            status_code=200,
+        )
+        ucr_id = self.oauth_mock.test1_datasources['objects'][0]['id']
+        path, __, content_hash = download_datasource(
+            'test1', ucr_id, inserted_after=datetime(2024, 1, 1)
+        )
+        # Incremental exports are not hashed
+        self.assertIsNone(content_hash)
+        hash_mock.assert_not_called()
+        os.remove(path)
+
+    @patch('hq_superset.hq_requests.get_valid_cchq_oauth_token', return_value={})
+    @patch('hq_superset.services.subscribe_to_hq_datasource')
+    @patch('hq_superset.hq_requests.HQRequest.get')
+    def test_download_datasource_too_large(self, hq_request_get_mock, subscribe_mock, *args):
+        from hq_superset.services import download_and_subscribe_to_datasource
+
+        hq_request_get_mock.return_value = MockResponse(
+            json_data=TEST_UCR_CSV_V1,
+            status_code=200,
+        )
+        max_size = len(pickle.dumps(TEST_UCR_CSV_V1)) - 1
+        ucr_id = self.oauth_mock.test1_datasources['objects'][0]['id']
+        files_before = set(os.listdir(self.app.config['SHARED_DIR']))
+        with (
+            patch.dict(self.app.config, {'HQ_DATASOURCE_EXPORT_MAX_BYTES': max_size}),
+            self.assertRaises(HQAPIException),
+        ):
+            download_and_subscribe_to_datasource('test1', ucr_id)
+        subscribe_mock.assert_not_called()
+        # The partial download is removed
+        self.assertEqual(set(os.listdir(self.app.config['SHARED_DIR'])), files_before)
+
     @patch('hq_superset.services.unsubscribe_from_hq_datasource')
     @patch('hq_superset.hq_requests.get_valid_cchq_oauth_token', return_value={})
     def test_refresh_hq_datasource(self, unsubscribe_mock, *args):
@@ -316,6 +450,653 @@ class TestViews(HQDBTestCase):
             client.get('/hq_datasource/list/', follow_redirects=True)
             self.assert_context('ucr_id_to_pks', {})
 
+    @patch('hq_superset.hq_requests.get_valid_cchq_oauth_token', return_value={})
+    def test_refresh_hq_datasource_unlogged_staging(self, *args):
+        from hq_superset.services import refresh_hq_datasource
+
+        ucr_id = self.oauth_mock.test1_datasources['objects'][0]['id']
+        with (
+            patch("hq_superset.services.get_datasource_file") as csv_mock,
+            patch.dict(self.app.config, {'HQ_IMPORT_UNLOGGED_STAGING': True}),
+            patch("hq_superset.metrics.statsd") as statsd_mock,
+            self.app.test_client() as client
+        ):
+            self.login(client)
+            client.get('/domain/select/test1/', follow_redirects=True)
+            csv_mock.return_value = StringIO(TEST_UCR_CSV_V1)
+            refresh_hq_datasource('test1', ucr_id, 'ds1', '_', TEST_DATASOURCE)
+
+            with self.hq_db.get_sqla_engine_with_context() as engine:
+                relpersistence, reltuples = engine.execute(text(
+                    "SELECT relpersistence, reltuples FROM pg_class "
+                    "WHERE oid = 'hqdomain_test1.test1_ucr1'::regclass"
+                )).one()
+            # The live table is logged, and has been analyzed
+            self.assertEqual(relpersistence, 'p')
+            self.assertEqual(reltuples, 2)
+            phases = [
+                tag
+                for call in statsd_mock.histogram.call_args_list
+                if call.args[0] == 'cca.import.phase_seconds'
+                for tag in call.kwargs['tags']
+                if tag.startswith('phase:')
+            ]
+            # The table is set logged before it is indexed, so that
+            # its indexes are not built again when it is rewritten
+            self.assertEqual(phases, [
+                'phase:load',
+                'phase:set_logged',
+                'phase:index',
+                'phase:swap',
+                'phase:analyze',
+                'phase:metadata',
+            ])
+
+    @patch('hq_superset.hq_requests.get_valid_cchq_oauth_token', return_value={})
+    def test_refresh_hq_datasource_replays_changes(self, *args):
+        import hq_superset.services
+        from hq_superset.services import refresh_hq_datasource
+        from hq_superset.tasks import (
+            process_dataset_change,
+            queue_dataset_change,
+        )
+
+        ucr_id = self.oauth_mock.test1_datasources['objects'][0]['id']
+        change = {
+            'data_source_id': ucr_id,
+            'doc_id': 'a2',
+            'data': [{
+                'doc_id': 'a2',
+                'inserted_at': '2022-01-05T00:00:00Z',
+                'data_visit_number_33d63739': 11,
+                'data_visit_comment_fb984fda': 'changed',
+            }],
+        }
+        swap_staging_table = hq_superset.services.swap_staging_table
+
+        def swap_after_change(*args, **kwargs):
+            # The change arrives after the staging table is loaded
+            queue_dataset_change(change)
+            return swap_staging_table(*args, **kwargs)
+
+        with (
+            patch("hq_superset.services.get_datasource_file") as csv_mock,
+            patch.dict(self.app.config, {'HQ_DATASET_CHANGE_BATCH_SECONDS': 0}),
+            patch.object(
+                process_dataset_change,
+                'delay',
+                side_effect=process_dataset_change,
+            ),
+            self.app.test_client() as client
+        ):
+            self.login(client)
+            client.get('/domain/select/test1/', follow_redirects=True)
+            csv_mock.return_value = StringIO(TEST_UCR_CSV_V1)
+            refresh_hq_datasource('test1', ucr_id, 'ds1', '_', TEST_DATASOURCE)
+
+            csv_mock.return_value = StringIO(TEST_UCR_CSV_V2)
+            with patch(
+                "hq_superset.services.swap_staging_table",
+                side_effect=swap_after_change,
+            ):
+                refresh_hq_datasource(
+                    'test1', ucr_id, 'ds1', '_', TEST_DATASOURCE
+                )
+            with self.hq_db.get_sqla_engine_with_context() as engine:
+                result = engine.execute(text(
+                    'SELECT doc_id, data_visit_comment_fb984fda '
+                    'FROM hqdomain_test1.test1_ucr1 ORDER BY doc_id'
+                )).fetchall()
+            self.assertEqual(result, [
+                ('a1', ' some_text'),
+                ('a2', 'changed'),
+                ('a3', ' some_other_text2'),
+            ])
+
+    @patch('hq_superset.hq_requests.get_valid_cchq_oauth_token', return_value={})
+    def test_refresh_hq_datasource_incremental_replays_changes(self, *args):
+        import hq_superset.services
+        from hq_superset.services import refresh_hq_datasource
+        from hq_superset.tasks import (
+            process_dataset_change,
+            queue_dataset_change,
+        )
+
+        ucr_id = self.oauth_mock.test1_datasources['objects'][0]['id']
+        # The export has an older version of a2 than the change
+        delta_csv = (
+            TEST_UCR_CSV_V1.splitlines()[0] + "\n"
+            "a2, 2022-01-05, 2022-02-19, 11, 2022-03-20, exported_text\n"
+        )
+        change = {
+            'data_source_id': ucr_id,
+            'doc_id': 'a2',
+            'data': [{
+                'doc_id': 'a2',
+                'inserted_at': '2022-01-06T00:00:00Z',
+                'data_visit_number_33d63739': 12,
+                'data_visit_comment_fb984fda': 'changed',
+            }],
+        }
+        merge_staging_table = hq_superset.services.merge_staging_table
+
+        def merge_after_change(*args, **kwargs):
+            queue_dataset_change(change)
+            return merge_staging_table(*args, **kwargs)
+
+        with (
+            patch("hq_superset.services.get_datasource_file") as csv_mock,
+            patch.dict(self.app.config, {'HQ_DATASET_CHANGE_BATCH_SECONDS': 0}),
+            patch.object(
+                process_dataset_change,
+                'delay',
+                side_effect=process_dataset_change,
+            ),
+            self.app.test_client() as client
+        ):
+            self.login(client)
+            client.get('/domain/select/test1/', follow_redirects=True)
+            csv_mock.return_value = StringIO(TEST_UCR_CSV_V1)
+            refresh_hq_datasource('test1', ucr_id, 'ds1', '_', TEST_DATASOURCE)
+
+            csv_mock.return_value = StringIO(delta_csv)
+            with patch(
+                "hq_superset.services.merge_staging_table",
+                side_effect=merge_after_change,
+            ):
+                refresh_hq_datasource(
+                    'test1', ucr_id, 'ds1', '_', TEST_DATASOURCE,
+                    incremental=True,
+                )
+            with self.hq_db.get_sqla_engine_with_context() as engine:
+                result = engine.execute(text(
+                    'SELECT doc_id, data_visit_comment_fb984fda '
+                    'FROM hqdomain_test1.test1_ucr1 ORDER BY doc_id'
+                )).fetchall()
+            self.assertEqual(result, [
+                ('a1', ' some_text'),
+                ('a2', 'changed'),
+            ])
+
+    @patch('hq_superset.hq_requests.get_valid_cchq_oauth_token', return_value={})
+    def test_refresh_hq_datasource_incremental(self, *args):
+        from hq_superset.services import (
+            get_incremental_watermark,
+            refresh_hq_datasource,
+        )
+
+        ucr_id = self.oauth_mock.test1_datasources['objects'][0]['id']
+        delta_csv = (
+            TEST_UCR_CSV_V1.splitlines()[0] + "\n"
+            "a2, 2022-01-05, 2022-02-19, 11, 2022-03-20, updated_text\n"
+            "a3, 2022-01-04, 2022-01-19, 10, 2022-03-20, some_other_text2\n"
+        )
+        with (
+            patch("hq_superset.services.get_datasource_file") as csv_mock,
+            self.app.test_client() as client
+        ):
+            self.login(client)
+            client.get('/domain/select/test1/', follow_redirects=True)
+            self.assertIsNone(
+                get_incremental_watermark('test1', ucr_id, TEST_DATASOURCE)
+            )
+
+            csv_mock.return_value = StringIO(TEST_UCR_CSV_V1)
+            refresh_hq_datasource('test1', ucr_id, 'ds1', '_', TEST_DATASOURCE)
+            self.assertEqual(
+                get_incremental_watermark('test1', ucr_id, TEST_DATASOURCE),
+                datetime(2021, 12, 22),
+            )
+
+            csv_mock.return_value = StringIO(delta_csv)
+            refresh_hq_datasource(
+                'test1', ucr_id, 'ds1', '_', TEST_DATASOURCE, incremental=True
+            )
+            with self.hq_db.get_sqla_engine_with_context() as engine:
+                result = engine.execute(text(
+                    'SELECT doc_id, data_visit_comment_fb984fda '
+                    'FROM hqdomain_test1.test1_ucr1 ORDER BY doc_id'
+                )).fetchall()
+            self.assertEqual(result, [
+                ('a1', ' some_text'),
+                ('a2', ' updated_text'),
+                ('a3', ' some_other_text2'),
+            ])
+            self.assertEqual(
+                get_incremental_watermark('test1', ucr_id, TEST_DATASOURCE),
+                datetime(2022, 1, 5),
+            )
+
+            # A changed definition needs a full refresh
+            changed_defn = dict(
+                TEST_DATASOURCE,
+                configured_indicators=TEST_DATASOURCE['configured_indicators'][:-1],
+            )
+            self.assertIsNone(
+                get_incremental_watermark('test1', ucr_id, changed_defn)
+            )
+
+    @patch('hq_superset.hq_requests.get_valid_cchq_oauth_token', return_value={})
+    def test_refresh_hq_datasource_narrow_column_types(self, *args):
+        from superset.sql_parse import Table
+
+        from hq_superset.models import DataSetChange
+        from hq_superset.profiling import get_column_types
+        from hq_superset.services import get_sqla_table, refresh_hq_datasource
+        from hq_superset.utils import get_hq_database
+
+        ucr_id = self.oauth_mock.test1_datasources['objects'][0]['id']
+        header = TEST_UCR_CSV_V1.splitlines()[0]
+        full_csv = (
+            header + "\n"
+            "a1,2021-12-20,2022-01-19,100,2022-02-20,yes\n"
+            "a2,2021-12-22,2022-02-19,10,2022-03-20,no\n"
+        )
+        delta_csv = (
+            header + "\n"
+            "a3,2022-01-04,2022-01-19,12,2022-03-20,maybe\n"
+        )
+
+        def get_data_types():
+            with self.hq_db.get_sqla_engine_with_context() as engine:
+                return dict(engine.execute(text(
+                    "SELECT column_name, data_type "
+                    "FROM information_schema.columns "
+                    "WHERE table_schema = 'hqdomain_test1' "
+                    "AND table_name = 'test1_ucr1' "
+                    "AND column_name IN ("
+                    "'data_visit_number_33d63739', "
+                    "'data_visit_comment_fb984fda')"
+                )).fetchall())
+
+        def get_stored_column_types():
+            database = get_hq_database()
+            return get_column_types(get_sqla_table(
+                database, Table(table=ucr_id, schema='hqdomain_test1')
+            ))
+
+        with (
+            patch("hq_superset.services.get_datasource_file") as csv_mock,
+            patch.dict(self.app.config, {'HQ_IMPORT_NARROW_COLUMN_TYPES': True}),
+            self.app.test_client() as client
+        ):
+            self.login(client)
+            client.get('/domain/select/test1/', follow_redirects=True)
+            csv_mock.return_value = StringIO(full_csv)
+            refresh_hq_datasource('test1', ucr_id, 'ds1', '_', TEST_DATASOURCE)
+            self.assertEqual(get_data_types(), {
+                'data_visit_number_33d63739': 'smallint',
+                'data_visit_comment_fb984fda': 'boolean',
+            })
+            self.assertEqual(get_stored_column_types(), {
+                'data_visit_number_33d63739': {'type': 'smallint'},
+                'data_visit_comment_fb984fda': {
+                    'type': 'boolean', 'true': 'yes', 'false': 'no'
+                },
+            })
+
+            # "maybe" does not fit the boolean column, which is widened
+            csv_mock.return_value = StringIO(delta_csv)
+            refresh_hq_datasource(
+                'test1', ucr_id, 'ds1', '_', TEST_DATASOURCE, incremental=True
+            )
+            self.assertEqual(get_data_types(), {
+                'data_visit_number_33d63739': 'smallint',
+                'data_visit_comment_fb984fda': 'text',
+            })
+            self.assertEqual(get_stored_column_types(), {
+                'data_visit_number_33d63739': {'type': 'smallint'},
+            })
+
+            # A change that does not fit widens the columns again
+            DataSetChange(
+                data_source_id=ucr_id,
+                doc_id='a1',
+                data=[{
+                    'doc_id': 'a1',
+                    'data_visit_number_33d63739': 100_000,
+                    'data_visit_comment_fb984fda': 'yes',
+                }],
+            ).update_dataset()
+            self.assertEqual(get_data_types(), {
+                'data_visit_number_33d63739': 'bigint',
+                'data_visit_comment_fb984fda': 'text',
+            })
+            self.assertEqual(get_stored_column_types(), {})
+            with self.hq_db.get_sqla_engine_with_context() as engine:
+                result = engine.execute(text(
+                    'SELECT doc_id, data_visit_number_33d63739, '
+                    'data_visit_comment_fb984fda '
+                    'FROM hqdomain_test1.test1_ucr1 ORDER BY doc_id'
+                )).fetchall()
+            self.assertEqual(result, [
+                ('a1', 100_000, 'yes'),
+                ('a2', 10, 'no'),
+                ('a3', 12, 'maybe'),
+            ])
+
+    @patch('hq_superset.hq_requests.get_valid_cchq_oauth_token', return_value={})
+    def test_refresh_hq_datasource_partitioned(self, *args):
+        from hq_superset.services import refresh_hq_datasource
+        from hq_superset.tasks import maintain_datasource_partitions
+
+        ucr_id = self.oauth_mock.test1_datasources['objects'][0]['id']
+        delta_csv = (
+            TEST_UCR_CSV_V1.splitlines()[0] + "\n"
+            "a2, 2022-03-05, 2022-02-19, 11, 2022-03-20, updated_text\n"
+        )
+
+        def select_rows():
+            with self.hq_db.get_sqla_engine_with_context() as engine:
+                return engine.execute(text(
+                    'SELECT tableoid::regclass::text, doc_id '
+                    'FROM hqdomain_test1.test1_ucr1 ORDER BY doc_id'
+                )).fetchall()
+
+        with (
+            patch("hq_superset.services.get_datasource_file") as csv_mock,
+            patch(
+                "hq_superset.services.get_datasource_file_size",
+                return_value=len(TEST_UCR_CSV_V1),
+            ),
+            patch.dict(
+                self.app.config, {'HQ_DATASOURCE_PARTITION_MIN_BYTES': 100}
+            ),
+            self.app.test_client() as client
+        ):
+            self.login(client)
+            client.get('/domain/select/test1/', follow_redirects=True)
+            csv_mock.return_value = StringIO(TEST_UCR_CSV_V1)
+            refresh_hq_datasource('test1', ucr_id, 'ds1', '_', TEST_DATASOURCE)
+            self.assertEqual(select_rows(), [
+                ('hqdomain_test1.test1_ucr1_p2021_12', 'a1'),
+                ('hqdomain_test1.test1_ucr1_p2021_12', 'a2'),
+            ])
+            datasets = json.loads(client.get('/api/v1/dataset/').data)
+            self.assertEqual(datasets['result'][0]['table_name'], ucr_id)
+
+            # New rows get partitions for their months
+            csv_mock.return_value = StringIO(delta_csv)
+            refresh_hq_datasource(
+                'test1', ucr_id, 'ds1', '_', TEST_DATASOURCE, incremental=True
+            )
+            self.assertEqual(select_rows(), [
+                ('hqdomain_test1.test1_ucr1_p2021_12', 'a1'),
+                ('hqdomain_test1.test1_ucr1_p2022_03', 'a2'),
+            ])
+
+            with patch.dict(
+                self.app.config,
+                {'HQ_DATASOURCE_PARTITION_RETENTION_MONTHS': 12},
+            ):
+                maintain_datasource_partitions()
+            # Partitions for this month and next month are created, and
+            # expired partitions are detached
+            with self.hq_db.get_sqla_engine_with_context() as engine:
+                partition_count = engine.execute(text(
+                    "SELECT count(*) FROM pg_inherits WHERE inhparent = "
+                    "'hqdomain_test1.test1_ucr1'::regclass"
+                )).scalar()
+            self.assertEqual(partition_count, 3)  # Including the default
+            self.assertEqual(select_rows(), [])
+
+    def test_maintain_datasource_partitions_skips_failed_tables(self):
+        from hq_superset.tasks import maintain_datasource_partitions
+
+        tables = [
+            Table(table='ucr1', schema='hqdomain_test1'),
+            Table(table='ucr2', schema='hqdomain_test1'),
+        ]
+        with (
+            patch(
+                'hq_superset.tasks.get_partitioned_tables',
+                return_value=tables,
+            ),
+            patch(
+                'hq_superset.tasks.create_partitions',
+                side_effect=[Exception('mocked error'), None],
+            ) as create_mock,
+            patch('hq_superset.tasks.logger') as logger_mock,
+        ):
+            maintain_datasource_partitions()
+        self.assertEqual(
+            [kall.args[1] for kall in create_mock.call_args_list], tables
+        )
+        logger_mock.exception.assert_called_once()
+
+    @patch('hq_superset.hq_requests.get_valid_cchq_oauth_token', return_value={})
+    def test_refresh_hq_datasource_resumes_from_checkpoint(self, *args):
+        from hq_superset.services import (
+            AsyncImportHelper,
+            refresh_hq_datasource,
+        )
+
+        ucr_id = self.oauth_mock.test1_datasources['objects'][0]['id']
+        helper = AsyncImportHelper('test1', ucr_id)
+        with (
+            patch("hq_superset.services.get_datasource_file") as csv_mock,
+            patch(
+                "hq_superset.services.get_datasource_file_size",
+                return_value=len(TEST_UCR_CSV_V2),
+            ),
+            self.app.test_client() as client
+        ):
+            self.login(client)
+            client.get('/domain/select/test1/', follow_redirects=True)
+
+            # Simulate the worker being killed after loading two rows
+            csv_mock.return_value = StringIO(TEST_UCR_CSV_V1)
+            with (
+                patch(
+                    "hq_superset.services.swap_staging_table",
+                    side_effect=KeyboardInterrupt,
+                ),
+                self.assertRaises(KeyboardInterrupt),
+            ):
+                refresh_hq_datasource(
+                    'test1', ucr_id, 'ds1', '_', TEST_DATASOURCE, resumable=True
+                )
+            self.assertTrue(helper.has_checkpoint('_'))
+            self.assertFalse(helper.has_checkpoint('other_export'))
+            progress = helper.get_progress()
+            self.assertEqual(progress['stage'], 'indexing')
+            self.assertEqual(progress['rows'], 2)
+            self.assertEqual(progress['bytes_read'], len(TEST_UCR_CSV_V1))
+
+            # The retry only loads the rows after the checkpoint
+            csv_mock.return_value = StringIO(TEST_UCR_CSV_V2)
+            refresh_hq_datasource(
+                'test1', ucr_id, 'ds1', '_', TEST_DATASOURCE, resumable=True
+            )
+            with self.hq_db.get_sqla_engine_with_context() as engine:
+                result = engine.execute(text(
+                    'SELECT doc_id FROM hqdomain_test1.test1_ucr1 ORDER BY doc_id'
+                )).fetchall()
+            self.assertEqual(result, [('a1', ), ('a2', ), ('a3', )])
+            self.assertFalse(helper.has_checkpoint('_'))
+            self.assertIsNone(helper.get_progress())
+
+    @patch('hq_superset.hq_requests.get_valid_cchq_oauth_token', return_value={})
+    def test_rebuild_from_snapshot(self, *args):
+        from hq_superset.services import refresh_hq_datasource
+        from hq_superset.snapshots import get_snapshot, has_snapshot
+
+        ucr_id = self.oauth_mock.test1_datasources['objects'][0]['id']
+        shared_dir = self.app.config['SHARED_DIR']
+        os.makedirs(shared_dir, exist_ok=True)
+        files_before = set(os.listdir(shared_dir))
+        with (
+            patch.dict(
+                self.app.config, {'HQ_DATASOURCE_SNAPSHOTS_MAX_BYTES': 10**9}
+            ),
+            patch("hq_superset.services.get_datasource_file") as csv_mock,
+            self.app.test_client() as client,
+        ):
+            self.login(client)
+            client.get('/domain/select/test1/', follow_redirects=True)
+            # Without a snapshot, there is nothing to rebuild from
+            response = client.get(f'/hq_datasource/rebuild/{ucr_id}')
+            self.assertEqual(response.status, "302 FOUND")
+
+            csv_mock.return_value = StringIO(TEST_UCR_CSV_V1)
+            refresh_hq_datasource(
+                'test1', ucr_id, 'ds1', '_', TEST_DATASOURCE, content_hash='abc'
+            )
+            snapshot = get_snapshot('test1', ucr_id)
+            self.assertEqual(snapshot.datasource_defn, TEST_DATASOURCE)
+            self.assertEqual(snapshot.content_hash, 'abc')
+            try:
+                with self.hq_db.get_sqla_engine_with_context() as engine:
+                    engine.execute(text('DROP TABLE hqdomain_test1.test1_ucr1'))
+
+                csv_mock.reset_mock()
+                response = client.get(f'/hq_datasource/rebuild/{ucr_id}')
+                self.assertEqual(response.status, "302 FOUND")
+                csv_mock.assert_not_called()
+                with self.hq_db.get_sqla_engine_with_context() as engine:
+                    result = engine.execute(text(
+                        'SELECT doc_id, data_visit_comment_fb984fda '
+                        'FROM hqdomain_test1.test1_ucr1 ORDER BY doc_id'
+                    )).fetchall()
+                self.assertEqual(
+                    result, [('a1', ' some_text'), ('a2', ' some_other_text')]
+                )
+                # The copy that was imported is removed, the snapshot is kept
+                self.assertEqual(set(os.listdir(shared_dir)) - {'snapshots'}, files_before)
+                self.assertTrue(has_snapshot('test1', ucr_id))
+
+                # An incremental import would be missing from the snapshot
+                csv_mock.return_value = StringIO(TEST_UCR_CSV_V2)
+                refresh_hq_datasource(
+                    'test1', ucr_id, 'ds1', '_', TEST_DATASOURCE, incremental=True
+                )
+                self.assertFalse(has_snapshot('test1', ucr_id))
+            finally:
+                shutil.rmtree(os.path.join(shared_dir, 'snapshots'), ignore_errors=True)
+
+    @patch('hq_superset.hq_requests.get_valid_cchq_oauth_token', return_value={})
+    def test_rebuild_from_snapshot_keeps_partitions(self, *args):
+        from hq_superset.services import refresh_hq_datasource
+
+        ucr_id = self.oauth_mock.test1_datasources['objects'][0]['id']
+        shared_dir = self.app.config['SHARED_DIR']
+        os.makedirs(shared_dir, exist_ok=True)
+
+        def select_rows():
+            with self.hq_db.get_sqla_engine_with_context() as engine:
+                return engine.execute(text(
+                    'SELECT tableoid::regclass::text, doc_id '
+                    'FROM hqdomain_test1.test1_ucr1 ORDER BY doc_id'
+                )).fetchall()
+
+        with (
+            patch.dict(self.app.config, {
+                'HQ_DATASOURCE_SNAPSHOTS_MAX_BYTES': 10**9,
+                'HQ_DATASOURCE_PARTITION_MIN_BYTES': 10**6,
+            }),
+            patch("hq_superset.services.get_datasource_file") as csv_mock,
+            patch(
+                "hq_superset.services.get_datasource_file_size",
+                return_value=10**7,
+            ),
+            self.app.test_client() as client,
+        ):
+            self.login(client)
+            client.get('/domain/select/test1/', follow_redirects=True)
+            csv_mock.return_value = StringIO(TEST_UCR_CSV_V1)
+            refresh_hq_datasource('test1', ucr_id, 'ds1', '_', TEST_DATASOURCE)
+            try:
+                partitioned_rows = [
+                    ('hqdomain_test1.test1_ucr1_p2021_12', 'a1'),
+                    ('hqdomain_test1.test1_ucr1_p2021_12', 'a2'),
+                ]
+                self.assertEqual(select_rows(), partitioned_rows)
+
+                # The Parquet snapshot is smaller than the partition
+                # threshold, but the table is rebuilt as it was imported
+                response = client.get(f'/hq_datasource/rebuild/{ucr_id}')
+                self.assertEqual(response.status, "302 FOUND")
+                self.assertEqual(select_rows(), partitioned_rows)
+            finally:
+                shutil.rmtree(os.path.join(shared_dir, 'snapshots'), ignore_errors=True)
+
+    @patch.object(DomainSyncUtil, "_get_domain_access", return_value=(True, True, []))
+    def test_import_progress(self, *args):
+        from hq_superset.services import AsyncImportHelper
+
+        client = self.app.test_client()
+        self.login(client)
+        client.get('/domain/select/test1/', follow_redirects=True)
+        ucr_id = self.oauth_mock.test1_datasources['objects'][0]['id']
+        helper = AsyncImportHelper('test1', ucr_id)
+        helper.start_progress()
+        helper.set_progress('loading', rows=10000, bytes_read=250, total_bytes=1000)
+        try:
+            with patch.object(AsyncImportHelper, 'is_import_in_progress', return_value=True):
+                progress = client.get(f'/hq_datasource/progress/{ucr_id}').json
+            self.assertTrue(progress['in_progress'])
+            self.assertEqual(progress['stage'], 'loading')
+            self.assertEqual(progress['rows'], 10000)
+            self.assertEqual(progress['bytes_read'], 250)
+            self.assertEqual(progress['total_bytes'], 1000)
+            self.assertIsNotNone(progress['eta_seconds'])
+
+            with patch.object(AsyncImportHelper, 'is_import_in_progress', return_value=False):
+                progress = client.get(f'/hq_datasource/progress/{ucr_id}').json
+            self.assertEqual(progress, {'in_progress': False})
+        finally:
+            helper.clear_progress()
+        self.logout(client)
+
+    @patch('hq_superset.hq_requests.get_valid_cchq_oauth_token', return_value={})
+    @patch('hq_superset.views.subscribe_to_hq_datasource')
+    @patch('hq_superset.views.os.remove')
+    def test_unchanged_export_is_not_imported(self, os_remove_mock, *args):
+        from hq_superset.import_cost import ImportCost
+        from hq_superset.services import DatasourceExport, refresh_hq_datasource
+        from hq_superset.views import trigger_datasource_refresh
+
+        ucr_id = self.oauth_mock.test1_datasources['objects'][0]['id']
+        export = DatasourceExport('/file_path', 100, 'abc')
+        with (
+            patch("hq_superset.services.get_datasource_file") as csv_mock,
+            self.app.test_client() as client
+        ):
+            self.login(client)
+            client.get('/domain/select/test1/', follow_redirects=True)
+            csv_mock.return_value = StringIO(TEST_UCR_CSV_V1)
+            refresh_hq_datasource(
+                'test1', ucr_id, 'ds1', '_', TEST_DATASOURCE, content_hash='abc'
+            )
+
+            with (
+                patch("hq_superset.views.download_datasource", return_value=export),
+                patch("hq_superset.views.get_datasource_defn", return_value=TEST_DATASOURCE),
+                patch("hq_superset.views.refresh_hq_datasource") as refresh_mock,
+                patch("hq_superset.views.statsd") as statsd_mock,
+            ):
+                trigger_datasource_refresh('test1', ucr_id, 'ds1')
+                refresh_mock.assert_not_called()
+                os_remove_mock.assert_called_once_with('/file_path')
+                statsd_mock.increment.assert_called_once()
+                self.assertEqual(
+                    statsd_mock.increment.call_args[0][0],
+                    'cca.import.unchanged',
+                )
+
+            # An export with different data is imported
+            with (
+                patch(
+                    "hq_superset.views.download_datasource",
+                    return_value=export._replace(content_hash='def'),
+                ),
+                patch("hq_superset.views.get_datasource_defn", return_value=TEST_DATASOURCE),
+                patch("hq_superset.views.estimate_import_cost", return_value=ImportCost(2, 6, 1.0)),
+                patch("hq_superset.views.refresh_hq_datasource") as refresh_mock,
+            ):
+                trigger_datasource_refresh('test1', ucr_id, 'ds1')
+                refresh_mock.assert_called_once()
+
     @patch('hq_superset.hq_requests.get_valid_cchq_oauth_token', return_value={})
     @patch('hq_superset.hq_domain._sync_domain_role', return_value=None)
     def test_sync_user_domain_role_calls(self, sync_domain_role_mock, *args):
@@ -53,7 +53,7 @@ class OAuthMock(object):
     def authorize_access_token(self):
         return {"access_token": "some-key"}
 
-    def get(self, url, token):
+    def get(self, url, token, **kwargs):
         return {
             'api/v0.5/identity/': MockResponse(self.user_json, 200),
             'api/v0.5/user_domains?feature_flag=superset-analytics&can_view_reports=true': MockResponse(
@@ -81,6 +81,7 @@ class MockResponse:
     def __init__(self, json_data, status_code):
         self.json_data = json_data
         self.status_code = status_code
+        self.headers = {}
 
     def json(self):
         return self.json_data
@@ -89,3 +90,10 @@ class MockResponse:
     def content(self):
         return pickle.dumps(self.json_data)
 
+    def iter_content(self, chunk_size=1):
+        content = self.content
+        for i in range(0, len(content), chunk_size):
+            yield content[i:i + chunk_size]
+
+    def close(self):
+        pass
@@ -1,12 +1,14 @@
 import ast
+import hashlib
+import json
+import re
 import secrets
 import string
 import sys
 from contextlib import contextmanager
 from datetime import date, datetime
 from functools import partial
-from typing import Any, Generator
-from zipfile import ZipFile
+from zipfile import ZipFile, is_zipfile
 
 import pandas
 import pytz
@@ -14,7 +16,7 @@ import sqlalchemy
 from cryptography.fernet import Fernet
 from flask import current_app, session
 from flask_login import current_user
-from sqlalchemy.sql import TableClause
+from sqlalchemy.dialects import postgresql
 from superset.utils.database import get_or_create_db
 
 from hq_superset.const import (
@@ -97,6 +99,86 @@ def get_column_dtypes(datasource_defn):
     return column_dtypes, date_columns, array_type_columns
 
 
+def get_sql_dtypes(datasource_defn):
+    """
+    Returns SQLAlchemy types for the columns whose type pandas would
+    not infer correctly when creating the table.
+    """
+    sql_dtypes = {}
+    for ind in datasource_defn['configured_indicators']:
+        indicator_datatype = ind.get('datatype', 'string')
+        if indicator_datatype == 'array':
+            # Assumes all array values will be of type TEXT
+            sql_dtypes[ind['column_id']] = postgresql.ARRAY(
+                sqlalchemy.types.TEXT
+            )
+        elif indicator_datatype == 'date':
+            # Dates are parsed as datetime64. Store them as dates.
+            sql_dtypes[ind['column_id']] = sqlalchemy.types.Date
+    return sql_dtypes
+
+
+def get_datasource_defn_hash(datasource_defn):
+    """
+    Returns a hash of the parts of a datasource definition that
+    determine the columns and rows of its table. If the hash changes,
+    the table must be reloaded in full.
+
+    >>> defn = {'configured_filter': {}, 'configured_indicators': [],
+    ...         'display_name': 'Visits'}
+    >>> get_datasource_defn_hash(defn) == get_datasource_defn_hash(
+    ...     dict(defn, display_name='Renamed visits'))
+    True
+
+    """
+    relevant = {
+        key: datasource_defn.get(key)
+        for key in ('configured_filter', 'configured_indicators')
+    }
+    serialized = json.dumps(relevant, sort_keys=True)
+    return hashlib.sha256(serialized.encode('utf-8')).hexdigest()
+
+
+def parse_date_columns(df, date_columns):
+    """
+    Converts the ``date_columns`` of ``df`` to datetime64 in place,
+    parsing one column at a time. Values that cannot be parsed become
+    NaT. Returns the number of values that could not be parsed.
+
+    >>> df = pandas.DataFrame({'inserted_at': pandas.Series([
+    ...     '2022-02-24 12:29:19.450137',
+    ...     '2022-02-22',
+    ...     None,
+    ...     'not a date',
+    ... ], dtype='string')})
+    >>> parse_date_columns(df, ['inserted_at'])
+    1
+    >>> df['inserted_at']
+    0   2022-02-24 12:29:19.450137
+    1   2022-02-22 00:00:00.000000
+    2                          NaT
+    3                          NaT
+    Name: inserted_at, dtype: datetime64[ns]
+
+    """
+    unparseable_count = 0
+    for column in date_columns:
+        if column not in df.columns:
+            continue
+        values = df[column]
+        # HQ formats datetimes in UTC. ``utc=True`` handles exports
+        # that mix naive and "Z"-suffixed values.
+        parsed = pandas.to_datetime(
+            values,
+            errors='coerce',
+            format='ISO8601',
+            utc=True,
+        ).dt.tz_localize(None)
+        unparseable_count += int((parsed.isna() & values.notna()).sum())
+        df[column] = parsed
+    return unparseable_count
+
+
 def parse_date(date_str):
     """
     Simple, fast date parser for dates formatted by CommCare HQ.
@@ -261,6 +343,54 @@ def get_datasource_file(path):
         yield zipfile.open(filename)
 
 
+def get_datasource_file_hash(path):
+    """
+    Returns a SHA-256 hash of the data in the zipped export at ``path``,
+    so that unchanged exports can be skipped.
+
+    The CRC-32 and the uncompressed size of each file in the zip file
+    are hashed, because zip files include timestamps, so two exports of
+    the same data are not the same. They are read from the central
+    directory at the end of the zip file, so that a large export is not
+    read again. An export that is not zipped is hashed as it is.
+    """
+    digest = hashlib.sha256()
+    if not is_zipfile(path):
+        with open(path, 'rb') as f:
+            for block in iter(partial(f.read, 1024 * 1024), b''):
+                digest.update(block)
+        return digest.hexdigest()
+    with ZipFile(path) as zipfile:
+        for info in zipfile.infolist():
+            digest.update(f"{info.CRC:08x}:{info.file_size}\n".encode())
+    return digest.hexdigest()
+
+
+def get_datasource_file_size(path):
+    """
+    Returns the uncompressed size of the CSV file in the zipped export
+    at ``path``.
+    """
+    with ZipFile(path) as zipfile:
+        return zipfile.infolist()[0].file_size
+
+
+def get_eta_seconds(elapsed, bytes_read, total_bytes):
+    """
+    Estimates the seconds left to read an export, assuming the rest of
+    it is read at the same rate as the part that has been read.
+
+    >>> get_eta_seconds(10, 250, 1000)
+    30.0
+    >>> get_eta_seconds(10, 0, 1000) is None
+    True
+
+    """
+    if not bytes_read or not total_bytes:
+        return None
+    return elapsed * max(total_bytes - bytes_read, 0) / bytes_read
+
+
 def get_fernet_keys():
     return [
         Fernet(encoded(key, 'ascii'))
@@ -286,6 +416,24 @@ def encoded(string_maybe, encoding):
     return string_maybe
 
 
+# Matches one item of the list literals that HQ exports for array
+# indicators, and the comma that follows it. Anything else, like
+# escaped quotes or nested lists, is left to ``ast.literal_eval()``.
+ARRAY_ITEM_RE = re.compile(r"""
+    \s*(?:
+        '(?P<single_quoted>[^'\\]*)'
+      | "(?P<double_quoted>[^"\\]*)"
+      | (?P<none>None)
+      | (?P<float>-?\d+\.\d*(?:[eE][-+]?\d+)?)
+      | (?P<int>-?(?:0|[1-9]\d*))
+    )\s*(?:(?P<comma>,)|\Z)
+""", re.VERBOSE)
+
+
+# Limits the memory used to remember decoded array values
+MAX_DECODED_ARRAYS = 10_000
+
+
 def convert_to_array(string_array):
     """
     Converts the string representation of a list to a list.
@@ -300,15 +448,20 @@ def convert_to_array(string_array):
 
     >>> convert_to_array("hello, world")
     []
+
+    >>> convert_to_array("[1, 2.5, None, 'hello']")
+    [1, 2.5, None, 'hello']
     """
 
     def array_is_falsy(array_values):
         return not array_values or array_values == [None]
 
-    try:
-        array_values = ast.literal_eval(string_array)
-    except ValueError:
-        return []
+    array_values = _parse_list_literal(string_array)
+    if array_values is None:
+        try:
+            array_values = ast.literal_eval(string_array)
+        except (ValueError, SyntaxError):
+            return []
 
     if isinstance(array_values, tuple):
         array_values = list(array_values)
@@ -320,6 +473,101 @@ def convert_to_array(string_array):
     return array_values
 
 
+def _parse_list_literal(string_array):
+    """
+    Parses simple list and tuple literals without ``ast``. Returns None
+    if the string needs to be parsed by ``ast.literal_eval()``.
+
+    >>> _parse_list_literal("['a', 'b', None, -1, 2.5]")
+    ['a', 'b', None, -1, 2.5]
+    >>> _parse_list_literal("'a',")
+    ['a']
+    >>> _parse_list_literal("'a'") is None  # Not a tuple
+    True
+    >>> _parse_list_literal("[['a']]") is None
+    True
+    """
+    if (
+        len(string_array) >= 4
+        and string_array.startswith("['")
+        and string_array.endswith("']")
+        and '\\' not in string_array
+    ):
+        # Most values are Python reprs of lists of strings. If the only
+        # quotes are the ones around items, splitting is all we need.
+        inner = string_array[2:-2]
+        items = inner.split("', '")
+        if inner.count("'") == 2 * (len(items) - 1):
+            return items
+
+    literal = string_array.strip()
+    if literal[:1] + literal[-1:] in ('[]', '()'):
+        is_list = literal[0] == '['
+        literal = literal[1:-1]
+    else:
+        is_list = False
+    if not literal.strip():
+        return [] if is_list or string_array.strip() == '()' else None
+
+    items = []
+    pos = 0
+    match = None
+    while pos < len(literal):
+        match = ARRAY_ITEM_RE.match(literal, pos)
+        if not match:
+            return None
+        if match['single_quoted'] is not None:
+            items.append(match['single_quoted'])
+        elif match['double_quoted'] is not None:
+            items.append(match['double_quoted'])
+        elif match['none'] is not None:
+            items.append(None)
+        elif match['float'] is not None:
+            items.append(float(match['float']))
+        else:
+            items.append(int(match['int']))
+        pos = match.end()
+        if match['comma'] is None:
+            break
+    if pos < len(literal):
+        return None
+    if not is_list and len(items) == 1 and match['comma'] is None:
+        # "'a'" and "('a')" are not tuples
+        return None
+    return items
+
+
+def convert_array_column(values, decoded=None):
+    """
+    Converts a Series of string representations of lists to lists.
+    Each distinct value is only decoded once. Missing values become
+    empty lists.
+
+    Pass the same dict as ``decoded`` for each chunk of a column to
+    reuse values decoded in earlier chunks. Once it holds
+    ``MAX_DECODED_ARRAYS`` values, new values are decoded but not
+    remembered.
+
+    >>> values = pandas.Series(["['a']", None, "['a']", "[None]"], dtype='string')
+    >>> convert_array_column(values).tolist()
+    [['a'], [], ['a'], []]
+    """
+    if decoded is None:
+        decoded = {}
+    arrays = []
+    for value in values.to_numpy(dtype=object, na_value=None):
+        if value in decoded:
+            # Copy so that rows do not share the same list
+            arrays.append(decoded[value].copy())
+        else:
+            array = [] if value is None else convert_to_array(value)
+            if len(decoded) < MAX_DECODED_ARRAYS:
+                decoded[value] = array
+                array = array.copy()
+            arrays.append(array)
+    return pandas.Series(arrays, index=values.index, dtype=object)
+
+
 def js_to_py_datetime(jsdt, preserve_tz=True):
     """
     JavaScript UTC datetimes end in "Z". In Python < 3.11,
@@ -346,34 +594,6 @@ def js_to_py_datetime(jsdt, preserve_tz=True):
     return datetime.fromisoformat(pydt)
 
 
-def cast_data_for_table(
-    data: list[dict[str, Any]],
-    table: TableClause,
-) -> Generator[dict[str, Any], None, None]:
-    """
-    Returns ``data`` with values cast in the correct data types for
-    the columns of ``table``.
-    """
-    cast_functions = {
-        # 'BIGINT': int,
-        # 'TEXT': str,
-        'TIMESTAMP': partial(js_to_py_datetime, preserve_tz=False),
-        # TODO: What else?
-    }
-
-    column_types = {c.name: str(c.type) for c in table.columns}
-    for row in data:
-        cast_row = {}
-        for column, value in row.items():
-            type_name = column_types[column]
-            if type_name in cast_functions:
-                cast_func = cast_functions[type_name]
-                cast_row[column] = cast_func(value)
-            else:
-                cast_row[column] = value
-        yield cast_row
-
-
 def generate_secret():
     alphabet = string.ascii_letters + string.digits
     return ''.join(secrets.choice(alphabet) for __ in range(64))
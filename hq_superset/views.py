@@ -1,9 +1,20 @@
 import logging
 import os
+from concurrent.futures import wait
 
 import requests
 import superset
-from flask import Response, abort, flash, g, redirect, request, url_for
+from datadog import statsd
+from flask import (
+    Response,
+    abort,
+    flash,
+    g,
+    jsonify,
+    redirect,
+    request,
+    url_for,
+)
 from flask_appbuilder import expose
 from flask_appbuilder.security.decorators import has_access, permission_name
 from superset import db
@@ -14,19 +25,32 @@ from superset.commands.dataset.delete import (
     DeleteDatasetCommand,
 )
 from superset.connectors.sqla.models import SqlaTable
+from superset.sql_parse import Table
 from superset.views.base import BaseSupersetView
 
+from hq_superset.change_log import (
+    start_recording_changes,
+    stop_recording_changes,
+)
 from hq_superset.exceptions import HQAPIException
 from hq_superset.hq_domain import user_domains
-from hq_superset.hq_requests import HQRequest
+from hq_superset.hq_requests import HQCallGroup, HQRequest
 from hq_superset.hq_url import datasource_list
+from hq_superset.import_cost import estimate_import_cost, get_sync_import_budget
+from hq_superset.metrics import get_tags
 from hq_superset.services import (
     AsyncImportHelper,
-    download_and_subscribe_to_datasource,
+    download_datasource,
     get_datasource_defn,
+    get_incremental_watermark,
+    get_sqla_table,
+    is_export_unchanged,
     refresh_hq_datasource,
+    subscribe_to_hq_datasource,
     unsubscribe_from_hq_datasource,
 )
+from hq_superset.snapshots import copy_snapshot, get_snapshot, has_snapshot
+from hq_superset.table_cache import invalidate_table
 from hq_superset.tasks import refresh_hq_datasource_task
 from hq_superset.utils import (
     DomainSyncUtil,
@@ -34,8 +58,6 @@ from hq_superset.utils import (
     get_schema_name_for_domain,
 )
 
-ASYNC_DATASOURCE_IMPORT_LIMIT_IN_BYTES = 5_000_000  # ~5MB
-
 logger = logging.getLogger(__name__)
 
 
@@ -71,11 +93,22 @@ class HQDatasourceView(BaseSupersetView):
         # Fetches data for a datasource from HQ and creates/updates a
         # Superset table
         display_name = request.args.get("name")
+        # Incremental refreshes only fetch rows that HQ has inserted
+        # since the last import
+        incremental = request.args.get("incremental") == "1"
         res = trigger_datasource_refresh(
-            g.hq_domain, datasource_id, display_name
+            g.hq_domain, datasource_id, display_name, incremental
         )
         return res
 
+    @expose("/rebuild/<datasource_id>", methods=["GET"])
+    @has_access
+    @permission_name("write")
+    def rebuild(self, datasource_id):
+        # Reloads a datasource's table from its snapshot, without
+        # contacting CommCare HQ
+        return rebuild_datasource_from_snapshot(g.hq_domain, datasource_id)
+
     @expose("/list/", methods=["GET"])
     def list_hq_datasources(self):
         hq_request = HQRequest(url=datasource_list(g.hq_domain))
@@ -105,6 +138,7 @@ class HQDatasourceView(BaseSupersetView):
             ds['is_import_in_progress'] = AsyncImportHelper(
                 g.hq_domain, ds['id']
             ).is_import_in_progress()
+            ds['has_snapshot'] = has_snapshot(g.hq_domain, ds['id'])
         return self.render_template(
             "hq_datasource_list.html",
             hq_datasources=hq_datasources,
@@ -112,6 +146,15 @@ class HQDatasourceView(BaseSupersetView):
             hq_base_url=hq_request.api_base_url
         )
 
+    @expose("/progress/<datasource_id>", methods=["GET"])
+    def import_progress(self, datasource_id):
+        # Returns the progress of a background import as JSON, for
+        # hq_datasource_list.html to poll
+        helper = AsyncImportHelper(g.hq_domain, datasource_id)
+        if not helper.is_import_in_progress():
+            return jsonify({"in_progress": False})
+        return jsonify({"in_progress": True, **(helper.get_progress() or {})})
+
     @expose("/delete/<datasource_pk>", methods=["GET"])
     def delete(self, datasource_pk):
         datasource_id = self._ucr_id_from_pk(datasource_pk)
@@ -132,11 +175,17 @@ class HQDatasourceView(BaseSupersetView):
             return abort(400, description=str(ex))
         else:
             if datasource_id:
+                invalidate_table(datasource_id)
                 unsubscribe_from_hq_datasource(g.hq_domain, datasource_id)
         return redirect("/tablemodelview/list/")
 
 
-def trigger_datasource_refresh(domain, datasource_id, display_name):
+def trigger_datasource_refresh(
+    domain,
+    datasource_id,
+    display_name,
+    incremental=False,
+):
     if AsyncImportHelper(domain, datasource_id).is_import_in_progress():
         flash(
             "The datasource is already being imported in the background. "
@@ -145,21 +194,176 @@ def trigger_datasource_refresh(domain, datasource_id, display_name):
         )
         return redirect("/tablemodelview/list/")
 
+    # Changes that arrive after the export is taken are replayed when
+    # it is imported. Recording starts before the subscription, so that
+    # no change is in neither the export nor the recording.
+    start_recording_changes(datasource_id)
+    # The definition and the subscription are fetched while the export
+    # downloads
+    hq_calls = HQCallGroup({"datasource": datasource_id})
+    defn_future = hq_calls.submit(
+        'definition', get_datasource_defn, domain, datasource_id
+    )
+    subscription_future = hq_calls.submit(
+        'subscribe', subscribe_to_hq_datasource, domain, datasource_id
+    )
+    export = None
     try:
-        path, size = download_and_subscribe_to_datasource(domain, datasource_id)
+        inserted_after = None
+        if incremental:
+            # Falls back to a full refresh if the datasource has not
+            # been imported, or its definition has changed. The export
+            # waits for the definition to know which rows to include.
+            inserted_after = get_incremental_watermark(
+                domain, datasource_id, defn_future.result()
+            )
+        export = hq_calls.call(
+            'export', download_datasource, domain, datasource_id, inserted_after
+        )
+        datasource_defn = defn_future.result()
+        subscription_future.result()
     except HQAPIException as e:
+        abandon_refresh(domain, datasource_id, export, subscription_future)
         flash(
             f"The datasource refresh failed: {e}. "
             "Please try again or report if issue persists.",
             "danger"
         )
         return redirect("/tablemodelview/list/")
+    except Exception:
+        abandon_refresh(domain, datasource_id, export, subscription_future)
+        raise
+    finally:
+        hq_calls.report()
+
+    incremental = inserted_after is not None
+    path, __, content_hash = export
+    try:
+        if not incremental and is_export_unchanged(
+            domain, datasource_id, datasource_defn, content_hash
+        ):
+            stop_recording_changes(datasource_id)
+            os.remove(path)
+            statsd.increment(
+                'cca.import.unchanged',
+                tags=get_tags({"datasource": datasource_id}),
+            )
+            flash(
+                "The datasource has not changed since it was last imported.",
+                "info",
+            )
+            return redirect("/tablemodelview/list/")
 
-    datasource_defn = get_datasource_defn(domain, datasource_id)
-    if size < ASYNC_DATASOURCE_IMPORT_LIMIT_IN_BYTES:
+        # Once the import has started, it stops recording and removes
+        # the export
+        return import_datasource_file(
+            domain,
+            datasource_id,
+            display_name,
+            path,
+            datasource_defn,
+            incremental,
+            content_hash,
+        )
+    except Exception:
+        abandon_refresh(domain, datasource_id, export, subscription_future)
+        raise
+
+
+def abandon_refresh(domain, datasource_id, export, subscription_future):
+    """
+    Cleans up after a refresh that failed before it was imported. Stops
+    recording the changes to the datasource, and removes its export.
+
+    Unsubscribes from its changes, unless it was imported before, and
+    its dataset still needs them.
+    """
+    stop_recording_changes(datasource_id)
+    if export and os.path.exists(export.path):
+        os.remove(export.path)
+    # Wait for the subscription, so that it does not follow the
+    # unsubscription
+    wait([subscription_future])
+    table = Table(
+        table=datasource_id,
+        schema=get_schema_name_for_domain(domain),
+    )
+    if get_sqla_table(get_hq_database(), table) is None:
+        unsubscribe_from_hq_datasource(domain, datasource_id)
+
+
+def rebuild_datasource_from_snapshot(domain, datasource_id):
+    """
+    Imports the snapshot of the last full import of the datasource.
+    Changes to the datasource since then are not included, until it
+    is refreshed from CommCare HQ.
+    """
+    if AsyncImportHelper(domain, datasource_id).is_import_in_progress():
+        flash(
+            "The datasource is already being imported in the background. "
+            "Please wait for it to finish before retrying.",
+            "warning",
+        )
+        return redirect("/tablemodelview/list/")
+
+    snapshot = get_snapshot(domain, datasource_id)
+    if snapshot is None:
+        flash(
+            "There is no snapshot to rebuild the datasource from. "
+            "Please refresh it from CommCare HQ.",
+            "warning",
+        )
+        return redirect("/tablemodelview/list/")
+
+    statsd.increment(
+        'cca.import.rebuild_from_snapshot',
+        tags=get_tags({"datasource": datasource_id}),
+    )
+    return import_datasource_file(
+        domain,
+        datasource_id,
+        snapshot.display_name,
+        copy_snapshot(snapshot),
+        snapshot.datasource_defn,
+        False,
+        snapshot.content_hash,
+    )
+
+
+def import_datasource_file(
+    domain,
+    datasource_id,
+    display_name,
+    path,
+    datasource_defn,
+    incremental=False,
+    content_hash=None,
+):
+    """
+    Imports the file at ``path`` now if it is expected to take no
+    longer than ``HQ_IMPORT_SYNC_BUDGET_SECONDS``, or in the
+    background, and removes it when it has been imported.
+    """
+    cost = estimate_import_cost(path, datasource_defn)
+    budget = get_sync_import_budget()
+    logger.info(
+        "Importing %s is estimated to take %.1fs (%s rows, %s columns)",
+        datasource_id,
+        cost.seconds,
+        cost.rows,
+        cost.columns,
+    )
+    if cost.seconds <= budget:
         try:
             refresh_hq_datasource(
-                domain, datasource_id, display_name, path, datasource_defn, None
+                domain,
+                datasource_id,
+                display_name,
+                path,
+                datasource_defn,
+                None,
+                incremental,
+                content_hash,
             )
         except Exception:
             flash(
@@ -171,11 +375,10 @@ def trigger_datasource_refresh(domain, datasource_id, display_name):
             os.remove(path)
         return redirect("/tablemodelview/list/")
     else:
-        limit_in_mb = int(ASYNC_DATASOURCE_IMPORT_LIMIT_IN_BYTES / 1000000)
         flash(
             "The datasource is being refreshed in the background as it is "
-            f"larger than {limit_in_mb} MB. This may take a while, please "
-            "wait for it to finish.",
+            f"expected to take longer than {budget} seconds. This may take "
+            "a while, please wait for it to finish.",
             "info",
         )
         return queue_refresh_task(
@@ -185,6 +388,8 @@ def trigger_datasource_refresh(domain, datasource_id, display_name):
             path,
             datasource_defn,
             g.user.get_id(),
+            incremental,
+            content_hash,
         )
 
 
@@ -195,6 +400,8 @@ def queue_refresh_task(
     export_path,
     datasource_defn,
     user_id,
+    incremental=False,
+    content_hash=None,
 ):
     task_id = refresh_hq_datasource_task.delay(
         domain,
@@ -203,6 +410,8 @@ def queue_refresh_task(
         export_path,
         datasource_defn,
         g.user.get_id(),
+        incremental,
+        content_hash,
     ).task_id
     AsyncImportHelper(domain, datasource_id).mark_as_in_progress(task_id)
     return redirect("/tablemodelview/list/")
@@ -8,7 +8,7 @@ setup(
     author='Dimagi Inc.',
     author_email='sreddy@dimagi.com',
     url='https://github.com/dimagi/commcare-analytics',
-    packages=find_packages(exclude=['docs', 'tests']),
+    packages=find_packages(exclude=['benchmarks', 'docs', 'tests']),
     include_package_data=True,
     install_requires=[
         'dimagi-superset==3.1.0.post2',
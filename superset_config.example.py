@@ -82,9 +82,84 @@ AUTH_USER_REGISTRATION_ROLE = "Gamma"
 SHARED_DIR = 'shared_dir'
 REMOVE_SHARED_FILES_AFTER = 7 # days
 
-# If this is enabled, UCRs larger than
-#   hq_superset.views.ASYNC_DATASOURCE_IMPORT_LIMIT_IN_BYTES
-#   are imported via Celery/Redis.
+# UCR exports larger than this are not downloaded. Set to None for no limit.
+HQ_DATASOURCE_EXPORT_MAX_BYTES = 2_000_000_000  # ~2GB
+
+# Imported tables are indexed on "doc_id". Index these columns too.
+HQ_DATASOURCE_INDEX_COLUMNS = ['inserted_at']
+
+# UCR exports are read in chunks sized to fit in this much memory. The
+# peak RSS of each import is reported as "cca.import.peak_rss_bytes".
+HQ_IMPORT_MEMORY_BUDGET_BYTES = 256 * 1024 * 1024  # 256MB
+
+# If this is more than 1, imports into PostgreSQL load chunks using
+# this many threads, each with its own database connection. Chunks can
+# then be committed out of order, so an interrupted background import
+# starts again instead of resuming from its last checkpoint.
+HQ_IMPORT_LOADER_WORKERS = 1
+
+# The engine that parses UCR exports: "pandas" or "pyarrow". Arrow
+# parses blocks of the CSV with several threads. It does not accept
+# whitespace around numbers, which pandas ignores.
+HQ_IMPORT_CSV_ENGINE = 'pandas'
+
+# Load full imports into an UNLOGGED staging table, which is set logged
+# before it replaces the live table. This avoids writing WAL for every
+# chunk, but the staging table is emptied if PostgreSQL crashes, and an
+# interrupted import then starts again.
+HQ_IMPORT_UNLOGGED_STAGING = True
+
+# Full imports write a Parquet snapshot of the export to
+# SHARED_DIR/snapshots/, which "Rebuild" imports again without
+# downloading it from CommCare HQ. The least recently written snapshots
+# are removed to keep them under this many bytes. 0 disables snapshots.
+HQ_DATASOURCE_SNAPSHOTS_MAX_BYTES = 10 * 1024 * 1024 * 1024  # 10GB
+
+# Full imports of exports of at least this many bytes create a table
+# partitioned by month of "inserted_at". Queries filtered by
+# "inserted_at" only read the partitions they need. 0 disables
+# partitioning.
+HQ_DATASOURCE_PARTITION_MIN_BYTES = 1024 * 1024 * 1024  # 1GB
+
+# The "maintain_datasource_partitions" task detaches (or drops)
+# partitions older than this many months. A full refresh imports them
+# again. None keeps all partitions.
+HQ_DATASOURCE_PARTITION_RETENTION_MONTHS = None
+HQ_DATASOURCE_PARTITION_DROP_EXPIRED = False
+
+# Full imports store integer columns as SMALLINT or INTEGER if their
+# values fit, and text columns that only hold "true"/"false" or
+# "yes"/"no" as BOOLEAN. Columns are widened again when a change does
+# not fit.
+HQ_IMPORT_NARROW_COLUMN_TYPES = False
+
+# Refreshing a datasource fetches its definition and subscribes to its
+# changes while the export downloads. Each web worker makes at most
+# this many of these calls to CommCare HQ at once.
+HQ_REQUEST_WORKERS = 4
+
+# Changes to a datasource forwarded by CommCare HQ are collected for
+# this many seconds, or until there are HQ_DATASET_CHANGE_BATCH_SIZE of
+# them, and applied in one transaction. 0 applies each change in its
+# own task. Changes left waiting, because the task scheduled to apply
+# them was lost, are applied by the "drain_dataset_changes" task.
+HQ_DATASET_CHANGE_BATCH_SECONDS = 2
+HQ_DATASET_CHANGE_BATCH_SIZE = 500
+
+# Apply each dataset change by comparing its rows with the rows of its
+# documents in the table, and writing only the rows that differ,
+# instead of deleting and inserting them all. Unchanged rows are counted
+# as "cca.dataset_change.rows" tagged "action:skipped".
+HQ_DATASET_CHANGE_APPLY_DIFF = False
+
+# UCR imports that are expected to take longer than this are imported
+# via Celery/Redis. The estimate is based on the number of rows and
+# columns of the export, and how fast past imports were.
+HQ_IMPORT_SYNC_BUDGET_SECONDS = 20
+
+# If this is enabled, UCRs that are expected to take longer than
+#   HQ_IMPORT_SYNC_BUDGET_SECONDS to import are imported via
+#   Celery/Redis.
 ENABLE_ASYNC_UCR_IMPORTS = False
 
 # Enable below for sentry integration
@@ -122,6 +197,10 @@ class CeleryConfig:
     worker_log_level = 'DEBUG'
     worker_prefetch_multiplier = 10
     task_acks_late = True
+    # Tasks that have not been acknowledged within the visibility
+    # timeout are redelivered. It must be longer than the longest UCR
+    # import, or a running import will be started again.
+    broker_transport_options = {'visibility_timeout': 6 * 60 * 60}
     task_annotations = {
         'sql_lab.get_sql_results': {
             'rate_limit': '100/s',
@@ -142,7 +221,15 @@ class CeleryConfig:
         'delete_redundant_shared_files': {
             'task': 'delete_redundant_shared_files',
             'schedule': crontab(hour='0', minute='0')
-        }
+        },
+        'maintain_datasource_partitions': {
+            'task': 'maintain_datasource_partitions',
+            'schedule': crontab(hour='1', minute='0')
+        },
+        'drain_dataset_changes': {
+            'task': 'drain_dataset_changes',
+            'schedule': crontab(minute='*/5')
+        },
     }
 
 